@@ -0,0 +1,68 @@
+"""Compares the throughput (rows/sec) of the in-process aggregation of ``chartchemy.kernels`` with the GROUP BY
+of the database, on the SQLite fixture of ``query_paths.py``.
+
+``kernels_python`` is the plain Python kernel, ``kernels_numpy`` the NumPy one (skipped if NumPy isn't
+installed). Both include the time it takes to read the two columns from the database.
+
+Usage: python benchmarks/in_process.py [--rows N] [--categories N] [--batch-size N] [--repeat N] [--db PATH]
+"""
+import optparse
+import os
+import sys
+import tempfile
+import timeit
+
+import simplejson
+import sqlalchemy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from zosimus.chartchemy import kernels, queries  # noqa
+from query_paths import make_fixture  # noqa
+
+
+def best_of(func, repeat):
+    return min(timeit.repeat(func, number=1, repeat=repeat))
+
+
+def run(path, n_rows, n_categories, batch_size, repeat):
+    engine, orders, n_rows = make_fixture(path, n_rows, n_categories)
+    x_column, y_column = orders.c.region, orders.c.revenue
+
+    def sql():
+        return queries.fetch_aggregate(engine, x_column, sqlalchemy.func.sum(y_column))
+
+    def in_process():
+        result = engine.execution_options(stream_results=True).execute(sqlalchemy.select([x_column, y_column]))
+        return kernels.finalize(kernels.aggregate(result, batch_size), 'sum')
+
+    numpy = kernels.numpy
+    results = {'rows': n_rows, 'categories': n_categories, 'batch_size': batch_size}
+    try:
+        kernels.numpy = None
+        assert in_process() == sql()
+        benchmarks = [('sql', sql), ('kernels_python', in_process)]
+        if numpy is not None:
+            kernels.numpy = numpy
+            assert in_process() == sql()
+            benchmarks.append(('kernels_numpy', in_process))
+        for name, func in benchmarks:
+            kernels.numpy = numpy if name == 'kernels_numpy' else None
+            seconds = best_of(func, repeat)
+            results[name] = {'seconds': seconds, 'rows_per_second': int(n_rows / seconds)}
+    finally:
+        kernels.numpy = numpy
+    return results
+
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(usage=__doc__.strip().splitlines()[-1])
+    parser.add_option('--rows', type='int', default=1000000)
+    parser.add_option('--categories', type='int', default=1000)
+    parser.add_option('--batch-size', type='int', dest='batch_size', default=50000)
+    parser.add_option('--repeat', type='int', default=3)
+    parser.add_option('--db', default=os.path.join(tempfile.gettempdir(), 'chartchemy_query_paths.sqlite'),
+                      help='The SQLite fixture. Created the first time, reused afterwards.')
+    options, _args = parser.parse_args()
+    print(simplejson.dumps(run(options.db, options.rows, options.categories, options.batch_size,
+                               options.repeat), indent=2))
@@ -0,0 +1,218 @@
+"""Times every stage of the chart pipeline on a synthetic SQLite datasource and prints the results as JSON.
+
+The stages are timed separately, each from a cold start (the caches they depend on are cleared first):
+
+* ``introspection``: ``Datasource._pickle_all()`` (reflection, measures/dimensions and, if
+  ``INTROSPECTION_PROFILE`` is on, the profiling pass).
+* ``schema_load``: a new ``Datasource`` instance reading its ``tables``, ``measures`` and ``dimensions``.
+* ``mapping``: mapping a class to every table (``Datasource.bases``).
+* ``chart_data``: ``Chart._get_column_chart_data()``, the aggregate query of a chart on the first table.
+* ``render``: ``render_highcharts_options`` of the chart data.
+* ``chart_details``: ``GET /charts/<pk>/`` (the page, without the chart data) through the Django test client.
+* ``chart_data_view``: ``GET /charts/<pk>/data/`` (the Highcharts options) through the Django test client.
+
+The fixture has ``--tables`` tables of ``--columns`` columns (an id, then alternating string dimensions and
+integer measures) and ``--rows`` rows each, with ``--categories`` distinct values per dimension. It is created
+in ``--db`` the first time and reused afterwards, unless it was created with other parameters. The Django db
+is an in-memory SQLite db.
+
+Save the output of a run with ``--output`` and compare a later run (e.g. of another commit) with it with
+``--compare``. The ratios are new time / old time, so more than 1 is a slowdown.
+
+Usage: python benchmarks/pipeline.py [--tables N] [--columns N] [--rows N] [--categories N] [--output PATH] ...
+"""
+import optparse
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+
+import simplejson
+import sqlalchemy
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.insert(0, ROOT)
+
+from django.conf import settings  # noqa
+from zosimus import settings as project_settings  # noqa
+
+# The project settings, with an in-memory Django db and cache.
+overrides = dict((name, getattr(project_settings, name)) for name in dir(project_settings) if name.isupper())
+overrides.update(DEBUG=False, TEMPLATE_DEBUG=False, ECHO=False, ALLOWED_HOSTS=['testserver'],
+                 SECRET_KEY='benchmark-secret-key-of-32-bytes-00', INTROSPECTION_ASYNC=False,
+                 SLOW_CHART_THRESHOLD=0,
+                 DATABASES={'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:'}},
+                 CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+settings.configure(**overrides)
+
+from django.contrib.auth.models import User  # noqa
+from django.core.cache import cache  # noqa
+from django.core.management import call_command  # noqa
+from django.test.client import Client  # noqa
+from django.utils import timezone  # noqa
+
+from zosimus.chartchemy import introspection, mappers  # noqa
+from zosimus.chartchemy.models import Chart, Datasource  # noqa
+from zosimus.chartchemy.utils import render_highcharts_options  # noqa
+
+
+def make_fixture(path, n_tables, n_columns, n_rows, n_categories):
+    """Creates the SQLite db at ``path``, unless it exists and was made with the same parameters. Returns the
+    engine.
+    """
+    # A digest of the parameters is kept in the user_version of the db (0 in a new db), not in a table that
+    # the introspection would see.
+    version = zlib.crc32(repr((n_tables, n_columns, n_rows, n_categories))) & 0x7fffffff or 1
+    engine = sqlalchemy.create_engine('sqlite:///%s' % path)
+    if engine.scalar('PRAGMA user_version') == version:
+        return engine
+    engine.dispose()
+    os.remove(path)
+    engine = sqlalchemy.create_engine('sqlite:///%s' % path)
+    metadata = sqlalchemy.MetaData()
+    for t in range(n_tables):
+        columns = [sqlalchemy.Column('id', sqlalchemy.Integer, primary_key=True)]
+        for c in range(1, n_columns):
+            if c % 2:
+                columns.append(sqlalchemy.Column('dimension_%d' % c, sqlalchemy.String(20)))
+            else:
+                columns.append(sqlalchemy.Column('measure_%d' % c, sqlalchemy.Integer))
+        sqlalchemy.Table('table_%d' % t, metadata, *columns)
+    metadata.create_all(engine)
+    rnd = random.Random(42)
+    for table in metadata.sorted_tables:
+        names = [column.name for column in table.columns if column.name != 'id']
+        for start in range(0, n_rows, 10000):
+            engine.execute(table.insert(), [
+                dict((name, 'category_%d' % rnd.randrange(n_categories) if name.startswith('dimension')
+                      else rnd.randrange(1000)) for name in names)
+                for _ in range(start, min(start + 10000, n_rows))])
+    # Last, so that an interrupted run leaves a db that is rebuilt the next time.
+    engine.execute('PRAGMA user_version = %d' % version)
+    return engine
+
+
+def measure(func, repeat, setup=None):
+    """Runs ``setup()`` (untimed) and ``func()`` ``repeat`` times. Returns the best and the mean time."""
+    times = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        started = time.time()
+        func()
+        times.append(time.time() - started)
+    return {'best': min(times), 'mean': sum(times) / len(times)}
+
+
+def clear_caches():
+    cache.clear()
+    mappers.cache.clear()
+    mappers.tables.clear()
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(path, n_tables, n_columns, n_rows, n_categories, repeat):
+    engine = make_fixture(path, n_tables, n_columns, n_rows, n_categories)
+    Datasource.engine = property(lambda ds: engine)
+    call_command('syncdb', interactive=False, verbosity=0)
+    user = User.objects.create_user('benchmark', 'benchmark@example.com', 'secret')
+    # bulk_create() doesn't send the signals that introspect the db.
+    Datasource.objects.bulk_create([Datasource(user=user, name='fixture', dbtype='MYSQL', dbname=path,
+                                               dbusername='', dbpassword='', dbhost='localhost',
+                                               introspection_status=introspection.DONE,
+                                               time_introspected=timezone.now())])
+    datasource = Datasource.objects.get(name='fixture')
+    table_names = ['table_%d' % t for t in range(n_tables)]
+
+    def reset_introspection():
+        clear_caches()
+        datasource.datasourcetable_set.all().delete()
+
+    results = {'introspection': measure(datasource._pickle_all, repeat, reset_introspection)}
+
+    def schema_load():
+        ds = Datasource.objects.get(pk=datasource.pk)
+        for table_name in table_names:
+            ds.tables[table_name]
+        ds.measures, ds.dimensions
+    results['schema_load'] = measure(schema_load, repeat, clear_caches)
+
+    def mapping():
+        ds = Datasource.objects.get(pk=datasource.pk)
+        for table_name in table_names:
+            ds.bases[table_name]
+    results['mapping'] = measure(mapping, repeat, clear_caches)
+
+    chart = Chart.objects.create(user=user, name='Benchmark', datasource=datasource, table_name='table_0',
+                                 x_axis='dimension_1', y_axis='measure_2', aggr_func_name='sum',
+                                 category_limit=0)
+    results['chart_data'] = measure(lambda: Chart.objects.get(pk=chart.pk)._get_column_chart_data(), repeat,
+                                    clear_caches)
+
+    categories, series = zip(*chart._get_column_chart_data())
+    results['render'] = measure(lambda: render_highcharts_options('chartchemy_chart', categories, series,
+                                                                  'Benchmark', 'dimension_1', 'measure_2',
+                                                                  'sum(measure_2)'), repeat)
+
+    client = Client()
+    client.login(username='benchmark', password='secret')
+
+    def chart_details():
+        response = client.get('/charts/%d/' % chart.pk)
+        assert response.status_code == 200, response.status_code
+    results['chart_details'] = measure(chart_details, repeat, clear_caches)
+
+    def chart_data_view():
+        response = client.get('/charts/%d/data/' % chart.pk)
+        assert response.status_code == 200, response.status_code
+    results['chart_data_view'] = measure(chart_data_view, repeat, clear_caches)
+
+    return {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'sqlalchemy': sqlalchemy.__version__,
+        'fixture': {'tables': n_tables, 'columns': n_columns, 'rows': n_rows, 'categories': n_categories},
+        'repeat': repeat,
+        'stages': results,
+    }
+
+
+def compare(results, baseline):
+    """Returns the ratio of the best times of every stage of ``results`` to the ones of ``baseline``."""
+    return dict((name, round(stage['best'] / baseline['stages'][name]['best'], 3))
+                for name, stage in results['stages'].items()
+                if name in baseline['stages'] and baseline['stages'][name]['best'])
+
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(usage=__doc__.strip().splitlines()[-1])
+    parser.add_option('--tables', type='int', default=20)
+    parser.add_option('--columns', type='int', default=10)
+    parser.add_option('--rows', type='int', default=20000)
+    parser.add_option('--categories', type='int', default=100)
+    parser.add_option('--repeat', type='int', default=5)
+    parser.add_option('--db', default=os.path.join(tempfile.gettempdir(), 'chartchemy_pipeline.sqlite'),
+                      help='The SQLite fixture. Created the first time, reused afterwards.')
+    parser.add_option('--output', help='Also write the results to this file.')
+    parser.add_option('--compare', help='Results of an earlier run to compare with.')
+    options, _args = parser.parse_args()
+    results = run(options.db, options.tables, options.columns, options.rows, options.categories, options.repeat)
+    if options.compare:
+        with open(options.compare) as f:
+            baseline = simplejson.load(f)
+        results['compared_to'] = {'commit': baseline.get('commit'), 'ratios': compare(results, baseline)}
+    output = simplejson.dumps(results, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(output)
+    print(output)
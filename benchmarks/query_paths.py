@@ -0,0 +1,87 @@
+"""Compares the rows/sec of chart queries built with the ORM (``session.query`` on a mapped class) and with
+SQLAlchemy Core (``chartchemy.queries``) on a local SQLite fixture.
+
+Two queries are timed: the aggregate query of a column chart (``SELECT x, sum(y) ... GROUP BY x``, where the
+database does most of the work) and a scan of the x and y columns of every row (where the row processing
+of the ORM shows). Rows/sec is the number of rows of the table divided by the time of the query.
+
+Usage: python benchmarks/query_paths.py [--rows N] [--categories N] [--repeat N] [--db PATH]
+"""
+import optparse
+import os
+import random
+import sys
+import tempfile
+import timeit
+
+import simplejson
+import sqlalchemy
+from sqlalchemy import orm
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from zosimus.chartchemy import queries  # noqa
+
+
+def make_fixture(path, n_rows, n_categories):
+    """Creates (unless it exists) the SQLite db at ``path`` with an ``orders`` table of ``n_rows`` rows."""
+    engine = sqlalchemy.create_engine('sqlite:///%s' % path)
+    metadata = sqlalchemy.MetaData()
+    orders = sqlalchemy.Table('orders', metadata,
+                              sqlalchemy.Column('id', sqlalchemy.Integer, primary_key=True),
+                              sqlalchemy.Column('region', sqlalchemy.String(20)),
+                              sqlalchemy.Column('revenue', sqlalchemy.Integer))
+    if not engine.dialect.has_table(engine, 'orders'):
+        metadata.create_all(engine)
+        rnd = random.Random(42)
+        batch = 50000
+        for start in range(0, n_rows, batch):
+            engine.execute(orders.insert(), [{'region': 'region_%d' % rnd.randrange(n_categories),
+                                              'revenue': rnd.randrange(1000)}
+                                             for _ in range(start, min(start + batch, n_rows))])
+    n_rows = engine.execute(sqlalchemy.select([sqlalchemy.func.count()]).select_from(orders)).scalar()
+    return engine, orders, n_rows
+
+
+def best_of(func, repeat):
+    return min(timeit.repeat(func, number=1, repeat=repeat))
+
+
+def run(path, n_rows, n_categories, repeat):
+    engine, orders, n_rows = make_fixture(path, n_rows, n_categories)
+    klass = type('BaseOrders', (object, ), {})
+    orm.mapper(klass, orders)
+    session = orm.sessionmaker(bind=engine)()
+
+    def orm_aggregate():
+        return session.query(klass.region, sqlalchemy.func.sum(klass.revenue))\
+                      .group_by(klass.region).order_by(klass.region).all()
+
+    def core_aggregate():
+        x_column, y_aggr = queries.aggregate_columns(orders, 'region', 'revenue', 'sum')
+        return queries.fetch_aggregate(engine, x_column, y_aggr)
+
+    def orm_scan():
+        return session.query(klass.region, klass.revenue).all()
+
+    def core_scan():
+        return engine.execute(sqlalchemy.select([orders.c.region, orders.c.revenue])).fetchall()
+
+    assert [tuple(row) for row in orm_aggregate()] == core_aggregate()
+    results = {'rows': n_rows, 'categories': n_categories}
+    for name, func in (('orm_aggregate', orm_aggregate), ('core_aggregate', core_aggregate),
+                       ('orm_scan', orm_scan), ('core_scan', core_scan)):
+        seconds = best_of(func, repeat)
+        results[name] = {'seconds': seconds, 'rows_per_second': int(n_rows / seconds)}
+    return results
+
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(usage=__doc__.strip().splitlines()[-1])
+    parser.add_option('--rows', type='int', default=1000000)
+    parser.add_option('--categories', type='int', default=1000)
+    parser.add_option('--repeat', type='int', default=3)
+    parser.add_option('--db', default=os.path.join(tempfile.gettempdir(), 'chartchemy_query_paths.sqlite'),
+                      help='The SQLite fixture. Created the first time, reused afterwards.')
+    options, _args = parser.parse_args()
+    print(simplejson.dumps(run(options.db, options.rows, options.categories, options.repeat), indent=2))
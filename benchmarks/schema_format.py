@@ -0,0 +1,71 @@
+"""Compares the size and the load time of the pickled structure of tables with the JSON format of
+``chartchemy.schema``.
+
+Usage: python benchmarks/schema_format.py [--tables N] [--columns N] [--repeat N]
+"""
+import base64
+import cPickle as pickle
+import optparse
+import os
+import sys
+import timeit
+
+import simplejson
+import sqlalchemy
+from sqlalchemy.dialects import mysql
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from zosimus.chartchemy import schema  # noqa
+
+COLUMN_TYPES = [lambda: mysql.INTEGER(display_width=11), lambda: mysql.VARCHAR(length=255),
+                lambda: mysql.DECIMAL(precision=12, scale=2), lambda: mysql.DATETIME(),
+                lambda: mysql.DOUBLE(), lambda: mysql.TEXT()]
+
+
+def make_tables(n_tables, n_columns):
+    metadata = sqlalchemy.MetaData()
+    for t in range(n_tables):
+        columns = [sqlalchemy.Column('id', mysql.INTEGER(display_width=11), primary_key=True)]
+        columns += [sqlalchemy.Column('column_%d' % c, COLUMN_TYPES[c % len(COLUMN_TYPES)]())
+                    for c in range(n_columns - 1)]
+        sqlalchemy.Table('table_%d' % t, metadata, *columns)
+    return dict(metadata.tables.items())
+
+
+def best_of(func, repeat):
+    return min(timeit.repeat(func, number=1, repeat=repeat))
+
+
+def run(n_tables, n_columns, repeat):
+    tables = make_tables(n_tables, n_columns)
+    # The old format: one base64 encoded pickle of all the tables.
+    pickled = base64.b64encode(pickle.dumps(tables))
+    # The new format: one JSON document per table.
+    documents = dict((name, schema.dumps(table)) for name, table in tables.items())
+    one = sorted(documents)[0]
+    return {
+        'tables': n_tables,
+        'columns': n_columns,
+        'pickle': {
+            'bytes': len(pickled),
+            'load_all_seconds': best_of(lambda: pickle.loads(base64.b64decode(pickled)), repeat),
+            # A single table can't be read without unpickling all of them.
+            'load_one_seconds': best_of(lambda: pickle.loads(base64.b64decode(pickled))[one], repeat),
+        },
+        'json': {
+            'bytes': sum(len(d) for d in documents.values()),
+            'load_all_seconds': best_of(lambda: [schema.loads(d) for d in documents.values()], repeat),
+            'load_one_seconds': best_of(lambda: schema.loads(documents[one]), repeat),
+            'load_one_columns_seconds': best_of(lambda: schema.load_columns(documents[one]), repeat),
+        },
+    }
+
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(usage=__doc__.strip().splitlines()[-1])
+    parser.add_option('--tables', type='int', default=200)
+    parser.add_option('--columns', type='int', default=20)
+    parser.add_option('--repeat', type='int', default=5)
+    options, _args = parser.parse_args()
+    print(simplejson.dumps(run(options.tables, options.columns, options.repeat), indent=2))
@@ -0,0 +1,148 @@
+"""Time buckets for the date and time dimensions.
+
+A chart with a date or datetime x axis groups the rows by a bucket of the value (the minute, hour, day, week
+or month it falls in) rather than by the value itself, so the database returns one row per bucket, not one
+row per event. The bucket is computed by the database: ``bucket`` compiles to the date formatting functions
+of the dialect. Every bucket is labelled by its start, formatted so that the labels sort in time order::
+
+    minute  2013-05-14 09:41
+    hour    2013-05-14 09:00
+    day     2013-05-14
+    week    2013-05-13  (the Monday)
+    month   2013-05
+
+Buckets without rows are added to the chart data afterwards (see ``fill_gaps``), so that the series is dense.
+The number of buckets is bounded by ``TIME_BUCKET_MAX_BUCKETS``: ``ColumnChartAxesForm`` refuses a granularity
+too fine for the range of the dates of the column.
+"""
+import datetime
+
+import sqlalchemy
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import FunctionElement
+
+MINUTE, HOUR, DAY, WEEK, MONTH = 'minute', 'hour', 'day', 'week', 'month'
+BUCKET_CHOICES = ((MINUTE, 'Minute'), (HOUR, 'Hour'), (DAY, 'Day'), (WEEK, 'Week'), (MONTH, 'Month'))
+
+# strftime() formats of the labels. Weeks are labelled by their Monday.
+_FORMATS = {MINUTE: '%Y-%m-%d %H:%M', HOUR: '%Y-%m-%d %H:00', DAY: '%Y-%m-%d', WEEK: '%Y-%m-%d',
+            MONTH: '%Y-%m'}
+_MYSQL_FORMATS = {MINUTE: '%Y-%m-%d %H:%i', HOUR: '%Y-%m-%d %H:00', DAY: '%Y-%m-%d', WEEK: '%Y-%m-%d',
+                  MONTH: '%Y-%m'}
+_POSTGRESQL_FORMATS = {MINUTE: 'YYYY-MM-DD HH24:MI', HOUR: 'YYYY-MM-DD HH24:00', DAY: 'YYYY-MM-DD',
+                       WEEK: 'YYYY-MM-DD', MONTH: 'YYYY-MM'}
+_STEPS = {MINUTE: datetime.timedelta(minutes=1), HOUR: datetime.timedelta(hours=1),
+          DAY: datetime.timedelta(days=1), WEEK: datetime.timedelta(days=7)}
+
+
+def is_temporal(column):
+    """Returns True if ``column`` holds dates or datetimes, i.e. can be bucketed."""
+    return isinstance(column.type, (sqlalchemy.types.Date, sqlalchemy.types.DateTime))
+
+
+class bucket(FunctionElement):
+    """The label of the ``granularity`` bucket of the values of a date or datetime column."""
+    type = sqlalchemy.String()
+    name = 'bucket'
+
+    def __init__(self, column, granularity):
+        if granularity not in _FORMATS:
+            raise ValueError('Unknown time bucket: %r' % granularity)
+        self.granularity = granularity
+        super(bucket, self).__init__(column)
+
+
+def _literal(text):
+    # A literal rather than a bound parameter, so that the expression in the GROUP BY is the same as the one
+    # in the SELECT (MySQL's ONLY_FULL_GROUP_BY compares them).
+    return sqlalchemy.literal_column("'%s'" % text)
+
+
+@compiles(bucket)
+def _compile_sqlite(element, compiler, **kw):
+    column = list(element.clauses)[0]
+    if element.granularity == WEEK:
+        # 'weekday 0' moves to the next Sunday (unless it is one), 6 days back is the Monday.
+        expression = sqlalchemy.func.strftime(_literal('%Y-%m-%d'), column, _literal('weekday 0'),
+                                              _literal('-6 days'))
+    else:
+        expression = sqlalchemy.func.strftime(_literal(_FORMATS[element.granularity]), column)
+    return compiler.process(expression, **kw)
+
+
+@compiles(bucket, 'mysql')
+def _compile_mysql(element, compiler, **kw):
+    column = list(element.clauses)[0]
+    if element.granularity == WEEK:
+        column = sqlalchemy.func.subdate(column, sqlalchemy.func.weekday(column))
+    expression = sqlalchemy.func.date_format(column, _literal(_MYSQL_FORMATS[element.granularity]))
+    return compiler.process(expression, **kw)
+
+
+@compiles(bucket, 'postgresql')
+def _compile_postgresql(element, compiler, **kw):
+    column = list(element.clauses)[0]
+    if element.granularity == WEEK:
+        column = sqlalchemy.func.date_trunc(_literal('week'), column)
+    expression = sqlalchemy.func.to_char(column, _literal(_POSTGRESQL_FORMATS[element.granularity]))
+    return compiler.process(expression, **kw)
+
+
+def label(value, granularity):
+    """Returns the label of the ``granularity`` bucket of the date or datetime ``value``, like ``bucket``
+    does in the database. None stays None.
+    """
+    if value is None:
+        return None
+    if granularity == WEEK:
+        value -= datetime.timedelta(days=value.weekday())
+    return value.strftime(_FORMATS[granularity])
+
+
+def _next(start, granularity):
+    if granularity == MONTH:
+        return start.replace(year=start.year + start.month // 12, month=start.month % 12 + 1)
+    return start + _STEPS[granularity]
+
+
+def _count(first, last, granularity):
+    """Returns the number of buckets from the ``first`` to the ``last`` one, both included."""
+    if granularity == MONTH:
+        return (last.year - first.year) * 12 + last.month - first.month + 1
+    return int((last - first).total_seconds() // _STEPS[granularity].total_seconds()) + 1
+
+
+def count(first, last, granularity):
+    """Returns the number of ``granularity`` buckets from the one of the date or datetime ``first`` to the one
+    of ``last``, both included.
+    """
+    starts = [datetime.datetime.strptime(label(value, granularity), _FORMATS[granularity])
+              for value in (first, last)]
+    return _count(starts[0], starts[1], granularity)
+
+
+def fill_gaps(rows, granularity, fills, max_buckets):
+    """Returns the ``(label, value, ...)`` ``rows`` (ordered by label) with a ``(label,) + fills`` row for
+    every bucket between the first and the last one that has no row. The rows are returned as they are if
+    that would make more than ``max_buckets`` rows, or if the labels aren't what ``bucket`` returns.
+    """
+    labelled = [row for row in rows if row[0] is not None]
+    if len(labelled) < 2:
+        return rows
+    try:
+        first = datetime.datetime.strptime(labelled[0][0], _FORMATS[granularity])
+        last = datetime.datetime.strptime(labelled[-1][0], _FORMATS[granularity])
+    except (TypeError, ValueError):
+        return rows
+    count = _count(first, last, granularity)
+    if count == len(labelled) or count > max_buckets:
+        return rows
+    existing = dict((row[0], row) for row in labelled)
+    # Rows without a date come first, like NULLs do in the ORDER BY.
+    filled = [row for row in rows if row[0] is None]
+    start = first
+    for _i in range(count):
+        key = start.strftime(_FORMATS[granularity])
+        filled.append(existing.get(key) or (key,) + tuple(fills))
+        start = _next(start, granularity)
+    return filled
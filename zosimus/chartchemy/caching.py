@@ -0,0 +1,59 @@
+import hashlib
+
+from django.core.cache import cache
+
+DATA_KEY_PREFIX = 'chartchemy:data:'
+OPTIONS_KEY_PREFIX = 'chartchemy:options:'
+HITS_KEY = 'chartchemy:stats:data_hits'
+MISSES_KEY = 'chartchemy:stats:data_misses'
+# The hit/miss counters are kept for 30 days.
+STATS_TIMEOUT = 60 * 60 * 24 * 30
+
+
+def make_key(prefix, *parts):
+    """Returns a cache key made of ``prefix`` and a digest of ``parts``.
+
+    The parts (table and column names) come from the user's database, so they are hashed to keep the key
+    short and free of characters memcached doesn't allow.
+    """
+    digest = hashlib.md5()
+    for part in parts:
+        digest.update(unicode(part).encode('utf-8'))
+        digest.update('\0')
+    return prefix + digest.hexdigest()
+
+
+def data_version(rows):
+    """Returns a digest of the chart data ``rows``. Same rows, same version."""
+    return hashlib.md5(repr(rows)).hexdigest()
+
+
+def _incr(key):
+    # ``cache.incr`` raises ValueError for missing keys. ``cache.add`` is a no-op for existing ones.
+    if not cache.add(key, 1, STATS_TIMEOUT):
+        try:
+            cache.incr(key)
+        except ValueError:
+            # The key expired (or was evicted) between add() and incr().
+            cache.set(key, 1, STATS_TIMEOUT)
+
+
+def record_hit():
+    _incr(HITS_KEY)
+
+
+def record_miss():
+    _incr(MISSES_KEY)
+
+
+def stats():
+    """Returns the number of hits and misses of the chart data cache.
+
+    The counters are kept in the cache itself, so with a shared backend (e.g. memcached) they add up the
+    numbers of all the processes.
+    """
+    return {'hits': cache.get(HITS_KEY, 0), 'misses': cache.get(MISSES_KEY, 0)}
+
+
+def reset_stats():
+    cache.delete_many([HITS_KEY, MISSES_KEY])
@@ -0,0 +1,266 @@
+import logging
+import threading
+from multiprocessing.pool import ThreadPool
+
+import sqlalchemy
+from django.conf import settings
+
+from exceptions import DatasourceBusyError, QueryTimeoutError
+
+logger = logging.getLogger(__name__)
+
+# MySQL error raised when a query runs longer than ``max_execution_time``.
+ER_QUERY_TIMEOUT = 3024
+
+_pool = None
+_pool_lock = threading.Lock()
+
+_background_pool = None
+_background_keys = set()
+
+
+def get_pool():
+    """Returns the pool of threads that run the queries of the dashboards. Creates it the first time.
+
+    The pool is shared by all the requests of the process, so it also bounds the number of chart queries
+    running at the same time (``QUERY_THREADS``).
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPool(settings.QUERY_THREADS)
+    return _pool
+
+
+def submit(func, *args):
+    """Runs ``func(*args)`` on the pool. Returns an ``AsyncResult``."""
+    return get_pool().apply_async(func, args)
+
+
+def submit_background(key, func, *args):
+    """Runs ``func(*args)`` on the pool of threads that run the chart queries too expensive to run in a
+    request (``BACKGROUND_QUERY_THREADS``), unless a job with the same ``key`` is already queued or running.
+    Returns True if the job was queued.
+    """
+    global _background_pool
+    with _pool_lock:
+        if key in _background_keys:
+            return False
+        if _background_pool is None:
+            _background_pool = ThreadPool(settings.BACKGROUND_QUERY_THREADS)
+        _background_keys.add(key)
+
+    def run():
+        try:
+            func(*args)
+        finally:
+            with _pool_lock:
+                _background_keys.discard(key)
+    _background_pool.apply_async(run)
+    return True
+
+
+class _Slots(object):
+    """The queries running on a database. Like a semaphore, but the number of slots is given by every
+    ``acquire()``, so that it can change (the limit of a datasource is edited) without losing count of the
+    queries already running.
+    """
+
+    def __init__(self):
+        self.running = 0
+        self._condition = threading.Condition(threading.Lock())
+
+    def acquire(self, max_queries, blocking=False):
+        """Takes a slot if fewer than ``max_queries`` queries are running. Unless ``blocking`` is True,
+        returns False right away if there are not.
+        """
+        with self._condition:
+            while self.running >= max_queries:
+                if not blocking:
+                    return False
+                self._condition.wait()
+            self.running += 1
+            return True
+
+    def release(self):
+        with self._condition:
+            self.running -= 1
+            self._condition.notify()
+
+
+class DatasourceSemaphores(object):
+    """A process wide collection of semaphores, one per database (connection), that bounds the number of
+    queries that run against the same database at the same time.
+
+    Without it a dashboard with many charts on the same datasource would take all the threads of the pool
+    and open as many connections to the customer's database. And a customer database that has become slow
+    would tie up every worker of the web server.
+    """
+
+    def __init__(self):
+        self._semaphores = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Returns the ``_Slots`` of the database identified by ``key`` (``Datasource.connection_key``).
+
+        There is one per database, whatever the limits of the datasources on it: the queries of all of them
+        are counted together, and each query waits for fewer queries than the limit of its datasource.
+        """
+        with self._lock:
+            semaphore = self._semaphores.get(key)
+            if semaphore is None:
+                semaphore = self._semaphores[key] = _Slots()
+            return semaphore
+
+    def acquire(self, key, max_queries, blocking=False):
+        """Takes one of the ``max_queries`` slots of the database and returns the semaphore to release.
+
+        Unless ``blocking`` is True, raises ``DatasourceBusyError`` right away if all the slots are taken,
+        instead of waiting for one.
+        """
+        semaphore = self.get(key)
+        if not semaphore.acquire(max_queries, blocking):
+            raise DatasourceBusyError('Too many queries are running on this datasource. Try again in a bit.')
+        return semaphore
+
+
+semaphores = DatasourceSemaphores()
+
+
+class _Watchdog(object):
+    """Cancels the query running on ``connection`` after ``timeout`` seconds.
+
+    SQLite queries are interrupted (``sqlite3.Connection.interrupt``). MySQL queries are killed from another
+    connection (``KILL QUERY``). Other dialects can't be cancelled. The watchdog only records that the time
+    is up.
+    """
+
+    def __init__(self, connection, timeout):
+        self.fired = False
+        self._stopped = False
+        # Held while cancelling, so that stop() waits for the cancellation rather than let the connection go
+        # back to the pool (and the KILL hit whoever uses it next).
+        self._lock = threading.Lock()
+        self._cancel = _canceller(connection)
+        self._timer = threading.Timer(timeout, self._fire)
+        self._timer.daemon = True
+
+    def _fire(self):
+        with self._lock:
+            if self._stopped:
+                # The queries were done before the time was up.
+                return
+            self.fired = True
+            if self._cancel is not None:
+                try:
+                    self._cancel()
+                except Exception:
+                    logger.exception('Cancelling a query failed')
+
+    def start(self):
+        self._timer.start()
+
+    def stop(self):
+        """Stops the watchdog. Returns True if it fired before."""
+        with self._lock:
+            self._stopped = True
+        self._timer.cancel()
+        return self.fired
+
+
+def _canceller(connection):
+    """Returns a function that cancels the query running on ``connection`` (from another thread), or None.
+    """
+    dialect = connection.dialect.name
+    if dialect == 'sqlite':
+        # connection.connection is the pool's proxy, its .connection the sqlite3 connection.
+        return connection.connection.connection.interrupt
+    if dialect == 'mysql':
+        # The id of the connection on the server, as known to the driver (MySQLdb and PyMySQL).
+        thread_id = connection.connection.connection.thread_id()
+        engine = connection.engine
+
+        def kill():
+            # The connection is busy running the query. KILL QUERY has to come from another one, opened
+            # outside the pool: the pool may well be exhausted when queries time out.
+            cargs, cparams = engine.dialect.create_connect_args(engine.url)
+            killer = engine.dialect.connect(*cargs, **cparams)
+            try:
+                killer.cursor().execute('KILL QUERY %d' % thread_id)
+            finally:
+                killer.close()
+        return kill
+    return None
+
+
+def _is_server_timeout(error):
+    args = getattr(error.orig, 'args', None) or (None, )
+    return args[0] == ER_QUERY_TIMEOUT
+
+
+class QueryGuard(object):
+    """Runs the queries of a chart within the limits of its datasource::
+
+        with QueryGuard(engine, key, timeout, max_queries) as connection:
+            connection.execute(...)
+
+    Entering the guard takes one of the ``max_queries`` slots of the datasource (see
+    ``DatasourceSemaphores.acquire``) and checks out a connection. If the queries run for more than
+    ``timeout`` seconds (0 or None means no limit), the running query is cancelled on the server where the
+    dialect allows it (see ``_Watchdog``) and ``QueryTimeoutError`` is raised. MySQL also enforces the limit
+    on the server with ``max_execution_time``, in case the web process goes away.
+    """
+
+    def __init__(self, engine, key, timeout, max_queries, blocking=False):
+        self.engine = engine
+        self.key = key
+        self.timeout = timeout
+        self.max_queries = max_queries
+        self.blocking = blocking
+        self._semaphore = self._connection = self._watchdog = None
+
+    def __enter__(self):
+        self._semaphore = semaphores.acquire(self.key, self.max_queries, self.blocking)
+        try:
+            self._connection = self.engine.connect()
+            if self.timeout:
+                self._set_server_timeout(int(self.timeout * 1000))
+                self._watchdog = _Watchdog(self._connection, self.timeout)
+                self._watchdog.start()
+        except Exception:
+            self.close()
+            raise
+        return self._connection
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # Stopped before the connection is given back. It can't fire afterwards.
+        timed_out = self._watchdog is not None and self._watchdog.stop()
+        self.close()
+        if isinstance(exc_value, sqlalchemy.exc.DBAPIError) and _is_server_timeout(exc_value):
+            timed_out = True
+        if timed_out:
+            raise QueryTimeoutError('The query took longer than %s seconds and was cancelled.' % self.timeout)
+
+    def _set_server_timeout(self, milliseconds):
+        if self._connection.dialect.name != 'mysql':
+            return
+        try:
+            self._connection.execute(sqlalchemy.text('SET SESSION max_execution_time = %d' % milliseconds))
+        except sqlalchemy.exc.DBAPIError:
+            # Before MySQL 5.7.8 (and MariaDB) there is no max_execution_time. The watchdog still works.
+            pass
+
+    def close(self):
+        """Stops the watchdog, returns the connection to the pool and frees the slot of the datasource."""
+        if self._watchdog is not None:
+            self._watchdog.stop()
+            self._watchdog = None
+        if self._connection is not None:
+            if self.timeout:
+                self._set_server_timeout(0)
+            self._connection.close()
+            self._connection = None
+        if self._semaphore is not None:
+            self._semaphore.release()
+            self._semaphore = None
@@ -0,0 +1,77 @@
+"""Pre-flight cost estimates of the chart queries.
+
+Before a chart runs its aggregate query on a datasource with a row budget (``Datasource.query_row_budget``),
+the query is ``EXPLAIN``ed and the number of rows the database expects to read is checked against the
+budget. Plans that read an index get ``INDEXED_BUDGET_FACTOR`` times the budget. What happens to a query
+over budget is up to the datasource (``Datasource.over_budget_action``):
+
+* ``REFUSE``: the chart fails with ``QueryOverBudgetError``.
+* ``SAMPLE``: the chart is plotted from a sample of the rows instead (see ``sampling``).
+* ``ROLLUP``: the chart is plotted from its rollup (see ``rollups``), or queued if it doesn't have one yet.
+* ``BACKGROUND``: the query runs on a background thread and its result lands in the cache. The chart fails
+  with ``ChartQueuedError`` until then.
+
+Every estimate is recorded in the ``ChartQueryEstimate`` of the chart. The ``chart_costs`` management
+command lists the most expensive charts.
+"""
+from collections import namedtuple
+from operator import mul
+
+import simplejson
+import sqlalchemy
+from django.conf import settings
+
+import sampling
+
+REFUSE, SAMPLE, ROLLUP, BACKGROUND = 'refuse', 'sample', 'rollup', 'background'
+OVER_BUDGET_ACTION_CHOICES = ((REFUSE, 'Refuse the query'), (SAMPLE, 'Plot a sample'),
+                              (ROLLUP, 'Plot the rollup'), (BACKGROUND, 'Run in the background'))
+
+# ``rows`` is the number of rows the database expects to read, ``uses_index`` whether the plan reads an
+# index and ``plan`` the plan as the database tells it (JSON).
+Estimate = namedtuple('Estimate', 'rows uses_index plan')
+
+
+def _compile(connection, statement):
+    return unicode(statement.compile(dialect=connection.dialect, compile_kwargs={'literal_binds': True}))
+
+
+def explain(connection, statement, table):
+    """Returns the ``Estimate`` of ``statement``, a query of ``table``. Where the database doesn't estimate
+    the number of rows it reads (SQLite), all the rows of the table are assumed to be read.
+    """
+    dialect = connection.dialect.name
+    sql = _compile(connection, statement)
+    rows = None
+    if dialect == 'mysql':
+        plan = [dict(row) for row in connection.execute(sqlalchemy.text('EXPLAIN ' + sql))]
+        # One row per table. The rows of joined tables multiply.
+        rows = reduce(mul, [int(step['rows'] or 1) for step in plan], 1)
+        uses_index = any(step['key'] for step in plan)
+    elif dialect == 'postgresql':
+        plan = connection.execute(sqlalchemy.text('EXPLAIN (FORMAT JSON) ' + sql)).scalar()[0]['Plan']
+        nodes, scans = [plan], []
+        while nodes:
+            node = nodes.pop()
+            nodes.extend(node.get('Plans', []))
+            if node['Node Type'].endswith('Scan'):
+                scans.append(node)
+        rows = sum(int(node['Plan Rows']) for node in scans)
+        uses_index = any('Index' in node['Node Type'] for node in scans)
+    elif dialect == 'sqlite':
+        plan = [row[-1] for row in connection.execute(sqlalchemy.text('EXPLAIN QUERY PLAN ' + sql))]
+        uses_index = any('INDEX' in step for step in plan)
+    else:
+        plan, uses_index = None, False
+    if rows is None:
+        rows = sampling.estimated_row_count(connection, table)
+    return Estimate(rows, uses_index, simplejson.dumps(plan, default=unicode))
+
+
+def is_over_budget(estimate, budget):
+    """Returns True if the query of ``estimate`` reads more rows than ``budget`` (0 means no budget)."""
+    if not budget:
+        return False
+    if estimate.uses_index:
+        budget *= settings.INDEXED_BUDGET_FACTOR
+    return estimate.rows > budget
@@ -0,0 +1,178 @@
+"""Loads the data of many charts at once.
+
+Rendering the charts of a dashboard one after the other takes as long as all their queries put together.
+Instead, the charts whose data isn't cached are grouped by datasource, table and x axis, and every group is
+answered by a single ``SELECT x, aggr_1(y_1), ..., aggr_n(y_n) ... GROUP BY x`` (see
+``queries.fetch_merged``), extra series included. The groups run concurrently on the query pool (see
+``concurrency``), at most ``Datasource.effective_max_concurrent_queries`` at a time per datasource. So a
+dashboard takes about as long as its slowest query. Unlike a single chart, a group waits for a slot of its
+datasource rather than failing. So do the cost checks (EXPLAIN, see ``costs``) of the charts of datasources
+with a row budget, which run on the pool too, before the groups.
+
+The queries are built with SQLAlchemy Core, whatever ``CHART_QUERY_MODE`` says.
+"""
+import logging
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import cache
+
+import caching
+import concurrency
+import queries
+import rollups
+
+logger = logging.getLogger(__name__)
+
+
+def _query_group(guard, x_column, members):
+    """Queries the data of the ``(chart, aggrs)`` ``members``, charts of the same table with the same x
+    axis, on the connection of the ``concurrency.QueryGuard``. Returns a list of ``(chart, rows)`` pairs
+    where ``rows`` is an exception if the query failed.
+
+    Runs on a thread of the query pool. The charts are only read from.
+    """
+    try:
+        with guard as connection:
+            return _query_members(connection, x_column, members)
+    except Exception as e:
+        # Couldn't connect, or the time was up.
+        return [(chart, e) for chart, _aggrs in members]
+
+
+def _query_members(connection, x_column, members):
+    results = []
+    rows = None
+    if len(members) > 1:
+        try:
+            rows = queries.fetch_merged(connection, x_column,
+                                        [aggr for _chart, aggrs in members for aggr in aggrs],
+                                        settings.DASHBOARD_MERGE_MAX_CATEGORIES)
+        except Exception as e:
+            return [(chart, e) for chart, _aggrs in members]
+    # Column of the merged rows where the aggregates of the next chart start.
+    start = 1
+    for chart, aggrs in members:
+        limit, other = chart.effective_category_limit, chart.OTHER_CATEGORY
+        y_aggr, extra_aggrs = aggrs[0], aggrs[1:]
+        try:
+            if rows is None:
+                # A single chart, or too many categories to pick the top ones in Python.
+                chart_rows = queries.fetch_aggregate(connection, x_column, y_aggr, limit, other, extra_aggrs)
+            else:
+                chart_rows = queries.top_categories(connection, x_column, y_aggr,
+                                                    [row[:1] + row[start:start + len(aggrs)] for row in rows],
+                                                    limit, other, extra_aggrs)
+        except Exception as e:
+            chart_rows = e
+        results.append((chart, chart_rows))
+        start += len(aggrs)
+    return results
+
+
+def _aggregate_in_process(chart):
+    """Queries the data of an ``IN_PROCESS`` chart. The table of the chart must already be loaded. Like the
+    groups, waits for a slot of the datasource.
+    """
+    try:
+        return [(chart, chart._aggregate_in_process(blocking=True))]
+    except Exception as e:
+        return [(chart, e)]
+
+
+def _estimate(chart):
+    """Returns the ``costs.Estimate`` of the query of ``chart``, or the exception if EXPLAIN failed. The table
+    of the chart must already be loaded.
+    """
+    try:
+        return chart._estimate(blocking=True)
+    except Exception as e:
+        return e
+
+
+def load_charts(charts):
+    """Loads the data of ``charts``. The data is cached and remembered by the chart instances, so
+    ``_plot_column_chart()`` doesn't query the database again.
+
+    Returns a dict of the pks of the charts whose data couldn't be loaded and the exceptions.
+    """
+    errors = {}
+    pending = []
+    live = []
+    keys = [chart.data_cache_key for chart in charts if chart.data_cache_timeout]
+    cached = cache.get_many(keys) if keys else {}
+    groups = OrderedDict()
+    for chart in charts:
+        entry = cached.get(chart.data_cache_key) if chart.data_cache_timeout else None
+        if entry is not None:
+            caching.record_hit()
+            chart._remember_data_entry(entry)
+            continue
+        if chart.data_cache_timeout:
+            caching.record_miss()
+        if chart.execution_mode == queries.ROLLUP:
+            rows = rollups.read(chart)
+            if rows is not None:
+                chart._store_column_chart_data(rows)
+                continue
+        elif chart.execution_mode == queries.IN_PROCESS:
+            # No GROUP BY on this datasource, nothing to merge.
+            try:
+                chart.datasource.tables[chart.table_name]
+            except KeyError as e:
+                errors[chart.pk] = e
+                continue
+            pending.append(concurrency.submit(_aggregate_in_process, chart))
+            continue
+        # Everything that reads the Django db (the table, the engine) is done here, not on the pool.
+        try:
+            x_column, y_aggr = chart._core_columns()
+            aggrs = [y_aggr] + chart._extra_core_aggregates()
+            guard = chart.datasource.guarded_connection(blocking=True)
+        except Exception as e:
+            errors[chart.pk] = e
+            continue
+        # The queries of the charts with a row budget are EXPLAINed first (see ``costs``), on the pool.
+        budget = chart.datasource.effective_query_row_budget
+        estimate = concurrency.submit(_estimate, chart) if budget else None
+        live.append((chart, x_column, aggrs, guard, budget, estimate))
+
+    for chart, x_column, aggrs, guard, budget, estimate in live:
+        if estimate is not None:
+            # The cost check may answer the chart some other way. It records the estimate in the Django db.
+            try:
+                estimate = estimate.get()
+                if isinstance(estimate, Exception):
+                    raise estimate
+                rows = chart._apply_estimate(estimate, budget, blocking=True)
+            except Exception as e:
+                errors[chart.pk] = e
+                continue
+            if rows is not None:
+                chart._store_column_chart_data(rows)
+                continue
+        # The Table objects are shared by the datasources with the same table (see ``mappers.tables``).
+        key = (chart.datasource.connection_key, id(chart.datasource.tables[chart.table_name]), chart.x_axis,
+               chart.x_bucket)
+        groups.setdefault(key, (guard, x_column, []))[2].append((chart, aggrs))
+
+    # Submit the groups of different datasources in turn, so that a datasource with many groups doesn't take
+    # all the threads of the pool while the others wait.
+    by_datasource = OrderedDict()
+    for key, group in groups.items():
+        by_datasource.setdefault(key[0], []).append(group)
+    while by_datasource:
+        for connection_key in list(by_datasource):
+            group = by_datasource[connection_key].pop(0)
+            pending.append(concurrency.submit(_query_group, *group))
+            if not by_datasource[connection_key]:
+                del by_datasource[connection_key]
+
+    for result in pending:
+        for chart, rows in result.get():
+            if isinstance(rows, Exception):
+                logger.warning('Query of chart %s failed: %s', chart.pk, rows)
+                errors[chart.pk] = rows
+            else:
+                chart._store_column_chart_data(rows)
+    return errors
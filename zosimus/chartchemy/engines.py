@@ -0,0 +1,102 @@
+import threading
+from collections import OrderedDict
+
+import sqlalchemy
+from django.conf import settings
+
+
+class EngineRegistry(object):
+    """A process wide collection of SQLAlchemy engines keyed by the connection parameters of a datasource.
+
+    Creating an engine (and hence a connection pool) is cheap, but the connections it hands out are not.
+    Before the registry existed, every ``Datasource`` instance created its own engine, so every request
+    that loaded a datasource opened brand new connections to the customer's database. Now all the
+    datasource instances that share the same ``(dbtype, host, dbname, user, password)`` share one pooled
+    engine.
+
+    The registry holds at most ``max_engines`` engines. When it is full, the least recently used engine
+    that has no connections checked out is disposed (i.e. its pooled connections are closed) to make room.
+    """
+
+    def __init__(self, max_engines):
+        self.max_engines = max_engines
+        self._engines = OrderedDict()
+        self._lock = threading.RLock()
+
+    def get(self, key, url, **engine_kwargs):
+        """Returns the engine for ``key``. Creates one from ``url`` and ``engine_kwargs`` if there isn't one.
+        """
+        with self._lock:
+            engine = self._engines.pop(key, None)
+            if engine is None:
+                engine = sqlalchemy.create_engine(url, **engine_kwargs)
+            # (Re-)insert the engine so that it becomes the most recently used.
+            self._engines[key] = engine
+            self._evict(key)
+            return engine
+
+    def invalidate(self, key):
+        """Removes the engine for ``key`` (if any) from the registry and closes its pooled connections.
+
+        Connections that are checked out at the moment are closed when they are returned to the pool.
+        """
+        with self._lock:
+            engine = self._engines.pop(key, None)
+        if engine is not None:
+            engine.dispose()
+
+    def clear(self):
+        """Disposes all the engines in the registry."""
+        with self._lock:
+            engines, self._engines = self._engines.values(), OrderedDict()
+        for engine in engines:
+            engine.dispose()
+
+    def _evict(self, current):
+        # Oldest engines come first in the OrderedDict. Engines with connections checked out are busy
+        # serving a request and are never evicted, nor is the engine being returned (``current``, the newest).
+        # If all of them are busy, the registry is allowed to grow beyond ``max_engines`` until they become
+        # idle.
+        surplus = len(self._engines) - self.max_engines
+        for key in list(self._engines.keys()):
+            if surplus <= 0:
+                break
+            engine = self._engines[key]
+            if key == current:
+                continue
+            if _checked_out(engine):
+                continue
+            del self._engines[key]
+            engine.dispose()
+            surplus -= 1
+
+    def __contains__(self, key):
+        return key in self._engines
+
+    def __len__(self):
+        return len(self._engines)
+
+
+def _checked_out(engine):
+    """Returns the number of connections checked out of the engine's pool. Pools that don't keep count
+    (e.g. ``NullPool``) never hold on to connections and report 0.
+    """
+    try:
+        return engine.pool.checkedout()
+    except AttributeError:
+        return 0
+
+
+def engine_options():
+    """Returns the keyword arguments for ``sqlalchemy.create_engine``. See the ``ENGINE_*`` settings.
+    """
+    return {
+        'echo': settings.ECHO,
+        'pool_size': settings.ENGINE_POOL_SIZE,
+        'max_overflow': settings.ENGINE_MAX_OVERFLOW,
+        'pool_recycle': settings.ENGINE_POOL_RECYCLE,
+        'pool_pre_ping': settings.ENGINE_POOL_PRE_PING,
+    }
+
+
+registry = EngineRegistry(settings.ENGINE_REGISTRY_SIZE)
@@ -4,3 +4,19 @@ class UnsupportedDatabaseError(Exception):
 
 class ChartCreationError(Exception):
     pass
+
+
+class QueryTimeoutError(ChartCreationError):
+    pass
+
+
+class DatasourceBusyError(ChartCreationError):
+    pass
+
+
+class QueryOverBudgetError(ChartCreationError):
+    pass
+
+
+class ChartQueuedError(ChartCreationError):
+    pass
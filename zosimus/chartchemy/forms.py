@@ -1,6 +1,13 @@
+import simplejson
+import sqlalchemy
 from django import forms
+from django.conf import settings
 from django.forms import ModelForm, widgets
 
+import buckets
+import profiling
+import queries
+from exceptions import ChartCreationError
 from models import Datasource, Chart
 
 
@@ -8,13 +15,18 @@ class DatasourceForm(ModelForm):
     """Form to add a new datasource."""
     class Meta:
         model = Datasource
-        fields = ('name', 'dbtype', 'dbname', 'dbusername', 'dbpassword', 'dbhost')
+        fields = ('name', 'dbtype', 'dbname', 'dbusername', 'dbpassword', 'dbhost', 'query_timeout',
+                  'max_concurrent_queries', 'query_row_budget', 'over_budget_action')
         widgets = {
             'name': widgets.TextInput(attrs={'class': 'span2'}),
             'dbtype': widgets.Select(attrs={'class': 'span2'}),
             'dbname': widgets.TextInput(attrs={'class': 'span2'}),
             'dbusername': widgets.TextInput(attrs={'class': 'span1'}),
             'dbpassword': widgets.PasswordInput(attrs={'class': 'span1'}),
+            'query_timeout': widgets.TextInput(attrs={'class': 'span1'}),
+            'max_concurrent_queries': widgets.TextInput(attrs={'class': 'span1'}),
+            'query_row_budget': widgets.TextInput(attrs={'class': 'span1'}),
+            'over_budget_action': widgets.Select(attrs={'class': 'span2'}),
         }
 
 
@@ -30,13 +42,27 @@ class CreateChartForm(ModelForm):
         fields = ('name', 'datasource')
 
 
-class ChartTableForm(ModelForm):
+class ChartDataFormMixin(object):
+    """Mixin for chart forms that change what a chart plots. Saving the form invalidates the cached data
+    of the chart as it was before the form changed it.
+    """
+    def __init__(self, *args, **kwargs):
+        super(ChartDataFormMixin, self).__init__(*args, **kwargs)
+        # The instance is updated in place during validation. Remember the key before that happens.
+        self._original_data_cache_key = self.instance.data_cache_key
+
+    def save(self, *args, **kwargs):
+        self.instance.invalidate_data_cache(self._original_data_cache_key)
+        return super(ChartDataFormMixin, self).save(*args, **kwargs)
+
+
+class ChartTableForm(ChartDataFormMixin, ModelForm):
     """Form to set the table for a chart."""
     table_name = forms.ChoiceField()
 
     def __init__(self, *args, **kwargs):
         super(ChartTableForm, self).__init__(*args, **kwargs)
-        table_names = [n for n, _t in self.instance.datasource.tables.items()]
+        table_names = self.instance.datasource.table_names
         self.fields['table_name'].choices = list(zip(table_names, table_names))
 
     class Meta:
@@ -44,20 +70,98 @@ class ChartTableForm(ModelForm):
         fields = ('table_name', )
 
 
-class ColumnChartAxesForm(ModelForm):
-    """Form to set the x and y axes and the aggregation function for y-axis for a chart."""
+class ColumnChartAxesForm(ChartDataFormMixin, ModelForm):
+    """Form to set the x and y axes and the aggregation function for y-axis for a chart, and the extra series
+    (other aggregates of the measures of the table) to plot next to it. A date or datetime x axis needs the
+    granularity of its time buckets.
+    """
     CHOICES = (('avg', 'Avg'), ('count', 'Count'), ('max', 'Max'), ('min', 'min'), ('sum', 'Sum'),)
     x_axis = forms.ChoiceField()
     y_axis = forms.ChoiceField()
     aggr_func_name = forms.ChoiceField(choices=CHOICES)
+    # Values are 'aggr_func_name:y_axis'. Stored as the JSON list of the [y_axis, aggr_func_name] pairs.
+    extra_series = forms.MultipleChoiceField(required=False)
+
+    rollup_key_column = forms.ChoiceField(required=False)
 
     def __init__(self, *args, **kwargs):
         super(ColumnChartAxesForm, self).__init__(*args, **kwargs)
         measures = self.instance.datasource.measures.get(self.instance.table_name, [])
         dimensions = self.instance.datasource.dimensions.get(self.instance.table_name, [])
-        self.fields['x_axis'].choices = list(zip(dimensions, dimensions))
+        # Tell the cheap x axes from the expensive ones, if the table was profiled.
+        profile = self.instance.datasource.profiles.get(self.instance.table_name)
+        self.fields['x_axis'].choices = [(name, '%s (%s)' % (name, profiling.describe_column(profile, name))
+                                          if profile else name) for name in dimensions]
         self.fields['y_axis'].choices = list(zip(measures, measures))
+        self.fields['extra_series'].choices = [('%s:%s' % (aggr_func_name, name),
+                                                '%s(%s)' % (aggr_func_name, name))
+                                               for name in measures
+                                               for aggr_func_name, _label in self.CHOICES]
+        if self.instance.extra_series:
+            self.initial['extra_series'] = ['%s:%s' % (aggr_func_name, y_axis) for y_axis, aggr_func_name
+                                            in simplejson.loads(self.instance.extra_series)]
+        try:
+            table_columns = self.instance.datasource.tables[self.instance.table_name].columns
+        except KeyError:
+            table_columns = {}
+        self._temporal = set(name for name in dimensions
+                             if name in table_columns and buckets.is_temporal(table_columns[name]))
+        self._table_columns = table_columns
+        columns = table_columns.keys()
+        self.fields['rollup_key_column'].choices = [('', '---------')] + list(zip(columns, columns))
+
+    def clean_rollup_key_column(self):
+        return self.cleaned_data['rollup_key_column'] or None
+
+    def clean_extra_series(self):
+        pairs = [value.split(':', 1)[::-1] for value in self.cleaned_data['extra_series']]
+        return simplejson.dumps(pairs) if pairs else None
+
+    def clean_x_bucket(self):
+        return self.cleaned_data['x_bucket'] or None
+
+    def clean(self):
+        cleaned_data = super(ColumnChartAxesForm, self).clean()
+        if cleaned_data.get('extra_series') and cleaned_data.get('execution_mode') != queries.LIVE:
+            raise forms.ValidationError('Only charts that query the datasource can have extra series.')
+        x_axis = cleaned_data.get('x_axis')
+        if x_axis in self._temporal and not cleaned_data.get('x_bucket'):
+            raise forms.ValidationError('%s is a date. Pick the time buckets to group it by.' % x_axis)
+        if x_axis and x_axis not in self._temporal and cleaned_data.get('x_bucket'):
+            raise forms.ValidationError('Only dates can be grouped by time buckets. %s is not a date.' %
+                                        x_axis)
+        if x_axis in self._temporal:
+            self._check_bucket_count(x_axis, cleaned_data['x_bucket'])
+        return cleaned_data
+
+    def _check_bucket_count(self, x_axis, granularity):
+        """Refuses a ``granularity`` that would split the dates of ``x_axis`` in more than
+        ``TIME_BUCKET_MAX_BUCKETS`` buckets. The query of the chart isn't limited otherwise.
+        """
+        column = self._table_columns[x_axis]
+        guard = self.instance.datasource.guarded_connection(True, settings.PREVIEW_QUERY_TIMEOUT)
+        try:
+            with guard as connection:
+                first, last = connection.execute(sqlalchemy.select([sqlalchemy.func.min(column),
+                                                                    sqlalchemy.func.max(column)])).first()
+        except (sqlalchemy.exc.SQLAlchemyError, ChartCreationError):
+            # The range can't be read in time. Let the user try.
+            return
+        if first is None or buckets.count(first, last, granularity) <= settings.TIME_BUCKET_MAX_BUCKETS:
+            return
+        raise forms.ValidationError('%s spans more than %d %s buckets (%s to %s). Pick a coarser '
+                                    'granularity.' % (x_axis, settings.TIME_BUCKET_MAX_BUCKETS, granularity,
+                                                      first, last))
+
+    @property
+    def warnings(self):
+        """Returns the list of reasons why the chart of the (valid) form is expensive to plot. See
+        ``profiling.axis_warnings``.
+        """
+        profile = self.instance.datasource.profiles.get(self.instance.table_name)
+        return profiling.axis_warnings(profile, self.cleaned_data.get('x_axis'))
 
     class Meta:
         model = Chart
-        fields = ('x_axis', 'y_axis', 'aggr_func_name')
+        fields = ('x_axis', 'x_bucket', 'y_axis', 'aggr_func_name', 'extra_series', 'category_limit',
+                  'cache_timeout', 'execution_mode', 'rollup_key_column')
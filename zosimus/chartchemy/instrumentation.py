@@ -0,0 +1,167 @@
+"""Timings of the stages of a request: loading the schema, mapping classes, running the queries and rendering
+the chart options.
+
+``ServerTimingMiddleware`` (see ``middleware``) starts a ``Timings`` for every request. The code of the
+stages reports to it with ``stage()``, and SQLAlchemy reports every query (time and rows) through the cursor
+events listened to below. The timings end up in the ``Server-Timing`` header of the response, in the slow
+chart log (``zosimus.chartchemy.slow``) if the request took longer than ``SLOW_CHART_THRESHOLD`` and in the
+process wide ``metrics`` (p50/p95 per chart and per datasource), served by the ``metrics`` view.
+
+Only the thread that handles the request is timed. The queries of a dashboard run on the query pool (see
+``concurrency``) and show up as the time the request waited for them. The time of a stage includes the
+stages nested in it (e.g. mapping a class loads the schema of its table).
+"""
+import logging
+import threading
+import time
+from collections import deque, OrderedDict
+from contextlib import contextmanager
+
+import simplejson
+from django.conf import settings
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+slow_logger = logging.getLogger('zosimus.chartchemy.slow')
+
+_local = threading.local()
+
+
+class Timings(object):
+    """The time spent in every stage of a request (seconds), the number of SQL queries and the number of rows
+    they returned (where the driver tells), and tags (e.g. the chart) that say what the request was about.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.stages = OrderedDict()
+        self.queries = 0
+        self.rows = 0
+        self.tags = {}
+
+    def add(self, name, seconds):
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    @property
+    def total(self):
+        return time.time() - self.started
+
+    def server_timing(self, total=None):
+        """Returns the value of the ``Server-Timing`` header."""
+        metrics = []
+        for name, seconds in self.stages.items():
+            metric = '%s;dur=%.1f' % (name, seconds * 1000)
+            if name == 'query':
+                metric += ';desc="%d queries, %d rows"' % (self.queries, self.rows)
+            metrics.append(metric)
+        metrics.append('total;dur=%.1f' % ((self.total if total is None else total) * 1000))
+        return ', '.join(metrics)
+
+
+def start():
+    """Starts timing the request handled by the current thread. Returns the ``Timings``."""
+    _local.timings = Timings()
+    return _local.timings
+
+
+def finish():
+    """Stops timing the request handled by the current thread. Returns its ``Timings`` (None if it wasn't
+    timed).
+    """
+    timings, _local.timings = current(), None
+    return timings
+
+
+def current():
+    """Returns the ``Timings`` of the request handled by the current thread, or None."""
+    return getattr(_local, 'timings', None)
+
+
+@contextmanager
+def stage(name):
+    """Adds the time spent in the ``with`` block to the ``name`` stage of the current request."""
+    timings = current()
+    if timings is None:
+        yield
+        return
+    started = time.time()
+    try:
+        yield
+    finally:
+        timings.add(name, time.time() - started)
+
+
+def tag(**tags):
+    """Tags the current request, e.g. ``tag(chart=1, datasource=2)``. Tagged requests are counted in the
+    ``metrics`` of the chart and of the datasource.
+    """
+    timings = current()
+    if timings is not None:
+        timings.tags.update(tags)
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+    if current() is not None:
+        context._chartchemy_started = time.time()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+    timings = current()
+    started = getattr(context, '_chartchemy_started', None)
+    if timings is None or started is None:
+        return
+    # With a server side cursor, the rows are fetched (and counted) later.
+    timings.add('query', time.time() - started)
+    timings.queries += 1
+    if cursor.rowcount > 0:
+        timings.rows += cursor.rowcount
+
+
+def percentile(values, fraction):
+    """Returns the ``fraction`` (e.g. 0.95) percentile of the sorted ``values`` (nearest rank)."""
+    index = max(int(round(fraction * len(values))) - 1, 0)
+    return values[min(index, len(values) - 1)]
+
+
+class Metrics(object):
+    """The durations of the last ``size`` requests of every chart and every datasource of the process."""
+
+    def __init__(self, size):
+        self.size = size
+        self._samples = {}
+        self._lock = threading.Lock()
+
+    def record(self, key, seconds):
+        with self._lock:
+            self._samples.setdefault(key, deque(maxlen=self.size)).append(seconds)
+
+    def summary(self):
+        """Returns ``{key: {'count': n, 'p50': seconds, 'p95': seconds}}``."""
+        with self._lock:
+            samples = dict((key, sorted(values)) for key, values in self._samples.items())
+        return dict((key, {'count': len(values), 'p50': percentile(values, 0.5),
+                           'p95': percentile(values, 0.95)})
+                    for key, values in samples.items())
+
+    def clear(self):
+        with self._lock:
+            self._samples.clear()
+
+
+metrics = Metrics(settings.METRICS_SAMPLES)
+
+
+def report(timings, path, total):
+    """Records the ``timings`` of the request for ``path``, which took ``total`` seconds, in the ``metrics``.
+    Tagged requests that took ``SLOW_CHART_THRESHOLD`` seconds or more are logged too, as a JSON object.
+    """
+    for name in ('chart', 'datasource'):
+        if name in timings.tags:
+            metrics.record('%s:%s' % (name, timings.tags[name]), total)
+    if settings.SLOW_CHART_THRESHOLD and total >= settings.SLOW_CHART_THRESHOLD and timings.tags:
+        slow_logger.warning(simplejson.dumps({'path': path, 'total': round(total, 4), 'tags': timings.tags,
+                                              'stages': dict((name, round(seconds, 4))
+                                                             for name, seconds in timings.stages.items()),
+                                              'queries': timings.queries, 'rows': timings.rows}))
@@ -0,0 +1,106 @@
+import logging
+import threading
+from multiprocessing.pool import ThreadPool
+
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_connection
+from django.db.models import Q
+from django.utils import timezone
+
+import sessions
+
+logger = logging.getLogger(__name__)
+
+PENDING, RUNNING, DONE, FAILED = 'pending', 'running', 'done', 'failed'
+STATUS_CHOICES = ((PENDING, 'Pending'), (RUNNING, 'Running'), (DONE, 'Done'), (FAILED, 'Failed'))
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _get_pool():
+    """Returns the pool of threads that run the introspection jobs. Creates it the first time."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPool(settings.INTROSPECTION_THREADS)
+    return _pool
+
+
+def introspect(datasource_pk):
+    """Introspects the db of the datasource identified by ``datasource_pk`` and saves the structure in the
+    ``DatasourceTable`` rows of the datasource. Records the progress in the ``introspection_status`` field.
+    """
+    from models import Datasource
+
+    Datasource.objects.filter(pk=datasource_pk).update(introspection_status=RUNNING,
+                                                       introspection_started=timezone.now())
+    try:
+        ds = Datasource.objects.get(pk=datasource_pk)
+        ds._pickle_all()
+        ds.time_introspected = timezone.now()
+        ds.introspection_status = DONE
+        ds.introspection_error = None
+        ds.save(update_fields=['time_introspected', 'introspection_status', 'introspection_error'])
+    except Datasource.DoesNotExist:
+        # Deleted before the job got to it.
+        pass
+    except Exception as e:
+        logger.exception('Introspection of datasource %s failed', datasource_pk)
+        Datasource.objects.filter(pk=datasource_pk).update(introspection_status=FAILED,
+                                                           introspection_error=unicode(e))
+
+
+def _introspect_in_background(datasource_pk):
+    try:
+        introspect(datasource_pk)
+    finally:
+        # Every thread gets its own db connection (and SQLAlchemy sessions). Don't leave them open when the
+        # job is done.
+        sessions.remove()
+        close_connection()
+
+
+def schedule(datasource):
+    """Queues the introspection of ``datasource``. Unless ``INTROSPECTION_ASYNC`` is False, the job runs on
+    a background thread and ``schedule`` returns right away.
+    """
+    started = timezone.now()
+    type(datasource).objects.filter(pk=datasource.pk).update(introspection_status=PENDING,
+                                                             introspection_started=started)
+    datasource.introspection_status, datasource.introspection_started = PENDING, started
+    if settings.INTROSPECTION_ASYNC:
+        _get_pool().apply_async(_introspect_in_background, (datasource.pk, ))
+    else:
+        introspect(datasource.pk)
+
+
+def _abandoned():
+    """Returns the condition of the datasources whose job was queued or started more than
+    ``INTROSPECTION_JOB_TIMEOUT`` seconds ago. The job was lost (e.g. uWSGI recycled the worker that ran it).
+    """
+    started_before = timezone.now() - timedelta(seconds=settings.INTROSPECTION_JOB_TIMEOUT)
+    return Q(introspection_status__in=(PENDING, RUNNING)) & (Q(introspection_started__lt=started_before) |
+                                                             Q(introspection_started__isnull=True))
+
+
+def in_progress(datasource):
+    """Returns True if the introspection of ``datasource`` is queued or running, and not abandoned."""
+    if datasource.introspection_status not in (PENDING, RUNNING):
+        return False
+    started = datasource.introspection_started
+    return (started is not None and
+            started >= timezone.now() - timedelta(seconds=settings.INTROSPECTION_JOB_TIMEOUT))
+
+
+def stale_datasources(max_age):
+    """Returns the datasources last introspected more than ``max_age`` (a ``timedelta``) ago, never
+    introspected, whose last introspection failed or whose job was abandoned.
+    """
+    from models import Datasource
+
+    stale = (Q(time_introspected__lt=timezone.now() - max_age) | Q(time_introspected__isnull=True) |
+             Q(introspection_status=FAILED))
+    return Datasource.objects.filter((stale & ~Q(introspection_status__in=(PENDING, RUNNING))) | _abandoned())
@@ -0,0 +1,139 @@
+"""In-process group-by aggregation of ``(x, y)`` rows.
+
+Rows are aggregated into partial aggregates ``[sum, count, min, max]`` per category (x axis value). Every
+aggregate function of the charts (``ColumnChartAxesForm.CHOICES``) can be computed from them, and partials of
+different batches (or of a rollup, see ``rollups``) can be merged.
+
+Batches of integer or float y values are reduced with NumPy (``numpy.add.at`` and friends) when it is
+installed. Everything else (``Decimal`` values, integers whose sum could overflow 64 bits, no NumPy) goes
+through plain Python. Either way the results are the same as SQL's: NULL y values are ignored and integer sums
+are exact. Float sums may differ from the database's in the last digits, since the values are added in a
+different order.
+"""
+from decimal import Decimal
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import queries
+
+
+def merge(a, b):
+    """Merges two ``[sum, count, min, max]`` partial aggregates. NULLs are ignored, like SQL aggregates do.
+    """
+    def pick(x, y, func):
+        if x is None:
+            return y
+        if y is None:
+            return x
+        return func(x, y)
+    return [pick(a[0], b[0], lambda x, y: x + y), a[1] + b[1], pick(a[2], b[2], min), pick(a[3], b[3], max)]
+
+
+def final(aggr_func_name, partials):
+    """Returns the ``aggr_func_name`` aggregate computed from the ``[sum, count, min, max]`` partials."""
+    sum_, count, min_, max_ = partials
+    if aggr_func_name == 'avg':
+        if not count:
+            return None
+        return sum_ / count if isinstance(sum_, Decimal) else sum_ / float(count)
+    return {'sum': sum_, 'count': count, 'min': min_, 'max': max_}[aggr_func_name]
+
+
+def finalize(partials, aggr_func_name, limit=0, other_category='Other'):
+    """Returns the ``(x, aggr_func(y))`` rows for the ``{x: [sum, count, min, max]}`` ``partials``, like
+    ``queries.fetch_aggregate`` does: ordered by x, or the top ``limit`` categories followed by an
+    ``other_category`` row that aggregates all the rest.
+    """
+    rows = [(category, final(aggr_func_name, p)) for category, p in partials.items()]
+    if not limit or len(rows) <= limit:
+        return sorted(rows, key=lambda row: row[0])
+    top = sorted(rows, key=queries.top_order)[:limit]
+    top_categories = set(category for category, _value in top)
+    rest = reduce(merge, [p for category, p in partials.items() if category not in top_categories])
+    return top + [(other_category, final(aggr_func_name, rest))]
+
+
+def _python_partials(rows):
+    partials = {}
+    for category, value in rows:
+        if value is None:
+            partials.setdefault(category, [None, 0, None, None])
+            continue
+        p = partials.get(category)
+        if p is None or p[1] == 0:
+            partials[category] = [value, 1, value, value]
+        else:
+            p[0] += value
+            p[1] += 1
+            if value < p[2]:
+                p[2] = value
+            if value > p[3]:
+                p[3] = value
+    return partials
+
+
+def _numpy_partials(rows):
+    """Same as ``_python_partials`` but reduces the y values with NumPy. Returns None if the values are not
+    all integers or all floats, or if the sum of the integers could overflow an int64 (NumPy wraps around
+    silently).
+    """
+    xs, ys = zip(*rows)
+    categories = {}
+    codes = numpy.fromiter((categories.setdefault(x, len(categories)) for x in xs), numpy.intp, len(xs))
+    y = numpy.array(ys)
+    if y.dtype == object:
+        # NULLs, or values NumPy has no type for (e.g. Decimals).
+        valid = numpy.array([value is not None for value in ys], dtype=bool)
+        codes, y = codes[valid], numpy.array([value for value in ys if value is not None])
+    if y.dtype.kind not in 'if':
+        return None
+    if y.dtype.kind == 'i':
+        if y.dtype != numpy.int64:
+            y = y.astype(numpy.int64)
+        # Python ints, so that abs() of the smallest int64 doesn't overflow either.
+        if len(y) and max(int(y.max()), -int(y.min())) * len(y) > numpy.iinfo(numpy.int64).max:
+            return None
+    size = len(categories)
+    counts = numpy.bincount(codes, minlength=size)
+    sums = numpy.zeros(size, dtype=y.dtype)
+    numpy.add.at(sums, codes, y)
+    info = numpy.iinfo(y.dtype) if y.dtype.kind == 'i' else numpy.finfo(y.dtype)
+    mins = numpy.full(size, info.max, dtype=y.dtype)
+    numpy.minimum.at(mins, codes, y)
+    maxs = numpy.full(size, info.min, dtype=y.dtype)
+    numpy.maximum.at(maxs, codes, y)
+    # tolist() gives back Python ints and floats.
+    counts, sums, mins, maxs = counts.tolist(), sums.tolist(), mins.tolist(), maxs.tolist()
+    partials = {}
+    for category, code in categories.items():
+        if counts[code]:
+            partials[category] = [sums[code], counts[code], mins[code], maxs[code]]
+        else:
+            partials[category] = [None, 0, None, None]
+    return partials
+
+
+def batch_partials(rows):
+    """Returns the ``{x: [sum, count, min, max]}`` partials of a batch (list) of ``(x, y)`` rows."""
+    if numpy is not None and rows:
+        partials = _numpy_partials(rows)
+        if partials is not None:
+            return partials
+    return _python_partials(rows)
+
+
+def aggregate(result, batch_size):
+    """Aggregates the ``(x, y)`` rows of ``result`` (a ``ResultProxy``), fetched ``batch_size`` rows at a
+    time. Returns the ``{x: [sum, count, min, max]}`` partials.
+    """
+    partials = {}
+    while True:
+        rows = result.fetchmany(batch_size)
+        if not rows:
+            break
+        for category, p in batch_partials([tuple(row) for row in rows]).items():
+            partials[category] = merge(partials[category], p) if category in partials else p
+    return partials
@@ -0,0 +1,21 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from zosimus.chartchemy.models import ChartQueryEstimate
+
+
+class Command(BaseCommand):
+    help = ('Lists the charts with the most expensive aggregate queries, as estimated by the last cost check of '
+            'their datasource (see chartchemy.costs).')
+    option_list = BaseCommand.option_list + (
+        make_option('--limit', type='int', dest='limit', default=20, help='Number of charts to list.'),
+    )
+
+    def handle(self, *args, **options):
+        estimates = ChartQueryEstimate.objects.select_related('chart').order_by('-estimated_rows')
+        for estimate in estimates[:options['limit']]:
+            self.stdout.write('%12d rows  %-9s %-10s chart %d (%s), %s' % (
+                estimate.estimated_rows, 'index' if estimate.uses_index else 'no index',
+                estimate.action or '', estimate.chart_id, estimate.chart.name,
+                estimate.time_estimated.strftime('%Y-%m-%d %H:%M')))
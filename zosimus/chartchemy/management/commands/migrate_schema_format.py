@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from zosimus.chartchemy.models import Datasource, DatasourceTable
+
+
+class Command(BaseCommand):
+    help = ('Converts the pickled structure of introspected tables to the JSON format (see chartchemy.schema). '
+            'Datasources and tables that have not been converted keep working, but load slower.')
+
+    def handle(self, *args, **options):
+        datasources = Datasource.objects.filter(pickled_tables__isnull=False)
+        for ds in datasources:
+            ds._migrate_pickled_tables()
+        tables = DatasourceTable.objects.filter(structure__isnull=True, pickled_table__isnull=False)
+        n = 0
+        for table in tables.iterator():
+            table.migrate_pickled()
+            n += 1
+        self.stdout.write('Converted %d datasources and %d tables.' % (len(datasources), n))
@@ -0,0 +1,36 @@
+from optparse import make_option
+
+import sqlalchemy
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+
+from zosimus.chartchemy import queries, rollups
+from zosimus.chartchemy.exceptions import ChartCreationError
+from zosimus.chartchemy.models import Chart
+
+
+class Command(BaseCommand):
+    args = '[chart_id ...]'
+    help = ('Refreshes the rollups of the charts in rollup execution mode and of the charts that have one '
+            'because the cost check sent them to it (or of the given charts). Meant to be run periodically, '
+            'e.g. from cron.')
+    option_list = BaseCommand.option_list + (
+        make_option('--full', action='store_true', dest='full', default=False,
+                    help='Rebuild the rollups from scratch instead of aggregating only the new rows.'),
+    )
+
+    def handle(self, *args, **options):
+        charts = Chart.objects.filter(Q(execution_mode=queries.ROLLUP) | Q(chartrollup__isnull=False))
+        charts = charts.distinct().select_related('datasource')
+        if args:
+            charts = Chart.objects.filter(pk__in=[int(pk) for pk in args]).select_related('datasource')
+        for chart in charts:
+            if not (chart.datasource.is_introspected and chart.is_complete):
+                continue
+            try:
+                count = rollups.refresh(chart, full=options['full'])
+            except (KeyError, sqlalchemy.exc.SQLAlchemyError, ChartCreationError) as e:
+                self.stderr.write('Refreshing the rollup of chart %d (%s) failed: %s' % (chart.pk, chart.name, e))
+            else:
+                self.stdout.write('Refreshed the rollup of chart %d (%s): %d categories' %
+                                  (chart.pk, chart.name, count))
@@ -0,0 +1,23 @@
+from datetime import timedelta
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from zosimus.chartchemy import introspection
+
+
+class Command(BaseCommand):
+    help = ('Re-introspects the datasources whose snapshot of the db structure is older than --max-age '
+            'hours, that were never introspected, whose last introspection failed or whose job was lost. '
+            'Meant to be run periodically, e.g. from cron.')
+    option_list = BaseCommand.option_list + (
+        make_option('--max-age', type='int', dest='max_age', default=settings.INTROSPECTION_MAX_AGE,
+                    help='Age (in hours) after which a snapshot is stale. Defaults to INTROSPECTION_MAX_AGE.'),
+    )
+
+    def handle(self, *args, **options):
+        for ds in introspection.stale_datasources(timedelta(hours=options['max_age'])):
+            self.stdout.write('Introspecting datasource %d (%s)' % (ds.pk, ds.name))
+            # The process exits when the command is done. Don't hand the job to the background threads.
+            introspection.introspect(ds.pk)
@@ -0,0 +1,93 @@
+import string
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+from sqlalchemy import orm
+
+
+class MapperCache(object):
+    """A process wide, bounded collection of classes mapped (``orm.mapper``) to introspected tables.
+
+    The classes are keyed by ``(fingerprint, table_name)`` where ``fingerprint`` identifies the introspected
+    structure of the table (see ``Datasource.table_checksums``). So all the datasource instances with the
+    same table share the same mapped class, i.e. ``ds_a.bases['Customers'] is ds_b.bases['Customers']``.
+
+    At most ``max_size`` classes are kept. The least recently used ones are dropped first. SQLAlchemy only
+    keeps weak references to mapped classes, so a dropped class (and its mapper) is garbage collected once
+    no query refers to it anymore.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._classes = OrderedDict()
+        # Mapping a class is not atomic. Hold the lock while mapping so that two threads don't map the same
+        # table twice.
+        self._lock = threading.RLock()
+
+    def get(self, fingerprint, table_name, table_factory):
+        """Returns the class mapped to the table ``table_name``. If it isn't cached, calls ``table_factory()``
+        to get the ``sqlalchemy.schema.Table`` object and maps a new class to it.
+        """
+        key = (fingerprint, table_name)
+        with self._lock:
+            klass = self._classes.pop(key, None)
+            if klass is None:
+                klass = self._build(table_name, table_factory())
+            # (Re-)insert the class so that it becomes the most recently used.
+            self._classes[key] = klass
+            while len(self._classes) > self.max_size:
+                self._classes.popitem(last=False)
+            return klass
+
+    def _build(self, table_name, table):
+        return _map_class(table_name, table)
+
+    def invalidate(self, fingerprint):
+        """Drops all the classes mapped to tables with the structure identified by ``fingerprint``."""
+        with self._lock:
+            for key in [k for k in self._classes if k[0] == fingerprint]:
+                del self._classes[key]
+
+    def clear(self):
+        with self._lock:
+            self._classes.clear()
+
+    def __contains__(self, key):
+        return key in self._classes
+
+    def __len__(self):
+        return len(self._classes)
+
+
+class TableCache(MapperCache):
+    """Same as ``MapperCache``, but keeps the ``sqlalchemy.schema.Table`` objects themselves. The Core
+    queries (see ``queries``) don't need mapped classes, only the tables.
+    """
+
+    def _build(self, table_name, table):
+        return table
+
+
+def _map_class(table_name, table):
+    """Generates a class for ``table_name`` and *maps* it to the ``table`` object."""
+    # Note: When creating a class dynamically using ``type(name, bases, attr_dict)`` function,
+    # as far as I can tell (and tested) *any*name is legal. For example
+    # ``type(" 42!   worlds ", (object, ), {})`` will return ``__main__. 42!   worlds ``
+    # However for the sake of making classes look pretty, we are going to strip punctuation
+    # and spaces and prefix class name with Base. So in the above case we'll generate a class
+    # ``__main__.Base42Wworlds``
+    klass_name = table_name.encode('ascii', 'ignore').strip().title().replace(" ", "")
+    trans = string.maketrans("", "")
+    klass_name = 'Base' + klass_name.translate(trans, string.punctuation)
+    # Now generate the class
+    # NOTE: Note that we are ignoring ``Foreign Keys``. A more complete solution will involve
+    # creating a ``relationship`` attribute for every foreign key in the Table object.
+    klass = type(klass_name, (object, ), {})
+    # Map this newly generated declarative base to the Table object.
+    orm.mapper(klass, table)
+    return klass
+
+
+cache = MapperCache(settings.MAPPER_CACHE_SIZE)
+tables = TableCache(settings.MAPPER_CACHE_SIZE)
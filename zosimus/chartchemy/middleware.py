@@ -0,0 +1,36 @@
+import instrumentation
+import sessions
+
+
+class ServerTimingMiddleware(object):
+    """Times every request (see ``instrumentation``) and reports the timings in a ``Server-Timing`` header,
+    the slow chart log and the metrics.
+
+    Streamed responses are reported when the view returns, before the body is produced.
+    """
+
+    def process_request(self, request):
+        instrumentation.start()
+
+    def process_response(self, request, response):
+        timings = instrumentation.finish()
+        if timings is None:
+            # An earlier middleware answered the request.
+            return response
+        total = timings.total
+        response['Server-Timing'] = timings.server_timing(total)
+        instrumentation.report(timings, request.path, total)
+        return response
+
+
+class SessionCleanupMiddleware(object):
+    """Closes the SQLAlchemy sessions opened by the request (see ``sessions``), whether the view succeeded or
+    not, so that their connections go back to the pool.
+    """
+
+    def process_response(self, request, response):
+        sessions.remove()
+        return response
+
+    def process_exception(self, request, exception):
+        sessions.remove()
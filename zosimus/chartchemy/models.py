@@ -1,20 +1,42 @@
 import base64
-import string
-from collections import defaultdict, OrderedDict
+import hashlib
+import logging
+import sys
+from collections import Mapping, OrderedDict
+from itertools import chain, islice
 
+import simplejson
 import sqlalchemy
 from django.conf import settings
 from django.contrib.auth.models import User
+from django.core.cache import cache
 from django.core.exceptions import ValidationError
-from django.db import models
-from django.db.models.signals import post_save
+from django.db import close_connection, models
+from django.db.models.signals import post_save, pre_save, post_delete
 from django.dispatch import receiver
 from django.utils import timezone
 from django_fields.fields import EncryptedCharField
-from sqlalchemy import orm
 
-from exceptions import UnsupportedDatabaseError, ChartCreationError
-from utils import render_highcharts_options
+import buckets
+import caching
+import concurrency
+import costs
+import engines
+import instrumentation
+import introspection
+import kernels
+import mappers
+import profiling
+import queries
+import rollups
+import sampling
+import schema
+import sessions
+import singleflight
+from exceptions import UnsupportedDatabaseError, ChartCreationError, ChartQueuedError, QueryOverBudgetError
+from utils import render_highcharts_options, iter_highcharts_options
+
+logger = logging.getLogger(__name__)
 
 try:
     import cPickle as pickle  # @UnusedImport
@@ -28,54 +50,23 @@ class TableBases(object):
     In SQLAlchemy, introspecting a table returns instances of Table class. But Table classes are lower
     level. To get the goodness of higher level ORM API, we need Declarative Base classes that are
     *mapped* to the Table class. ``TableBases`` is such a collection.
+
+    The classes themselves live in the process wide ``mappers.cache``, keyed by the checksum of the
+    structure of the table. So datasource instances with identical tables share the classes too.
     """
 
     def __init__(self, datasource, *args, **kwargs):
         self.datasource = datasource
-        self._bases = {}
 
     def __getitem__(self, table_name):
         """Returns a ``Base`` table class for the corresponding ``table_name``.
 
         It is expensive to generate a class. So do it lazily, i.e. create the class the first time it is
-        accessed and save it in the ``_bases`` dict.
-        """
-
-        # NOTE: The current solution (even though it uses lazy loading is still not completely efficient).
-        # Because we create a Base class for every datasource instance even if all the datasource instances
-        # all have same parameters. For example in the same python process if we do ::
-        #
-        #     ds_a = Datasource.objects.get(pk=1)
-        #     ds_b = Datasource.objects.get(pk=1)
-        #
-        # Then ``ds_a.bases['Customers'] is ds_b.bases['Customers']`` returns ``False``. So the
-        # ``BaseCustomers`` class is created twice.
-        #
-        # A better solution is to bind a TableBases object to the parameters of the datasource and return
-        # same TableBases object for all the datasource objects that share same parameters.
-        #
-        # But the current setup will do in a pinch.
-
-        # Lazily create a Base class and *map* it to the corresponding table on the instance.
-        if self._bases.get(table_name) is None:
-            # Note: When creating a class dynamically using ``type(name, bases, attr_dict)`` function,
-            # as far as I can tell (and tested) *any*name is legal. For example
-            # ``type(" 42!   worlds ", (object, ), {})`` will return ``__main__. 42!   worlds ``
-            # However for the sake of making classes look pretty, we are going to strip punctuation
-            # and spaces and prefix class name with Base. So in the above case we'll generate a class
-            # ``__main__.Base42Wworlds``
-            klass_name = table_name.encode('ascii', 'ignore').strip().title().replace(" ", "")
-            trans = string.maketrans("", "")
-            klass_name = 'Base' + klass_name.translate(trans, string.punctuation)
-            # Now generate the class
-            # NOTE 2: Note that we are ignoring ``Foreign Keys``. A more complete solution will involve
-            # creating a ``relationship`` attribute for every foreign key in the Table object.
-            klass = type(klass_name, (object, ), {})
-            # Map this newly generated declarative base to the Table object.
-            orm.mapper(klass, self.datasource.tables[table_name])
-            # Now add it to the bases
-            self._bases[table_name] = klass
-        return self._bases[table_name]
+        accessed by any datasource with the same table and reuse it from then on.
+        """
+        with instrumentation.stage('mapping'):
+            return mappers.cache.get(self.datasource.table_checksums[table_name], table_name,
+                                     lambda: self.datasource.tables[table_name])
 
 
 class Datasource(models.Model):
@@ -89,127 +80,277 @@ class Datasource(models.Model):
     dbusername = models.CharField(max_length=100)
     dbpassword = EncryptedCharField(max_length=100)
     dbhost = models.CharField(max_length=100)  # Must either be an IP address or URL
-    # Pickled dict of db table names and sqlalchemy Table objects
+    # Pickled dict of db table names and sqlalchemy Table objects.
+    # NOTE: Legacy. Tables are stored in DatasourceTable rows now. These fields are only read to migrate
+    # datasources introspected before that. See _migrate_pickled_tables().
     pickled_tables = models.TextField(null=True)
     pickled_measures = models.TextField(null=True)
     pickled_dimensions = models.TextField(null=True)
     time_introspected = models.DateTimeField(null=True)
+    # Introspection runs in the background. See introspection.schedule().
+    introspection_status = models.CharField(max_length=20, choices=introspection.STATUS_CHOICES,
+                                            default=introspection.PENDING)
+    introspection_error = models.TextField(null=True, blank=True)
+    # When the job was queued (and then started). Jobs older than INTROSPECTION_JOB_TIMEOUT are abandoned.
+    introspection_started = models.DateTimeField(null=True, blank=True)
+    # Limits of the chart queries. None means the DATASOURCE_QUERY_TIMEOUT (seconds) and
+    # DATASOURCE_MAX_CONCURRENT_QUERIES settings.
+    query_timeout = models.PositiveIntegerField(null=True, blank=True)
+    max_concurrent_queries = models.PositiveIntegerField(null=True, blank=True)
+    # Chart queries expected to read more rows than ``query_row_budget`` are refused, sampled, read from the
+    # rollup or run in the background, as ``over_budget_action`` says. See costs. None means
+    # DATASOURCE_QUERY_ROW_BUDGET. 0 means no budget.
+    query_row_budget = models.PositiveIntegerField(null=True, blank=True)
+    over_budget_action = models.CharField(max_length=10, choices=costs.OVER_BUDGET_ACTION_CHOICES,
+                                          default=costs.REFUSE)
+
+    @property
+    def effective_query_timeout(self):
+        """Returns the number of seconds a chart query may run for. 0 means no limit."""
+        return self.query_timeout if self.query_timeout is not None else settings.DATASOURCE_QUERY_TIMEOUT
+
+    @property
+    def effective_max_concurrent_queries(self):
+        """Returns the maximum number of chart queries (per process) that may run on the datasource at the
+        same time.
+        """
+        if self.max_concurrent_queries:
+            return self.max_concurrent_queries
+        return settings.DATASOURCE_MAX_CONCURRENT_QUERIES
+
+    @property
+    def effective_query_row_budget(self):
+        """Returns the maximum number of rows a chart query is expected to read. 0 means no limit."""
+        if self.query_row_budget is not None:
+            return self.query_row_budget
+        return settings.DATASOURCE_QUERY_ROW_BUDGET
+
+    def guarded_connection(self, blocking=False, timeout=None):
+        """Returns a ``concurrency.QueryGuard`` that checks out a connection to run chart queries on, within
+        the time and concurrency limits of the datasource::
+
+            with datasource.guarded_connection() as connection:
+                connection.execute(...)
+
+        Unless ``blocking`` is True, ``DatasourceBusyError`` is raised right away if the datasource is
+        already running its maximum number of queries. ``timeout`` overrides ``effective_query_timeout``.
+        """
+        timeout = timeout if timeout is not None else self.effective_query_timeout
+        return concurrency.QueryGuard(self.engine, self.connection_key, timeout,
+                                      self.effective_max_concurrent_queries, blocking)
+
+    @property
+    def is_introspected(self):
+        """Returns True if the db has been introspected at least once, i.e. the tables, measures and
+        dimensions can be read without introspecting the db first. Re-introspecting the db doesn't
+        change that, the previous snapshot is used until the new one is saved.
+        """
+        return self.time_introspected is not None
+
+    @property
+    def connection_key(self):
+        """Returns the tuple of connection parameters that identifies the database the datasource points to.
+        Datasources with the same ``connection_key`` share an engine. See ``engines.EngineRegistry``.
+        """
+        return (self.dbtype, self.dbhost, self.dbname, self.dbusername, self.dbpassword)
 
     @property
     def engine(self):
-        """ Returns the SQLAlchemy engine for the datasource. Creates one if there isn't one already.
+        """ Returns the SQLAlchemy engine for the datasource from the process wide engine registry.
+        Creates one if there isn't one already.
         """
+        conn_param = {'username': self.dbusername,
+                      'password': self.dbpassword,
+                      'host': self.dbhost,
+                      'dbname': self.dbname,
+                      }
+        conn_template = "%(dialect_driver)s://%(username)s:%(password)s@%(host)s/%(dbname)s"
 
-        # Every instance gets a different engine. Can be optimized further. See the NOTE in TableBases.
-        try:
-            return self._engine
-        except AttributeError:
-            conn_param = {'username': self.dbusername,
-                          'password': self.dbpassword,
-                          'host': self.dbhost,
-                          'dbname': self.dbname,
-                          }
-            conn_template = "%(dialect_driver)s://%(username)s:%(password)s@%(host)s/%(dbname)s"
-
-            if self.dbtype == 'MYSQL':
-                conn_param['dialect_driver'] = 'mysql+mysqldb'
-            else:
-                raise UnsupportedDatabaseError("This database is not supported")
-            conn_string = conn_template % conn_param
-            self._engine = sqlalchemy.create_engine(conn_string, echo=settings.ECHO)
-        return self._engine
+        if self.dbtype == 'MYSQL':
+            conn_param['dialect_driver'] = 'mysql+mysqldb'
+        else:
+            raise UnsupportedDatabaseError("This database is not supported")
+        conn_string = conn_template % conn_param
+        return engines.registry.get(self.connection_key, conn_string, **engines.engine_options())
 
     def _pickle_tables(self):
-        """Reflects the database pointed to by the datasource, pickles all the Table objects returned
-        and sets the ``pickled_tables`` field.
+        """Introspects the database pointed to by the datasource and saves the structure of every table
+        (its columns, and its measures and dimensions) in a ``DatasourceTable`` row.
+
+        Only the tables whose structure changed since the last introspection are reflected and saved again.
+        The rows of the tables that don't exist anymore are deleted.
 
         See Also: tables
         """
-        metadata = sqlalchemy.MetaData()
-        metadata.reflect(bind=self.engine)
-        pickled_tables = pickle.dumps(dict(metadata.tables.items()))
-        # NOTE: Need to base64 encode it since django tries to convert to Unicode covert stuff by
-        # default which causes issues which storing and retrieving from database.
-        # See the implementation of ``django.sessions.base`` for an example of base64 encoding a pickled
-        # object before saving in db.
-        self.pickled_tables = base64.b64encode(pickled_tables)
-
-    def _pickle_measures_and_dimensions(self):
-        """Reflects the database columns and sets the ``pickled_measures`` and ``pickled_dimensions`` fields.
-
-        The logic is rather simple minded ... if a column is an integer or numeric (float or double), then
-        the column is considered a measure. If it is a string type, it is considered a dimension. Note that
-        we conveniently ignore date and time columns. Oh well.
-
-        See Also: _pickle_tables()
-        """
-        measures, dimensions = defaultdict(list), defaultdict(list)
-        for table_name, table in self.tables.items():
-            for column in table.columns:
-                if isinstance(column.type, (sqlalchemy.types.Integer, sqlalchemy.Numeric)):
-                    measures[table_name].append(column.name)
-                elif isinstance(column.type, sqlalchemy.types.String):
-                    dimensions[table_name].append(column.name)
-        # NOTE: see note in _pickle_tables() for an explanation of why we need to base64 encode.
-        self.pickled_measures = base64.b64encode(pickle.dumps(OrderedDict(measures)))
-        self.pickled_dimensions = base64.b64encode(pickle.dumps(OrderedDict(dimensions)))
+        inspector = sqlalchemy.inspect(self.engine)
+        table_names = inspector.get_table_names()
+        checksums = dict(self.datasourcetable_set.values_list('name', 'checksum'))
+        for table_name in table_names:
+            # NOTE: Copy the list. The SQLite dialect sorts the (cached) list of columns in place by primary
+            # key in get_pk_constraint().
+            columns = list(inspector.get_columns(table_name))
+            primary_key = inspector.get_pk_constraint(table_name)['constrained_columns']
+            checksum = _structure_checksum(columns, primary_key)
+            if checksums.get(table_name) == checksum:
+                continue
+            fields = _table_fields(_build_table(table_name, columns, primary_key), checksum)
+            if table_name in checksums:
+                # The classes mapped to the old structure of the table are of no use anymore.
+                mappers.cache.invalidate(checksums[table_name])
+                mappers.tables.invalidate(checksums[table_name])
+                self.datasourcetable_set.filter(name=table_name).update(**fields)
+            else:
+                self.datasourcetable_set.create(name=table_name, **fields)
+        dropped = set(checksums) - set(table_names)
+        if dropped:
+            self.datasourcetable_set.filter(name__in=dropped).delete()
+        self._reset_table_index()
+
+    def _migrate_pickled_tables(self):
+        """Moves the tables of a datasource introspected before tables were stored per table (i.e. the
+        ``pickled_tables`` field) to ``DatasourceTable`` rows.
+        """
+        if self.pickled_tables is None:
+            return
+        if not self.datasourcetable_set.exists():
+            for table_name, table in _unpickle(self.pickled_tables).items():
+                columns = [{'name': c.name, 'type': c.type, 'nullable': c.nullable} for c in table.columns]
+                primary_key = [c.name for c in table.primary_key]
+                self.datasourcetable_set.create(
+                    name=table_name,
+                    **_table_fields(_build_table(table_name, columns, primary_key),
+                                    _structure_checksum(columns, primary_key)))
+        self.pickled_tables = self.pickled_measures = self.pickled_dimensions = None
+        Datasource.objects.filter(pk=self.pk).update(pickled_tables=None, pickled_measures=None,
+                                                     pickled_dimensions=None)
+
+    def _profile_tables(self):
+        """Profiles every table (see ``profiling``) and saves the profiles in the ``DatasourceTable`` rows.
+        Tables that can't be profiled (or not within the query timeout of the datasource) are left without a
+        profile.
+
+        The queries of every table run like the chart queries (see ``guarded_connection()``), but wait for a
+        slot of the datasource rather than failing.
+        """
+        inspector = sqlalchemy.inspect(self.engine)
+        for table_name in self.table_names:
+            try:
+                with self.guarded_connection(blocking=True) as connection:
+                    profile = profiling.profile_table(connection, inspector, self.tables[table_name],
+                                                      self.dimensions.get(table_name, []))
+            except (sqlalchemy.exc.SQLAlchemyError, ChartCreationError):
+                logger.warning('Profiling table %s of datasource %s failed', table_name, self.pk,
+                               exc_info=True)
+                profile = None
+            self.datasourcetable_set.filter(name=table_name)\
+                                    .update(profile=simplejson.dumps(profile) if profile else None)
+        self._reset_table_index()
 
     def _pickle_all(self):
-        """Introspects the db and pickles the tables and the measures and dimensions.
+        """Introspects the db and saves the tables and the measures and dimensions. Profiles the tables too,
+        if ``INTROSPECTION_PROFILE`` is True.
         """
         self._pickle_tables()
-        self._pickle_measures_and_dimensions()
+        if settings.INTROSPECTION_PROFILE:
+            self._profile_tables()
+
+    def _load_table_index(self):
+        """Reads the names, checksums, measures and dimensions of all the tables in one query. The Table
+        objects themselves are not loaded.
+        """
+        with instrumentation.stage('schema'):
+            self._migrate_pickled_tables()
+            self._table_names, self._table_checksums = [], {}
+            self._measures, self._dimensions, self._profiles = OrderedDict(), OrderedDict(), {}
+            rows = self.datasourcetable_set.order_by('name')\
+                                           .values_list('name', 'checksum', 'measures', 'dimensions',
+                                                        'pickled_measures', 'pickled_dimensions', 'profile')
+            for (table_name, checksum, measures, dimensions, pickled_measures, pickled_dimensions,
+                 profile) in rows:
+                self._table_names.append(table_name)
+                self._table_checksums[table_name] = checksum
+                if profile is not None:
+                    self._profiles[table_name] = simplejson.loads(profile)
+                for attr, columns in ((self._measures, _column_names(measures, pickled_measures)),
+                                      (self._dimensions, _column_names(dimensions, pickled_dimensions))):
+                    if columns:
+                        attr[table_name] = columns
+
+    def _reset_table_index(self):
+        for attr in ('_table_names', '_table_checksums', '_measures', '_dimensions', '_profiles', '_tables'):
+            self.__dict__.pop(attr, None)
+
+    @property
+    def table_names(self):
+        """Returns the (sorted) list of the names of the introspected tables.
+        """
+        try:
+            return self._table_names
+        except AttributeError:
+            self._load_table_index()
+        return self._table_names
+
+    @property
+    def table_checksums(self):
+        """Returns a dict of table names and the checksums of their structure. Tables with the same
+        checksum have identical columns.
+
+        See Also: mappers.MapperCache
+        """
+        try:
+            return self._table_checksums
+        except AttributeError:
+            self._load_table_index()
+        return self._table_checksums
 
     @property
     def tables(self):
-        """Reads the ``pickled_tables`` field and unpickles the data and returns a dict of table names
-        and corresponding sqlalchemy.schema.Table objects. If the ``pickled_tables`` field is empty,
-        introspects db first and then returns the tables.
+        """Returns a (read only) dict of table names and corresponding sqlalchemy.schema.Table objects.
+        A Table object is built only when it is looked up.
 
-        See Also: _pickle_tables()
+        See Also: _pickle_tables(), DatasourceTables
         """
         try:
             return self._tables
         except AttributeError:
-            if self.pickled_tables is None:
-                self._pickle_tables()
-            # NOTE: see note in _pickle_tables() for an explanation of why pickled fields are
-            # base64 encoded.
-            self._tables = pickle.loads(base64.b64decode(self.pickled_tables))
+            self._tables = DatasourceTables(self)
         return self._tables
 
     @property
     def measures(self):
-        """Reads the ``pickled_measures`` field and unpickles the data and returns a dict of table names and
-        and list of column names that are measures. If the ``pickled_measures`` field is empty,
-        introspects db first and then returns the measures.
+        """Returns a dict of table names and list of column names that are measures.
 
-        See Also: _pickle_measures_and_dimensions()
+        See Also: _measures_and_dimensions()
         """
         try:
             return self._measures
         except AttributeError:
-            if self.pickled_measures is None:
-                self._picke_measures_and_dimensions()
-            self._measures = pickle.loads(base64.b64decode(self.pickled_measures))
+            self._load_table_index()
         return self._measures
 
     @property
     def dimensions(self):
-        """Reads the ``pickled_dimensions`` field and unpickles the data and returns a dict of table names and
-        and list of column names that are dimensions. If the ``pickled_dimensions`` field is empty,
-        introspects db first and then returns the dimensions.
+        """Returns a dict of table names and list of column names that are dimensions.
 
-        See Also: _pickle_measures_and_dimensions()
+        See Also: _measures_and_dimensions()
         """
         try:
             return self._dimensions
         except AttributeError:
-            if self.pickled_dimensions is None:
-                self._picke_measures_and_dimensions()
-            self._dimensions = pickle.loads(base64.b64decode(self.pickled_dimensions))
+            self._load_table_index()
         return self._dimensions
 
+    @property
+    def profiles(self):
+        """Returns a dict of table names and the profiles of the tables (see ``profiling.profile_table``).
+        Tables that weren't profiled are left out.
+        """
+        try:
+            return self._profiles
+        except AttributeError:
+            self._load_table_index()
+        return self._profiles
+
     @property
     def bases(self):
         """Returns a TableBases collection. Lazily creates an loads a (declarative) Base object mapped
@@ -243,34 +384,215 @@ class Datasource(models.Model):
         if the supplied parameters are incorrect, a new datasource record will not be created.
         """
         try:
-            self.engine.connect()
+            self.engine.connect().close()
         except (sqlalchemy.exc.OperationalError, UnsupportedDatabaseError):
+            # Don't keep a pool around for parameters that don't work.
+            engines.registry.invalidate(self.connection_key)
             raise ValidationError("Something wrong with the parameters. Can't connect to the DB.")
 
     @property
     def session(self):
-        """Returns a session (``sqlalchemy.orm.session``) corresponding to the datasource.
+        """Returns the session (``sqlalchemy.orm.session``) of the current request on the datasource. All the
+        instances of the datasource in a thread share it. It is closed at the end of the request (see
+        ``sessions``).
         """
-        # NOTE: Each instance gets its own session. Can be optimized further. See note in
-        # TableBases.__getitem__
+        return sessions.registry.get(self.connection_key, self.engine)
+
+
+class DatasourceTables(Mapping):
+    """A read only ``dict`` of table names and ``sqlalchemy.schema.Table`` objects of a datasource.
+
+    Listing the table names only reads the names of the ``DatasourceTable`` rows of the datasource. A Table
+    object is read (and built) from its row the first time it is looked up.
+    """
+
+    def __init__(self, datasource):
+        self.datasource = datasource
+        self._tables = {}
+
+    def __getitem__(self, table_name):
         try:
-            return self._session
-        except AttributeError:
-            Session = orm.sessionmaker()
-            Session.configure(bind=self.engine)
-            self._session = Session()
-            return self._session
+            return self._tables[table_name]
+        except KeyError:
+            try:
+                checksum = self.datasource.table_checksums[table_name]
+            except KeyError:
+                raise KeyError(table_name)
+            # Table objects are shared by all the datasources with the same table, like the mapped classes.
+            self._tables[table_name] = mappers.tables.get(checksum, table_name,
+                                                          lambda: self._read(table_name))
+        return self._tables[table_name]
+
+    def _read(self, table_name):
+        try:
+            with instrumentation.stage('schema'):
+                return self.datasource.datasourcetable_set.get(name=table_name).table
+        except DatasourceTable.DoesNotExist:
+            raise KeyError(table_name)
+
+    def __iter__(self):
+        return iter(self.datasource.table_names)
+
+    def __len__(self):
+        return len(self.datasource.table_names)
+
+
+class DatasourceTable(models.Model):
+    """The structure of a table of a datasource as of the last introspection.
+    """
+    datasource = models.ForeignKey(Datasource)
+    name = models.CharField(max_length=100)
+    # Digest of the columns and the primary key of the table. See _structure_checksum()
+    checksum = models.CharField(max_length=40)
+    # Versioned JSON document describing the columns of the table. See schema.dumps()
+    structure = models.TextField(null=True)
+    # JSON lists of the names of the columns that are measures and dimensions
+    measures = models.TextField(null=True)
+    dimensions = models.TextField(null=True)
+    # JSON statistics of the table (row count, distinct counts, indexes). See profiling.profile_table()
+    profile = models.TextField(null=True)
+    # NOTE: Legacy. Pickled sqlalchemy Table object and pickled lists of measures and dimensions of the rows
+    # saved before the structure was stored as JSON. See migrate_pickled().
+    pickled_table = models.TextField(null=True)
+    pickled_measures = models.TextField(null=True)
+    pickled_dimensions = models.TextField(null=True)
+
+    class Meta:
+        unique_together = (('datasource', 'name'), )
+
+    @property
+    def table(self):
+        """Returns the sqlalchemy.schema.Table object built from the ``structure`` of the table."""
+        if self.structure is None:
+            return _unpickle(self.pickled_table)
+        return schema.loads(self.structure)
+
+    def migrate_pickled(self):
+        """Converts a row saved with a pickled Table object to the JSON ``structure``."""
+        table = _unpickle(self.pickled_table)
+        columns = [{'name': c.name, 'type': c.type, 'nullable': c.nullable} for c in table.columns]
+        primary_key = [c.name for c in table.primary_key]
+        for field, value in _table_fields(table, _structure_checksum(columns, primary_key)).items():
+            setattr(self, field, value)
+        self.pickled_table = self.pickled_measures = self.pickled_dimensions = None
+        self.save()
+
+    def __unicode__(self):
+        return self.name
+
+
+def _unpickle(value):
+    # NOTE: Pickled fields are base64 encoded since django tries to convert to Unicode covert stuff by
+    # default which causes issues which storing and retrieving from database.
+    # See the implementation of ``django.sessions.base`` for an example of base64 encoding a pickled
+    # object before saving in db.
+    return pickle.loads(base64.b64decode(value))
+
+
+def _column_names(value, pickled_value):
+    """Returns the list of column names stored as JSON in ``value`` or, in legacy rows, as a pickle in
+    ``pickled_value``.
+    """
+    if value is None:
+        return _unpickle(pickled_value)
+    return simplejson.loads(value)
+
+
+def _build_table(table_name, columns, primary_key):
+    """Returns a Table object for the ``columns`` (as returned by ``Inspector.get_columns()``).
+
+    Every table gets its own MetaData. So pickling a table doesn't drag the rest of the schema along.
+    """
+    return sqlalchemy.Table(table_name, sqlalchemy.MetaData(),
+                            *[sqlalchemy.Column(c['name'], c['type'], nullable=c['nullable'],
+                                                primary_key=c['name'] in primary_key)
+                              for c in columns])
+
+
+def _guarded_rows(guard, rows, session=None):
+    """Yields the ``rows`` and exits the ``concurrency.QueryGuard`` once they are all read (or the
+    iteration is abandoned). Closes the ``session`` of the query first, if any.
+    """
+    exc_info = (None, None, None)
+    try:
+        for row in rows:
+            yield row
+    except Exception:
+        exc_info = sys.exc_info()
+        raise
+    finally:
+        try:
+            if session is not None:
+                sessions.close(session)
+        finally:
+            guard.__exit__(*exc_info)
+
+
+# Bumped when _measures_and_dimensions() changes, so that the next introspection saves every table again.
+_CLASSIFICATION_VERSION = 2
+
+
+def _structure_checksum(columns, primary_key):
+    """Returns a digest of the ``columns`` (as returned by ``Inspector.get_columns()``) and the primary key
+    of a table. The digest changes if a column is added, dropped, renamed or changes type or nullability.
+    """
+    structure = [(c['name'], repr(c['type']), c['nullable']) for c in columns]
+    return hashlib.sha1(repr((structure, sorted(primary_key), _CLASSIFICATION_VERSION))).hexdigest()
+
+
+def _measures_and_dimensions(table):
+    """Returns the lists of the names of the columns of ``table`` that are measures and dimensions.
+
+    The logic is rather simple minded ... if a column is an integer or numeric (float or double), then
+    the column is considered a measure. If it is a string type, it is considered a dimension. So are date
+    and datetime columns, which charts group by time buckets (see ``buckets``). Time columns are ignored.
+    """
+    measures, dimensions = [], []
+    for column in table.columns:
+        if isinstance(column.type, (sqlalchemy.types.Integer, sqlalchemy.Numeric)):
+            measures.append(column.name)
+        elif isinstance(column.type, sqlalchemy.types.String) or buckets.is_temporal(column):
+            dimensions.append(column.name)
+    return measures, dimensions
+
+
+def _table_fields(table, checksum):
+    """Returns the values of the fields of the ``DatasourceTable`` row that stores ``table``."""
+    measures, dimensions = _measures_and_dimensions(table)
+    return {'checksum': checksum,
+            'structure': schema.dumps(table),
+            'measures': simplejson.dumps(measures),
+            'dimensions': simplejson.dumps(dimensions)}
+
+
+@receiver(pre_save, sender=Datasource)
+def invalidate_edited_engine(sender, instance, raw, using, **kwargs):
+    """If the connection parameters of an existing datasource are edited, dispose the engine for the old
+    parameters.
+    """
+    if instance.pk is None:
+        return
+    try:
+        original = Datasource.objects.using(using).get(pk=instance.pk)
+    except Datasource.DoesNotExist:
+        return
+    if original.connection_key != instance.connection_key:
+        engines.registry.invalidate(original.connection_key)
+
+
+@receiver(post_delete, sender=Datasource)
+def invalidate_deleted_engine(sender, instance, using, **kwargs):
+    """Dispose the engine of a deleted datasource."""
+    engines.registry.invalidate(instance.connection_key)
 
 
 @receiver(post_save, sender=Datasource)
 def introspect_db(sender, instance, created, raw, using, **kwargs):
-    """The first time the datasource parameters are saved, introspect the db and save the
-    structure in the fields pickled_*
+    """The first time the datasource parameters are saved, queue the introspection of the db. The
+    structure is saved in DatasourceTable rows when the introspection is done.
     """
     if created:
-        instance._pickle_all()
-        instance.time_introspected = timezone.now()
-        instance.save()
+        introspection.schedule(instance)
 
 
 class Chart(models.Model):
@@ -281,32 +603,536 @@ class Chart(models.Model):
     datasource = models.ForeignKey(Datasource)
     table_name = models.CharField(max_length=100, null=True, blank=True)
     x_axis = models.CharField(max_length=100, null=True, blank=True)
+    # Granularity of the time buckets of a date or datetime x axis (see buckets). Null for other x axes.
+    x_bucket = models.CharField(max_length=10, choices=buckets.BUCKET_CHOICES, null=True, blank=True)
     y_axis = models.CharField(max_length=100, null=True, blank=True)
     aggr_func_name = models.CharField(max_length=100, null=True, blank=True)
+    # JSON encoded list of the [y_axis, aggr_func_name] pairs of the series plotted next to the one of
+    # y_axis and aggr_func_name. All the series are computed by the same query. Only LIVE charts have extra
+    # series.
+    extra_series = models.TextField(null=True, blank=True)
     time_created = models.DateTimeField(null=True, blank=True)
+    # Number of seconds to cache the chart data for. If null, CHART_DATA_CACHE_TIMEOUT is used. 0 disables
+    # caching.
+    cache_timeout = models.PositiveIntegerField(null=True, blank=True)
+    # Maximum number of categories to plot. The rest are lumped together in an OTHER_CATEGORY bar. If null,
+    # CHART_CATEGORY_LIMIT is used. 0 means no limit.
+    category_limit = models.PositiveIntegerField(null=True, blank=True)
+    # In ROLLUP mode the chart data is read from the pre-aggregated rollup of the chart (see rollups) rather
+    # than queried from the datasource. The rollup is refreshed incrementally if there is a key column.
+    execution_mode = models.CharField(max_length=10, choices=queries.EXECUTION_MODE_CHOICES,
+                                      default=queries.LIVE)
+    rollup_key_column = models.CharField(max_length=100, null=True, blank=True)
 
-    def _get_column_chart_data(self):
-        session = self.datasource.session
+    OTHER_CATEGORY = 'Other'
+
+    @property
+    def is_complete(self):
+        """Returns True if the table, the axes and the aggregate function of the chart are all set."""
+        return bool(self.table_name and self.x_axis and self.y_axis and self.aggr_func_name)
+
+    @property
+    def extra_measures(self):
+        """Returns the list of the ``(y_axis, aggr_func_name)`` pairs of the extra series of the chart."""
+        if not self.extra_series or self.execution_mode != queries.LIVE:
+            return []
+        return [(str(y_axis), str(aggr_func_name))
+                for y_axis, aggr_func_name in simplejson.loads(self.extra_series)]
+
+    @property
+    def data_cache_key(self):
+        """Returns the key under which the result of the chart's aggregate query is cached."""
+        return caching.make_key(caching.DATA_KEY_PREFIX, self.datasource_id, self.table_name,
+                                self.x_axis, self.x_bucket, self.y_axis, self.aggr_func_name,
+                                self.effective_category_limit, self.extra_measures)
+
+    @property
+    def data_cache_timeout(self):
+        """Returns the number of seconds to cache the chart data for. 0 means don't cache."""
+        return self.cache_timeout if self.cache_timeout is not None else settings.CHART_DATA_CACHE_TIMEOUT
+
+    def invalidate_data_cache(self, key=None):
+        """Deletes the cached result of the aggregate query. ``key`` defaults to the current
+        ``data_cache_key``.
+        """
+        cache.delete(key or self.data_cache_key)
+
+    @property
+    def effective_category_limit(self):
+        """Returns the maximum number of categories (x axis values) to plot. 0 means no limit. Time buckets
+        are never limited: a time series is plotted whole. Their number is checked by ``ColumnChartAxesForm``
+        instead (see ``TIME_BUCKET_MAX_BUCKETS``).
+        """
+        if self.x_bucket:
+            return 0
+        return self.category_limit if self.category_limit is not None else settings.CHART_CATEGORY_LIMIT
+
+    def _bucketed(self, x_column):
+        """Returns the time bucket of ``x_column`` if the chart has one, otherwise ``x_column``."""
+        return buckets.bucket(x_column, str(self.x_bucket)) if self.x_bucket else x_column
+
+    def _core_columns(self):
+        """Returns the x axis column (or its time bucket) and the aggregate of the y axis column of the
+        chart's table.
+        """
+        table = self.datasource.tables[self.table_name]
+        x_column, y_aggr = queries.aggregate_columns(table, str(self.x_axis), str(self.y_axis),
+                                                     str(self.aggr_func_name))
+        return self._bucketed(x_column), y_aggr
+
+    def _orm_columns(self):
+        """Returns the x axis column (or its time bucket) and the aggregate of the y axis column of the
+        chart's mapped (ORM) class.
+        """
         aggr_func = getattr(sqlalchemy.func, str(self.aggr_func_name))
         table_base = self.datasource.bases[self.table_name]
+        x_column = self._bucketed(getattr(table_base, str(self.x_axis)))
+        y_aggr = aggr_func(getattr(table_base, str(self.y_axis)))
+        return x_column, y_aggr
+
+    def _extra_core_aggregates(self):
+        """Returns the aggregates of the extra series of the chart, on the columns of the chart's table."""
+        table = self.datasource.tables[self.table_name]
+        return [queries.aggregate(table.c[y_axis], aggr_func_name)
+                for y_axis, aggr_func_name in self.extra_measures]
+
+    def _extra_orm_aggregates(self):
+        """Returns the aggregates of the extra series of the chart, on the chart's mapped (ORM) class."""
+        table_base = self.datasource.bases[self.table_name]
+        return [queries.aggregate(getattr(table_base, y_axis), aggr_func_name)
+                for y_axis, aggr_func_name in self.extra_measures]
+
+    def _query_column_chart_data(self, preflight=True):
+        """Runs the aggregate query of the chart and returns the ``(x, aggr_func(y))`` rows. The values of
+        the extra series (see ``extra_measures``), if any, follow ``aggr_func(y)`` in every row.
+
+        If there are more categories than ``effective_category_limit``, only the top categories (by
+        aggregate) are returned, followed by an ``OTHER_CATEGORY`` row that aggregates all the rest. Both the
+        top-N selection and the aggregate of the rest are computed by the database, so the size of the result
+        doesn't depend on the size of the table.
+
+        The query is built with SQLAlchemy Core (see ``queries``), unless ``CHART_QUERY_MODE`` is ``'orm'``.
+        Charts in ``ROLLUP`` execution mode read their rollup instead, as long as it is up to date. Unless
+        ``preflight`` is False, the cost of the query is checked first (see ``_preflight()``). Identical
+        queries running at the same time share one execution (see ``singleflight``).
+        """
+        if self.execution_mode == queries.ROLLUP:
+            rows = rollups.read(self)
+            if rows is not None:
+                return rows
+        elif self.execution_mode == queries.IN_PROCESS:
+            return self._aggregate_in_process()
+        rows = self._preflight() if preflight else None
+        if rows is not None:
+            return rows
+        return singleflight.flights.call(self.query_flight_key, self._query_live_column_chart_data)
+
+    def query_flight_key(self):
+        """Returns the key under which identical aggregate queries are coalesced (see ``singleflight``): the
+        datasource's database, the compiled SQL and the category limit.
+        """
+        x_column, y_aggr = self._core_columns()
+        statement = queries.grouped(x_column, y_aggr, *self._extra_core_aggregates())
+        datasource = self.datasource
+        return singleflight.make_key(datasource.connection_key, statement, datasource.engine.dialect,
+                                     self.effective_category_limit, self.OTHER_CATEGORY)
+
+    def _query_live_column_chart_data(self):
+        """Runs the aggregate query of the chart on the datasource. See ``_query_column_chart_data()``."""
+        if settings.CHART_QUERY_MODE == queries.ORM:
+            # The result may be shared through the cache. Plain tuples pickle more reliably than named ones.
+            return [tuple(row) for row in self._query_column_chart_data_orm()]
+        x_column, y_aggr = self._core_columns()
+        extra_aggrs = self._extra_core_aggregates()
+        try:
+            with self.datasource.guarded_connection() as connection:
+                return queries.fetch_aggregate(connection, x_column, y_aggr, self.effective_category_limit,
+                                               self.OTHER_CATEGORY, extra_aggrs)
+        except sqlalchemy.exc.OperationalError:
+            raise ChartCreationError
+
+    def _preflight(self):
+        """Checks the estimated cost of the aggregate query of the chart against the row budget of its
+        datasource and records the estimate (see ``costs``). Returns None if the query may run, or the rows to
+        plot instead of its result (from a sample or from the rollup).
+
+        Raises ``QueryOverBudgetError`` if the query is refused and ``ChartQueuedError`` if it was queued to
+        run in the background. Samples and rollups only have the main series of the chart.
+        """
+        budget = self.datasource.effective_query_row_budget
+        if not budget:
+            return None
+        return self._apply_estimate(self._estimate(), budget)
+
+    def _estimate(self, blocking=False):
+        """Returns the ``costs.Estimate`` of the aggregate query of the chart. Only reads the datasource, so
+        it can run on the query pool once the table of the chart is loaded. See ``guarded_connection()`` for
+        ``blocking``.
+        """
+        x_column, y_aggr = self._core_columns()
+        table = self.datasource.tables[self.table_name]
+        try:
+            with self.datasource.guarded_connection(blocking) as connection:
+                return costs.explain(connection, queries.grouped(x_column, y_aggr), table)
+        except sqlalchemy.exc.OperationalError:
+            raise ChartCreationError
+
+    def _apply_estimate(self, estimate, budget, blocking=False):
+        """The rest of ``_preflight()``, once the query is estimated."""
+        over_budget = costs.is_over_budget(estimate, budget)
+        action = self.datasource.over_budget_action if over_budget else None
+        self._record_estimate(estimate, over_budget, action)
+        if not over_budget:
+            return None
+        if action == costs.SAMPLE:
+            rows = [row[:2] for row in self._sample_column_chart_data(blocking).rows]
+            # Approximate numbers. They are not cached as the data of the chart.
+            self._sampled = True
+            return rows
+        if action == costs.ROLLUP:
+            rows = rollups.read(self)
+            if rows is not None:
+                return rows
+            concurrency.submit_background(('rollup', self.pk), _refresh_rollup_in_background, self.pk)
+            raise ChartQueuedError('The rollup of the chart is being built. Reload the page in a bit.')
+        if action == costs.BACKGROUND and self.data_cache_timeout:
+            # The result reaches the next requests through the cache.
+            concurrency.submit_background(('chart', self.data_cache_key), _query_in_background, self.pk)
+            raise ChartQueuedError('The chart is being computed in the background. Reload the page in a bit.')
+        raise QueryOverBudgetError('The query would read about %d rows, more than this datasource allows '
+                                   '(%d).' % (estimate.rows, budget))
+
+    def _record_estimate(self, estimate, over_budget, action):
+        fields = {'estimated_rows': estimate.rows, 'uses_index': estimate.uses_index, 'plan': estimate.plan,
+                  'over_budget': over_budget, 'action': action, 'time_estimated': timezone.now()}
+        if not ChartQueryEstimate.objects.filter(chart=self).update(**fields):
+            ChartQueryEstimate.objects.create(chart=self, **fields)
+
+    def _aggregate_in_process(self, blocking=False):
+        """Same as ``_query_column_chart_data`` but reads the x and y columns of all the rows of the table
+        (``IN_PROCESS_BATCH_SIZE`` rows at a time) and aggregates them in Python. See ``kernels``.
+
+        If ``blocking`` is True, waits for a slot of the datasource rather than failing when all are taken.
+        """
+        table = self.datasource.tables[self.table_name]
+        # The time buckets are still computed by the database, row by row.
+        columns = [self._bucketed(table.c[str(self.x_axis)]), table.c[str(self.y_axis)]]
         try:
-            return session.query(getattr(table_base, str(self.x_axis)),
-                             aggr_func(getattr(table_base, str(self.y_axis))))\
-                          .group_by(getattr(table_base, str(self.x_axis)))\
-                          .order_by(getattr(table_base, str(self.x_axis))).all()
+            with self.datasource.guarded_connection(blocking) as connection:
+                result = connection.execution_options(stream_results=True).execute(sqlalchemy.select(columns))
+                partials = kernels.aggregate(result, settings.IN_PROCESS_BATCH_SIZE)
         except sqlalchemy.exc.OperationalError:
             raise ChartCreationError
+        return kernels.finalize(partials, str(self.aggr_func_name), self.effective_category_limit,
+                                self.OTHER_CATEGORY)
+
+    def _query_column_chart_data_orm(self):
+        """Same as ``_query_column_chart_data`` but goes through the ORM (``session.query``)."""
+        x_column, y_aggr = self._orm_columns()
+        extra_aggrs = self._extra_orm_aggregates()
+        limit = self.effective_category_limit
+        try:
+            with self.datasource.guarded_connection() as connection:
+                session = sessions.open_session(connection)
+                try:
+                    query = session.query(x_column, y_aggr, *extra_aggrs).group_by(x_column)
+                    if not limit:
+                        return query.order_by(x_column).all()
+                    # Fetch one extra row to find out if there are more categories than the limit.
+                    top = query.order_by(y_aggr.desc(), x_column).limit(limit + 1).all()
+                    if len(top) <= limit:
+                        # Everything fits. Keep the usual order.
+                        return sorted(top, key=lambda row: row[0])
+                    top = top[:limit]
+                    top_categories = [row[0] for row in top if row[0] is not None]
+                    rest = x_column.notin_(top_categories)
+                    if len(top_categories) == len(top):
+                        # NULL NOT IN (...) is NULL, not true. Rows without a category belong to the rest too.
+                        rest = sqlalchemy.or_(rest, x_column.is_(None))
+                    other = session.query(y_aggr, *extra_aggrs).filter(rest).first()
+                    return top + [(self.OTHER_CATEGORY,) + tuple(other)]
+                finally:
+                    sessions.close(session)
+        except sqlalchemy.exc.OperationalError:
+            raise ChartCreationError
+
+    def _get_column_chart_data_entry(self):
+        """Returns a ``(version, rows)`` tuple where ``rows`` are the ``(x, aggr_func(y))`` rows of the chart
+        and ``version`` is a digest of the rows.
+
+        The entry is cached (see ``cache_timeout``) so that viewing a chart doesn't re-run the aggregate on
+        the customer's database every time. It is also remembered for the lifetime of the instance, so that
+        the query runs at most once per request even if caching is disabled.
+        """
+        key = self.data_cache_key
+        memo = getattr(self, '_data_entry_memo', None)
+        if memo is not None and memo[0] == key:
+            return memo[1]
+        entry = cache.get(key) if self.data_cache_timeout else None
+        if entry is not None:
+            caching.record_hit()
+            self._remember_data_entry(entry)
+            return entry
+        if self.data_cache_timeout:
+            caching.record_miss()
+        return self._store_column_chart_data(self._query_column_chart_data())
+
+    def _remember_data_entry(self, entry):
+        self._data_entry_memo = (self.data_cache_key, entry)
+
+    def _store_column_chart_data(self, rows):
+        """Caches ``rows`` as the data of the chart and returns the ``(version, rows)`` entry. Used when the
+        rows were queried some other way (e.g. by the dashboard). The gaps between the time buckets of the
+        rows, if any, are filled first. Rows of a sample (see ``data_is_sampled``) are only remembered by the
+        instance, so that the next request runs the cost check again rather than serve them as exact.
+        """
+        # Plain tuples pickle smaller (and more reliably) than the ORM's named tuples.
+        rows = [tuple(row) for row in rows]
+        if self.x_bucket and rows:
+            rows = self._fill_gaps(rows)
+        entry = (caching.data_version(rows), rows)
+        if self.data_cache_timeout and not self.data_is_sampled:
+            cache.set(self.data_cache_key, entry, self.data_cache_timeout)
+        self._remember_data_entry(entry)
+        return entry
+
+    def _fill_gaps(self, rows):
+        """Adds the time buckets the rows don't have (see ``buckets.fill_gaps``). Counts and sums of the
+        missing buckets are 0, the other aggregates are null.
+        """
+        aggr_func_names = [str(self.aggr_func_name)] + [aggr_func_name for _y_axis, aggr_func_name
+                                                        in self.extra_measures]
+        fills = [0 if aggr_func_name in ('count', 'sum') else None for aggr_func_name in aggr_func_names]
+        # Rows from a sample or a rollup only have the main series.
+        return buckets.fill_gaps(rows, str(self.x_bucket), fills[:len(rows[0]) - 1],
+                                 settings.TIME_BUCKET_MAX_BUCKETS)
+
+    def _get_column_chart_data(self):
+        """Returns the ``(x, aggr_func(y))`` rows of the chart."""
+        return self._get_column_chart_data_entry()[1]
+
+    @property
+    def data_is_sampled(self):
+        """Returns True if the data of the chart was computed from a sample of the rows, because the query was
+        over budget (see ``costs.SAMPLE``). Such data is plotted as a sample.
+        """
+        return getattr(self, '_sampled', False)
+
+    @property
+    def _series_name(self):
+        name = '%s(%s)' % (str(self.aggr_func_name), str(self.y_axis))
+        return name + ' (sample)' if self.data_is_sampled else name
+
+    @property
+    def streams_data(self):
+        """Returns True if the rows of the chart are streamed from the database rather than loaded (and
+        cached) all at once. Charts with a category limit (or not in LIVE execution mode) have a small result
+        and are loaded. So are charts with extra series or time buckets (one row per bucket, the gaps filled).
+        """
+        return not (self.effective_category_limit or self.execution_mode != queries.LIVE or
+                    self.extra_measures or self.x_bucket)
+
+    def _iter_column_chart_data(self):
+        """Returns an iterator over the ``(x, aggr_func(y))`` rows of the chart. The query is executed right
+        away, but the rows are not all loaded in memory.
+
+        Unless the chart ``streams_data``, the rows go through ``_get_column_chart_data()`` (and its cache).
+        Otherwise cached rows are served from the cache, and if there are none the rows are streamed from a
+        server side cursor, ``CHART_STREAM_BATCH_SIZE`` at a time. Streamed rows are not cached.
+        """
+        if not self.streams_data:
+            return iter(self._get_column_chart_data())
+        entry = cache.get(self.data_cache_key) if self.data_cache_timeout else None
+        if entry is not None:
+            caching.record_hit()
+            return iter(entry[1])
+        rows = self._preflight()
+        if rows is not None:
+            return iter(rows)
+        if settings.CHART_QUERY_MODE == queries.ORM:
+            x_column, y_aggr = self._orm_columns()
+        else:
+            x_column, y_aggr = self._core_columns()
+        # The connection (and the slot of the datasource) is held until all the rows are read.
+        guard = self.datasource.guarded_connection()
+        connection = guard.__enter__()
+        session = None
+        try:
+            if settings.CHART_QUERY_MODE == queries.ORM:
+                session = sessions.open_session(connection)
+                query = session.query(x_column, y_aggr).group_by(x_column).order_by(x_column)
+                # yield_per() asks the driver for a server side cursor (stream_results) as well.
+                rows = iter(query.yield_per(settings.CHART_STREAM_BATCH_SIZE))
+            else:
+                rows = iter(queries.iter_aggregate(connection, x_column, y_aggr))
+        except Exception as e:
+            if session is not None:
+                sessions.close(session)
+            # Gives the connection back. Raises QueryTimeoutError if the query was cancelled.
+            guard.__exit__(type(e), e, None)
+            if isinstance(e, sqlalchemy.exc.OperationalError):
+                raise ChartCreationError
+            raise e
+        return _guarded_rows(guard, rows, session)
+
+    @property
+    def column_chart_etag(self):
+        """Returns a strong ETag for the chart. It changes whenever the configuration of the chart (including
+        its cache timeout and category limit), the introspected schema of its datasource or the chart data (or
+        whether it is a sample) changes.
+        """
+        version, _rows = self._get_column_chart_data_entry()
+        return caching.make_key('', self.pk, self.name, self.datasource.time_introspected, self.table_name,
+                                self.x_axis, self.x_bucket, self.y_axis, self.aggr_func_name,
+                                self.extra_measures, self.cache_timeout, self.effective_category_limit,
+                                self.data_is_sampled, version)
 
     def _plot_column_chart(self):
+        """Returns the Highcharts options of the chart as a JSON string. The string is cached under the
+        ``column_chart_etag`` of the chart, so it is rendered only once for every version of the data.
+        """
+        key = caching.make_key(caching.OPTIONS_KEY_PREFIX, self.column_chart_etag)
+        options = cache.get(key)
+        if options is not None:
+            return options
         data = self._get_column_chart_data()
-        categories, series = zip(*data)
+        with instrumentation.stage('render'):
+            columns = zip(*data)
+        categories, series = columns[:2]
         title = self.name
-        x_axis_title, y_axis_title = str(self.x_axis), str(self.y_axis)
-        series_name = '%s(%s)' % (str(self.aggr_func_name), str(self.y_axis))
+        x_axis_title = str(self.x_axis)
+        series_name = self._series_name
+        # Rows from a sample or a rollup only have the main series.
+        extra = zip(self.extra_measures, columns[2:])
+        extra_series = [('%s(%s)' % (aggr_func_name, y_axis), values)
+                        for (y_axis, aggr_func_name), values in extra]
+        y_axes = [str(self.y_axis)] + [y_axis for (y_axis, _aggr_func_name), _values in extra]
+        y_axis_title = ', '.join(OrderedDict.fromkeys(y_axes))
+        try:
+            with instrumentation.stage('render'):
+                options = render_highcharts_options('chartchemy_chart', categories, series,
+                                                    title, x_axis_title, y_axis_title,
+                                                    series_name, extra_series)
+        except UnicodeDecodeError:
+            raise ChartCreationError
+        if self.data_cache_timeout:
+            cache.set(key, options, self.data_cache_timeout)
+        return options
+
+    def _sample_column_chart_data(self, blocking=False):
+        """Returns the ``sampling.Sample`` of the estimated data of the chart."""
+        table = self.datasource.tables[self.table_name]
+        try:
+            with self.datasource.guarded_connection(blocking, settings.PREVIEW_QUERY_TIMEOUT) as connection:
+                return sampling.preview(connection, table, str(self.x_axis), str(self.y_axis),
+                                        str(self.aggr_func_name), settings.PREVIEW_SAMPLE_SIZE,
+                                        self.effective_category_limit, self.OTHER_CATEGORY,
+                                        str(self.x_bucket) if self.x_bucket else None)
+        except sqlalchemy.exc.OperationalError:
+            raise ChartCreationError
+
+    def _preview_column_chart(self):
+        """Returns the Highcharts options of a preview of the chart (see ``sampling``) and the
+        ``sampling.Sample`` they were computed from. Nothing is cached: the axes of the chart are being edited
+        and haven't been saved.
+        """
+        sample = self._sample_column_chart_data()
+        if not sample.rows:
+            raise ChartCreationError('The table is empty.')
+        categories = [row[0] for row in sample.rows]
+        series = [row[1] for row in sample.rows]
+        series_name = '%s(%s) (preview)' % (str(self.aggr_func_name), str(self.y_axis))
         try:
-            return render_highcharts_options('chartchemy_chart', categories, series,
-                                             title, x_axis_title, y_axis_title,
-                                             series_name)
+            with instrumentation.stage('render'):
+                options = render_highcharts_options('chartchemy_chart', categories, series, self.name,
+                                                    str(self.x_axis), str(self.y_axis), series_name)
         except UnicodeDecodeError:
             raise ChartCreationError
+        return options, sample
+
+    def _stream_column_chart(self, on_error=None):
+        """Returns an iterator over the chunks of the Highcharts options of the chart (a JSON string). The
+        chunks are produced while the rows are read from the database.
+
+        The first batch of rows is read right away, so that the errors of the query are raised here rather
+        than once the response has started. ``on_error`` handles the errors of the later batches (see
+        ``utils.iter_highcharts_options``).
+
+        The series of a chart with extra series are separate lists, they can't be written in one pass over the
+        rows. Such a chart is plotted as usual (see ``_plot_column_chart()``), in one chunk.
+
+        See Also: _iter_column_chart_data(), utils.iter_highcharts_options()
+        """
+        if self.extra_measures:
+            return iter([self._plot_column_chart()])
+        batch_size = settings.CHART_STREAM_BATCH_SIZE
+        rows = self._iter_column_chart_data()
+        rows = chain(list(islice(rows, batch_size)), rows)
+        # After the rows: the cost check may have sampled them.
+        return iter_highcharts_options('chartchemy_chart', rows, self.name, str(self.x_axis),
+                                       str(self.y_axis), self._series_name, batch_size, on_error)
+
+
+def _query_in_background(chart_pk):
+    """Runs the aggregate query of the chart identified by ``chart_pk``, skipping the cost check, and caches
+    the result.
+    """
+    try:
+        chart = Chart.objects.select_related('datasource').get(pk=chart_pk)
+        chart._store_column_chart_data(chart._query_column_chart_data(preflight=False))
+    except Chart.DoesNotExist:
+        pass
+    except Exception:
+        logger.exception('Background query of chart %s failed', chart_pk)
+    finally:
+        sessions.remove()
+        close_connection()
+
+
+def _refresh_rollup_in_background(chart_pk):
+    try:
+        rollups.refresh(Chart.objects.select_related('datasource').get(pk=chart_pk))
+    except Chart.DoesNotExist:
+        pass
+    except Exception:
+        logger.exception('Background refresh of the rollup of chart %s failed', chart_pk)
+    finally:
+        sessions.remove()
+        close_connection()
+
+
+class ChartQueryEstimate(models.Model):
+    """The last pre-flight estimate of the cost of the aggregate query of a chart. See ``costs``."""
+    chart = models.OneToOneField(Chart)
+    estimated_rows = models.BigIntegerField()
+    uses_index = models.BooleanField(default=False)
+    # The plan as the database returned it, JSON.
+    plan = models.TextField(null=True)
+    over_budget = models.BooleanField(default=False)
+    # What was done about a query over budget (costs.OVER_BUDGET_ACTION_CHOICES).
+    action = models.CharField(max_length=10, choices=costs.OVER_BUDGET_ACTION_CHOICES, null=True)
+    time_estimated = models.DateTimeField()
+
+    def __unicode__(self):
+        return u'Estimate of %s' % self.chart
+
+
+class ChartRollup(models.Model):
+    """The state of the rollup (pre-aggregated data) of a chart. See ``rollups``."""
+    chart = models.OneToOneField(Chart)
+    # rollups.signature() of the chart when the rollup was built.
+    signature = models.CharField(max_length=32, null=True)
+    # JSON encoded greatest value of the chart's rollup_key_column aggregated so far.
+    watermark = models.TextField(null=True)
+    time_refreshed = models.DateTimeField(null=True)
+
+    def __unicode__(self):
+        return u'Rollup of %s' % self.chart
+
 
+class ChartRollupRow(models.Model):
+    """The partial aggregates of the y axis column of a chart for one category (x axis value)."""
+    rollup = models.ForeignKey(ChartRollup)
+    category = models.TextField(null=True)
+    # JSON encoded [sum, count, min, max].
+    partials = models.TextField()
@@ -0,0 +1,139 @@
+"""Statistics of the tables of a datasource, collected by an optional pass of the introspection.
+
+The profile of a table says how many rows it has (as estimated by the database, see
+``sampling.estimated_row_count``) and, for every column, whether it is indexed (it is the first column of an
+index or of the primary key) and, for the dimensions, roughly how many distinct values it has. Distinct
+counts come from the index statistics of the database where it keeps them (MySQL). The other columns are
+counted with a HyperLogLog sketch over the first ``PROFILE_MAX_ROWS`` rows, so their counts are lower bounds
+for bigger tables.
+
+A chart that groups a big table by an unindexed column, or by one with many distinct values, is expensive.
+``axis_warnings`` says so, and ``ColumnChartAxesForm`` shows the warnings.
+"""
+import hashlib
+import math
+
+import sqlalchemy
+from django.conf import settings
+
+import sampling
+
+
+class HyperLogLog(object):
+    """Estimates the number of distinct values added to it with ``2 ** p`` small counters. The standard error
+    is about ``1.04 / sqrt(2 ** p)``, 1.6% for the default ``p``.
+    """
+
+    def __init__(self, p=12):
+        self.p = p
+        self.m = 1 << p
+        self.registers = [0] * self.m
+
+    def add(self, value):
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        digest = int(hashlib.sha1(str(value)).hexdigest()[:16], 16)
+        index, rest = digest >> (64 - self.p), digest & ((1 << (64 - self.p)) - 1)
+        # Position of the leftmost 1 bit of the remaining 64 - p bits.
+        rank = 64 - self.p - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def count(self):
+        alpha = 0.7213 / (1 + 1.079 / self.m)
+        estimate = alpha * self.m * self.m / sum(2.0 ** -register for register in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * self.m and zeros:
+            # Small range correction (linear counting).
+            estimate = self.m * math.log(self.m / float(zeros))
+        return int(round(estimate))
+
+
+def _indexed_columns(inspector, table):
+    """Returns the names of the columns of ``table`` that are the first column of an index or of the primary
+    key.
+    """
+    names = set(index['column_names'][0] for index in inspector.get_indexes(table.name)
+                if index['column_names'])
+    primary_key = [column.name for column in table.primary_key.columns]
+    if primary_key:
+        names.add(primary_key[0])
+    return names
+
+
+def _index_cardinalities(connection, table):
+    """Returns the distinct counts of the first columns of the indexes of ``table`` kept by the database."""
+    if connection.dialect.name != 'mysql':
+        return {}
+    rows = connection.execute(sqlalchemy.text('SELECT column_name, MAX(cardinality) '
+                                              'FROM information_schema.statistics '
+                                              'WHERE table_schema = DATABASE() AND table_name = :name '
+                                              'AND seq_in_index = 1 GROUP BY column_name'), name=table.name)
+    return dict((name, int(cardinality)) for name, cardinality in rows if cardinality is not None)
+
+
+def _distinct_counts(connection, columns, max_rows):
+    """Counts the distinct values of ``columns`` (of the same table) in the first ``max_rows`` rows."""
+    sketches = [HyperLogLog() for _column in columns]
+    result = connection.execution_options(stream_results=True)\
+                       .execute(sqlalchemy.select(columns).limit(max_rows))
+    while True:
+        rows = result.fetchmany(10000)
+        if not rows:
+            break
+        for row in rows:
+            for sketch, value in zip(sketches, row):
+                if value is not None:
+                    sketch.add(value)
+    return dict((column.name, sketch.count()) for column, sketch in zip(columns, sketches))
+
+
+def profile_table(connection, inspector, table, dimensions):
+    """Returns the profile of ``table``, a dict::
+
+        {'rows': 1200000, 'columns': {'id': {'indexed': True}, 'region': {'indexed': False, 'distinct': 12}}}
+
+    Only the ``dimensions`` (names of columns) get a distinct count.
+    """
+    indexed = _indexed_columns(inspector, table)
+    rows = sampling.estimated_row_count(connection, table)
+    distinct = _index_cardinalities(connection, table)
+    uncounted = [table.c[name] for name in dimensions if name not in distinct]
+    if uncounted and rows:
+        distinct.update(_distinct_counts(connection, uncounted, settings.PROFILE_MAX_ROWS))
+    columns = {}
+    for column in table.columns:
+        columns[column.name] = {'indexed': column.name in indexed}
+        if column.name in dimensions:
+            columns[column.name]['distinct'] = distinct.get(column.name, 0)
+    return {'rows': rows, 'columns': columns}
+
+
+def axis_warnings(profile, x_axis):
+    """Returns the list of reasons why grouping the table of ``profile`` (None if it wasn't profiled) by the
+    ``x_axis`` column is expensive.
+    """
+    if not profile or x_axis not in profile['columns']:
+        return []
+    warnings = []
+    rows, column = profile['rows'], profile['columns'][x_axis]
+    if rows >= settings.PROFILE_LARGE_TABLE_ROWS and not column['indexed']:
+        warnings.append('%s is not indexed. Grouping the %d rows of the table by it scans the whole table.' %
+                        (x_axis, rows))
+    if column.get('distinct', 0) >= settings.PROFILE_MANY_CATEGORIES:
+        warnings.append('%s has about %d distinct values. Only the top categories can be plotted.' %
+                        (x_axis, column['distinct']))
+    return warnings
+
+
+def describe_column(profile, name):
+    """Returns a short description of the ``name`` column of the table of ``profile`` (e.g. ``'indexed, ~12
+    values'``), or an empty string.
+    """
+    if not profile or name not in profile['columns']:
+        return ''
+    column = profile['columns'][name]
+    parts = ['indexed' if column['indexed'] else 'not indexed']
+    if 'distinct' in column:
+        parts.append('~%d values' % column['distinct'])
+    return ', '.join(parts)
@@ -0,0 +1,106 @@
+"""The aggregate queries of the charts, built with SQLAlchemy Core.
+
+A column chart is a ``SELECT x, aggr(y) FROM table GROUP BY x``. A chart with extra series (more measures or
+aggregates against the same x axis) adds their aggregates to the same SELECT, so all its series cost one
+scan of the table. Going through the ORM (``session.query`` on
+the classes in ``mappers.cache``) adds mapper configuration, the identity map and ORM row processing to every
+query, and none of them is of any use for rows that are just pairs of values. The functions here work
+directly on the columns of the introspected ``Table`` and return plain tuples.
+"""
+import sqlalchemy
+
+CORE, ORM = 'core', 'orm'
+
+# Execution modes of the charts. LIVE charts run their aggregate query on the datasource. ROLLUP charts read
+# their pre-aggregated data (see ``rollups``). IN_PROCESS charts read the x and y columns and aggregate them
+# in Python (see ``kernels``), for databases where GROUP BY queries are too slow or not allowed.
+LIVE, ROLLUP, IN_PROCESS = 'live', 'rollup', 'in_process'
+EXECUTION_MODE_CHOICES = ((LIVE, 'Query the datasource'), (ROLLUP, 'Read the rollup'),
+                          (IN_PROCESS, 'Aggregate in process'))
+
+
+def aggregate(column, aggr_func_name):
+    """Returns the ``aggr_func_name`` aggregate of ``column``."""
+    return getattr(sqlalchemy.func, aggr_func_name)(column)
+
+
+def aggregate_columns(table, x_axis, y_axis, aggr_func_name):
+    """Returns the ``x_axis`` column of ``table`` and the ``aggr_func_name`` aggregate of its ``y_axis``
+    column.
+    """
+    return table.c[x_axis], aggregate(table.c[y_axis], aggr_func_name)
+
+
+def grouped(x_column, y_aggr, *extra_aggrs):
+    """Returns the ``SELECT x, aggr(y), extra_aggr_1, ... GROUP BY x`` statement."""
+    return sqlalchemy.select([x_column, y_aggr] + list(extra_aggrs)).group_by(x_column)
+
+
+def fetch_aggregate(connectable, x_column, y_aggr, limit=0, other_category='Other', extra_aggrs=()):
+    """Runs the aggregate query on ``connectable`` (an engine or a connection) and returns the list of
+    ``(x, aggr(y))`` tuples, ordered by x. The values of the ``extra_aggrs`` aggregates, if any, follow
+    ``aggr(y)`` in every tuple.
+
+    If ``limit`` is not 0 and there are more categories than ``limit``, only the top categories (by
+    aggregate) are returned, followed by an ``other_category`` row that aggregates all the rest. The top
+    categories are picked by ``y_aggr``.
+    """
+    statement = grouped(x_column, y_aggr, *extra_aggrs)
+    if not limit:
+        return [tuple(row) for row in connectable.execute(statement.order_by(x_column))]
+    # Fetch one extra row to find out if there are more categories than the limit.
+    top = [tuple(row) for row in connectable.execute(statement.order_by(y_aggr.desc(), x_column)
+                                                              .limit(limit + 1))]
+    if len(top) <= limit:
+        # Everything fits. Keep the usual order.
+        return sorted(top, key=lambda row: row[0])
+    top = top[:limit]
+    return top + [(other_category,) + _other(connectable, x_column, [y_aggr] + list(extra_aggrs), top)]
+
+
+def _other(connectable, x_column, aggrs, top):
+    """Returns the tuple of the ``aggrs`` of all the categories but the ``top`` ones."""
+    top_categories = [row[0] for row in top if row[0] is not None]
+    rest = x_column.notin_(top_categories)
+    if len(top_categories) == len(top):
+        # NULL NOT IN (...) is NULL, not true. Rows without a category belong to the rest too.
+        rest = sqlalchemy.or_(rest, x_column.is_(None))
+    return tuple(connectable.execute(sqlalchemy.select(aggrs).where(rest)).first())
+
+
+def fetch_merged(connectable, x_column, aggregates, max_categories):
+    """Runs one ``SELECT x, aggr_1(y_1), ..., aggr_n(y_n) ... GROUP BY x`` for several aggregates of the same
+    table and returns the rows ordered by x. Returns None if there are more than ``max_categories``
+    categories.
+    """
+    statement = sqlalchemy.select([x_column] + list(aggregates)).group_by(x_column).order_by(x_column)
+    rows = [tuple(row) for row in connectable.execute(statement.limit(max_categories + 1))]
+    return rows if len(rows) <= max_categories else None
+
+
+def top_order(row):
+    """Sort key of ``(x, aggr(y), ...)`` rows for ``ORDER BY aggr DESC, x``. Like in MySQL and SQLite, NULL
+    sorts before anything else.
+    """
+    category, value = row[:2]
+    return value is None, -value if value is not None else 0, category is not None, category
+
+
+def top_categories(connectable, x_column, y_aggr, rows, limit=0, other_category='Other', extra_aggrs=()):
+    """Same as ``fetch_aggregate``, but the ``(x, aggr(y), ...)`` rows of all the categories are already
+    known (e.g. from ``fetch_merged``). Picks the top categories in Python and only runs the aggregates of
+    the other categories on the database.
+    """
+    if not limit or len(rows) <= limit:
+        return sorted(rows, key=lambda row: row[0])
+    top = sorted(rows, key=top_order)[:limit]
+    return top + [(other_category,) + _other(connectable, x_column, [y_aggr] + list(extra_aggrs), top)]
+
+
+def iter_aggregate(connectable, x_column, y_aggr):
+    """Runs the aggregate query on ``connectable`` with a server side cursor and returns the result, an
+    iterator over the ``(x, aggr(y))`` rows ordered by x. If ``connectable`` is an engine, the connection
+    goes back to the pool once all the rows are read.
+    """
+    statement = grouped(x_column, y_aggr).order_by(x_column)
+    return connectable.execution_options(stream_results=True).execute(statement)
@@ -0,0 +1,144 @@
+"""Pre-aggregated chart data ("rollups") kept in the Django db.
+
+The rollup of a chart has one ``ChartRollupRow`` per category (x axis value) that holds the partial
+aggregates ``[sum, count, min, max]`` of the y axis column. Any of the aggregate functions of the charts can
+be computed from them (see ``kernels``), for a single category or for several merged ones (the ``Other``
+category), without going back to the customer's database. So a chart in ``queries.ROLLUP`` execution mode
+reads a few rows from the Django db instead of scanning the source table.
+
+Rollups are rebuilt by the ``refresh_rollups`` management command, meant to be run from cron. It refreshes
+the rollups of the ``ROLLUP`` charts and the ones built for ``LIVE`` charts sent to their rollup by the cost
+check (see ``costs``). If the chart
+has a ``rollup_key_column`` (a column that only grows, e.g. an auto increment id or a creation timestamp),
+only the rows with a key greater than the one seen by the last refresh are aggregated and merged into the
+rollup. That assumes rows are appended, never updated or deleted. Without a key column, or when the chart
+changes, the rollup is rebuilt from scratch.
+"""
+import datetime
+import hashlib
+
+import simplejson
+import sqlalchemy
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+import buckets
+import kernels
+
+
+def signature(chart):
+    """Returns a digest of the parameters of ``chart`` its rollup depends on. The rollup is rebuilt from
+    scratch when they change.
+    """
+    parts = (chart.datasource_id, chart.table_name, chart.x_axis, chart.y_axis, chart.rollup_key_column)
+    if chart.x_bucket:
+        # Appended, so that the signatures of the rollups of the other charts don't change.
+        parts += (chart.x_bucket,)
+    return hashlib.md5(repr(parts)).hexdigest()
+
+
+def _encode_value(value):
+    # Watermarks are numbers or dates.
+    if isinstance(value, datetime.datetime):
+        return simplejson.dumps({'datetime': value.isoformat()})
+    if isinstance(value, datetime.date):
+        return simplejson.dumps({'date': value.isoformat()})
+    return simplejson.dumps(value, use_decimal=True)
+
+
+def _decode_value(document):
+    value = simplejson.loads(document, use_decimal=True)
+    if isinstance(value, dict):
+        if 'datetime' in value:
+            return parse_datetime(value['datetime'])
+        return parse_date(value['date'])
+    return value
+
+
+def read(chart):
+    """Returns the ``(x, aggr_func(y))`` rows of ``chart`` computed from its rollup (with the top categories
+    and the ``Other`` category, see ``Chart._query_column_chart_data``), or None if the chart has no up to
+    date rollup.
+    """
+    from models import ChartRollup
+
+    try:
+        rollup = chart.chartrollup
+    except ChartRollup.DoesNotExist:
+        return None
+    if rollup.signature != signature(chart) or rollup.time_refreshed is None:
+        return None
+    partials = dict((category, simplejson.loads(document, use_decimal=True))
+                    for category, document in rollup.chartrolluprow_set.values_list('category', 'partials'))
+    return kernels.finalize(partials, str(chart.aggr_func_name), chart.effective_category_limit,
+                            chart.OTHER_CATEGORY)
+
+
+def _query_partials(connection, table, chart, watermark):
+    """Returns the ``(x, [sum, count, min, max])`` partials of the rows of ``table`` with a key greater than
+    ``watermark`` (all the rows if it is None), and the greatest key among them.
+    """
+    x_column, y_column = table.c[str(chart.x_axis)], table.c[str(chart.y_axis)]
+    if chart.x_bucket:
+        x_column = buckets.bucket(x_column, str(chart.x_bucket))
+    columns = [x_column, sqlalchemy.func.sum(y_column), sqlalchemy.func.count(y_column),
+               sqlalchemy.func.min(y_column), sqlalchemy.func.max(y_column)]
+    key_column = table.c[str(chart.rollup_key_column)] if chart.rollup_key_column else None
+    if key_column is not None:
+        # Computed by the same statement, so it is consistent with the partials.
+        columns.append(sqlalchemy.func.max(key_column))
+    statement = sqlalchemy.select(columns).group_by(x_column)
+    if key_column is not None and watermark is not None:
+        statement = statement.where(key_column > watermark)
+    partials, new_watermark = {}, watermark
+    for row in connection.execute(statement):
+        partials[row[0]] = list(row[1:5])
+        key = row[5] if key_column is not None else None
+        if key is not None and (new_watermark is None or key > new_watermark):
+            new_watermark = key
+    return partials, new_watermark
+
+
+def refresh(chart, full=False):
+    """Brings the rollup of ``chart`` up to date, incrementally if it can. Returns the number of categories
+    that were added or changed.
+    """
+    from models import ChartRollup, ChartRollupRow
+
+    rollup, _created = ChartRollup.objects.get_or_create(chart=chart)
+    sig = signature(chart)
+    incremental = not full and chart.rollup_key_column and rollup.signature == sig and rollup.watermark
+    watermark = _decode_value(rollup.watermark) if incremental else None
+    table = chart.datasource.tables[chart.table_name]
+    # Rollups scan the source table. They get their own (usually longer) time limit.
+    guard = chart.datasource.guarded_connection(blocking=True, timeout=settings.ROLLUP_QUERY_TIMEOUT)
+    with guard as connection:
+        partials, watermark = _query_partials(connection, table, chart, watermark)
+
+    with transaction.commit_on_success():
+        if not incremental:
+            rollup.chartrolluprow_set.all().delete()
+            ChartRollupRow.objects.bulk_create([ChartRollupRow(rollup=rollup, category=category,
+                                                               partials=simplejson.dumps(p, use_decimal=True))
+                                                for category, p in partials.items()])
+        else:
+            existing = dict((row.category, row) for row in rollup.chartrolluprow_set.all())
+            new_rows = []
+            for category, p in partials.items():
+                row = existing.get(category)
+                if row is None:
+                    new_rows.append(ChartRollupRow(rollup=rollup, category=category,
+                                                   partials=simplejson.dumps(p, use_decimal=True)))
+                else:
+                    merged = kernels.merge(simplejson.loads(row.partials, use_decimal=True), p)
+                    row.partials = simplejson.dumps(merged, use_decimal=True)
+                    row.save(update_fields=['partials'])
+            ChartRollupRow.objects.bulk_create(new_rows)
+        rollup.signature = sig
+        rollup.watermark = _encode_value(watermark) if watermark is not None else None
+        rollup.time_refreshed = timezone.now()
+        rollup.save()
+    chart.invalidate_data_cache()
+    return len(partials)
@@ -0,0 +1,178 @@
+"""Approximate chart data computed from a sample of the rows of a table, for previews.
+
+While the axes of a chart are being picked, the aggregate over the whole table is too slow to wait for. A
+preview reads at most ``PREVIEW_SAMPLE_SIZE`` rows instead and scales the aggregates up. The sample is taken
+with ``TABLESAMPLE`` where the database has it (PostgreSQL), otherwise with a random range of an integer
+primary key (which reads a slice of the index), otherwise with a plain ``LIMIT``.
+
+Along with every estimate comes the half width of its 95% confidence interval. The intervals assume the
+rows were sampled at random, which is only true of ``TABLESAMPLE``. Key ranges and ``LIMIT`` read rows that
+are next to each other, so their bounds mean nothing and aren't shown to the user. Min and max have no
+bounds: the sample can only miss the extremes.
+"""
+import math
+import random
+from collections import namedtuple
+
+import sqlalchemy
+
+import buckets
+import queries
+
+TABLESAMPLE, KEY_RANGE, LIMIT, FULL = 'tablesample', 'key range', 'limit', 'full'
+
+# z of the 95% confidence intervals.
+Z = 1.96
+
+# ``rows`` are ``(x, estimate, bound)`` tuples, ``fraction`` the fraction of the rows of the table that were
+# read and ``method`` how they were sampled.
+Sample = namedtuple('Sample', 'rows fraction method')
+
+
+def estimated_row_count(connection, table):
+    """Returns the number of rows of ``table``, as estimated by the database's statistics where it keeps
+    them (counting the rows of a big table takes as long as aggregating them).
+    """
+    dialect = connection.dialect.name
+    count = None
+    if dialect == 'postgresql':
+        count = connection.scalar(sqlalchemy.text('SELECT reltuples FROM pg_class '
+                                                  'WHERE oid = CAST(:name AS regclass)'), name=table.name)
+    elif dialect == 'mysql':
+        count = connection.scalar(sqlalchemy.text('SELECT table_rows FROM information_schema.tables '
+                                                  'WHERE table_schema = DATABASE() AND table_name = :name'),
+                                  name=table.name)
+    if not count or count < 0:
+        # No statistics (or never analyzed).
+        count = connection.scalar(sqlalchemy.select([sqlalchemy.func.count()]).select_from(table))
+    return int(count)
+
+
+def _integer_key(table):
+    key = list(table.primary_key.columns)
+    if len(key) == 1 and isinstance(key[0].type, sqlalchemy.Integer):
+        return key[0]
+    return None
+
+
+def sample_rows(connection, table, columns, size):
+    """Returns a sample of about ``size`` rows of the ``columns`` of ``table``, the fraction of the rows of
+    the table it holds and the sampling method.
+    """
+    total = estimated_row_count(connection, table)
+    statement = sqlalchemy.select(columns)
+    if total <= size:
+        # The statistics may be out of date. Never read more than the sample would.
+        rows = connection.execute(statement.limit(size + 1)).fetchall()
+        if len(rows) <= size:
+            return rows, 1.0, FULL
+        total = connection.scalar(sqlalchemy.select([sqlalchemy.func.count()]).select_from(table))
+    key = _integer_key(table)
+    if connection.dialect.name == 'postgresql':
+        method = TABLESAMPLE
+        sampled = table.tablesample(sqlalchemy.func.bernoulli(100.0 * size / total))
+        statement = sqlalchemy.select([sampled.c[column.name] for column in columns])
+    elif key is not None:
+        method = KEY_RANGE
+        low, high = connection.execute(sqlalchemy.select([sqlalchemy.func.min(key),
+                                                          sqlalchemy.func.max(key)])).first()
+        if low is None:
+            # The statistics are out of date, the table is empty.
+            return [], 0.0, method
+        # Keys have gaps. Assume they are spread evenly.
+        width = max(int((high - low + 1) * float(size) / total), 1)
+        start = random.randint(low, max(high - width + 1, low))
+        statement = statement.where(sqlalchemy.and_(key >= start, key < start + width))
+    else:
+        method = LIMIT
+        statement = statement.limit(size)
+    rows = connection.execute(statement).fetchall()
+    return rows, min(len(rows) / float(total), 1.0), method
+
+
+def _stats(rows):
+    """Returns the ``{x: [count, sum, sum of squares, min, max]}`` of the y values of the ``(x, y)`` rows.
+    NULL y values are ignored.
+    """
+    stats = {}
+    for category, value in rows:
+        s = stats.setdefault(category, [0, 0.0, 0.0, None, None])
+        if value is None:
+            continue
+        value = float(value)
+        s[0] += 1
+        s[1] += value
+        s[2] += value * value
+        s[3] = value if s[3] is None else min(s[3], value)
+        s[4] = value if s[4] is None else max(s[4], value)
+    return stats
+
+
+def _merge(a, b):
+    pick = lambda x, y, func: y if x is None else x if y is None else func(x, y)
+    return [a[0] + b[0], a[1] + b[1], a[2] + b[2], pick(a[3], b[3], min), pick(a[4], b[4], max)]
+
+
+def estimate(aggr_func_name, stats, fraction):
+    """Returns the estimate of the ``aggr_func_name`` aggregate over the whole table from the ``[count, sum,
+    sum of squares, min, max]`` stats of the sample, and the half width of its 95% confidence interval (None
+    if there is none).
+    """
+    count, sum_, squares, min_, max_ = stats
+    # Finite population correction. The bounds of an exact result are 0.
+    correction = 1.0 - fraction
+    if aggr_func_name == 'count':
+        return count / fraction, Z * math.sqrt(count * correction) / fraction
+    if aggr_func_name == 'sum':
+        if not count:
+            return None, None
+        return sum_ / fraction, Z * math.sqrt(squares * correction) / fraction
+    if aggr_func_name == 'avg':
+        if not count:
+            return None, None
+        mean = sum_ / count
+        if count == 1:
+            return mean, None if correction else 0.0
+        variance = max(squares - count * mean * mean, 0.0) / (count - 1)
+        return mean, Z * math.sqrt(variance / count * correction)
+    value = min_ if aggr_func_name == 'min' else max_
+    return value, None if correction else 0.0
+
+
+def largest_relative_bound(sample):
+    """Returns the largest bound of the estimates of ``sample`` relative to the estimate, None if some of them
+    have no bound.
+    """
+    largest = 0.0
+    for _category, value, bound in sample.rows:
+        if value is None:
+            continue
+        if bound is None:
+            return None
+        if bound:
+            largest = max(largest, bound / abs(value)) if value else float('inf')
+    return largest
+
+
+def preview(connection, table, x_axis, y_axis, aggr_func_name, size, limit=0, other_category='Other',
+            x_bucket=None):
+    """Returns the ``Sample`` of the estimated ``(x, aggr_func(y), bound)`` rows of the chart. Like
+    ``queries.fetch_aggregate``, they are ordered by x, or the top ``limit`` categories are followed by an
+    ``other_category`` row that aggregates all the rest. If ``x_bucket`` is set, x is the label of the time
+    bucket of the ``x_axis`` value (see ``buckets``).
+    """
+    rows, fraction, method = sample_rows(connection, table, [table.c[x_axis], table.c[y_axis]], size)
+    if x_bucket:
+        rows = [(buckets.label(x, x_bucket), y) for x, y in rows]
+    stats = _stats(rows)
+    if not stats:
+        return Sample([], fraction, method)
+    estimates = dict((category, estimate(aggr_func_name, s, fraction)) for category, s in stats.items())
+    rows = [(category, value, bound) for category, (value, bound) in estimates.items()]
+    if not limit or len(rows) <= limit:
+        return Sample(sorted(rows, key=lambda row: row[0]), fraction, method)
+    top = sorted(rows, key=lambda row: queries.top_order(row[:2]))[:limit]
+    top_categories = set(row[0] for row in top)
+    rest = reduce(_merge, [s for category, s in stats.items() if category not in top_categories])
+    value, bound = estimate(aggr_func_name, rest, fraction)
+    return Sample(top + [(other_category, value, bound)], fraction, method)
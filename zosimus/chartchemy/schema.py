@@ -0,0 +1,83 @@
+"""Compact, versioned serialization of the structure of introspected tables.
+
+A table is stored as a small JSON document::
+
+    {"v": 1, "name": "orders", "columns": [["id", "INTEGER", {}, false, true],
+                                           ["region", "VARCHAR", {"length": 20}, true, false]]}
+
+Every column is a ``[name, type, type arguments, nullable, primary key]`` list. The type is the name of the
+generic SQLAlchemy type the (possibly dialect specific) type of the column derives from. Unlike pickled Table
+objects, the documents don't depend on the version of SQLAlchemy that wrote them, and the columns can be read
+without building a Table object at all.
+"""
+import inspect
+
+import simplejson
+import sqlalchemy
+from sqlalchemy import types
+
+FORMAT_VERSION = 1
+
+# Type arguments worth keeping. Only the ones the constructor of the generic type accepts are stored.
+_TYPE_ARGS = ('length', 'precision', 'scale', 'asdecimal', 'timezone')
+
+
+def _generic_type(type_):
+    """Returns the name of the generic SQLAlchemy type ``type_`` derives from and its constructor arguments.
+    """
+    for klass in type(type_).__mro__:
+        if getattr(types, klass.__name__, None) is klass:
+            break
+    else:
+        return 'NullType', {}
+    try:
+        accepted = inspect.getargspec(klass.__init__).args
+    except TypeError:
+        accepted = []
+    args = dict((arg, getattr(type_, arg)) for arg in _TYPE_ARGS
+                if arg in accepted and getattr(type_, arg, None) is not None)
+    return klass.__name__, args
+
+
+def dumps(table):
+    """Returns the JSON document describing the columns and the primary key of ``table``."""
+    columns = []
+    for column in table.columns:
+        type_name, type_args = _generic_type(column.type)
+        columns.append([column.name, type_name, type_args, column.nullable, column.primary_key])
+    return simplejson.dumps({'v': FORMAT_VERSION, 'name': table.name, 'columns': columns},
+                            separators=(',', ':'))
+
+
+def _parse(document):
+    data = simplejson.loads(document)
+    if data.get('v') != FORMAT_VERSION:
+        raise ValueError("Unsupported schema format version: %r" % data.get('v'))
+    return data
+
+
+def load_columns(document):
+    """Returns the list of ``(name, type name, type arguments, nullable, primary key)`` tuples of the table
+    described by ``document``. Doesn't build any SQLAlchemy objects.
+    """
+    return [tuple(column) for column in _parse(document)['columns']]
+
+
+def _build_type(type_name, type_args):
+    klass = getattr(types, type_name, types.NullType)
+    try:
+        return klass(**type_args)
+    except TypeError:
+        return klass()
+
+
+def loads(document, metadata=None):
+    """Builds a ``sqlalchemy.schema.Table`` object from ``document``. Every table gets its own MetaData,
+    unless one is passed.
+    """
+    data = _parse(document)
+    columns = [sqlalchemy.Column(column_name, _build_type(type_name, type_args), nullable=nullable,
+                                 primary_key=primary_key)
+               for column_name, type_name, type_args, nullable, primary_key in data['columns']]
+    return sqlalchemy.Table(data['name'], metadata if metadata is not None else sqlalchemy.MetaData(),
+                            *columns)
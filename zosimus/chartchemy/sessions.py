@@ -0,0 +1,115 @@
+"""Request scoped SQLAlchemy sessions on the datasources.
+
+``Datasource.session`` used to create a session per ``Datasource`` instance and never close it, so every
+request that used one left a connection checked out of the pool (and its identity map in memory) until the
+instance was garbage collected. Now the sessions come from ``registry``: one per datasource (engine) and per
+thread, made by a shared ``sessionmaker``. ``SessionCleanupMiddleware`` (see ``middleware``) closes the
+sessions of the thread at the end of every request, which returns their connections to the pool. Code that
+runs outside a request (background threads, management commands) calls ``remove()`` itself.
+
+The chart queries bind their sessions to the connection of their ``QueryGuard`` instead, which outlives no
+query. They get them from ``open_session()`` and give them to ``close()`` when the rows are read.
+
+``stats()`` counts the sessions open and the connections checked out of all the pools of the process, to
+confirm that nothing leaks. The metrics view reports them.
+"""
+import threading
+
+from sqlalchemy import event, orm
+from sqlalchemy.pool import Pool
+
+_Session = orm.sessionmaker()
+
+
+class _Counters(object):
+    def __init__(self):
+        self.open_sessions = 0
+        self.checked_out_connections = 0
+        self.lock = threading.Lock()
+
+    def add(self, name, n):
+        with self.lock:
+            setattr(self, name, getattr(self, name) + n)
+
+
+counters = _Counters()
+
+
+class SessionRegistry(object):
+    """The sessions of every thread, keyed by the ``connection_key`` of their datasource. Like a
+    ``scoped_session``, but with one session per engine rather than one per thread.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def _sessions(self):
+        try:
+            return self._local.sessions
+        except AttributeError:
+            self._local.sessions = {}
+            return self._local.sessions
+
+    def get(self, key, engine):
+        """Returns the session of the current thread on ``engine``, the engine of the datasources identified
+        by ``key``. Creates it the first time.
+        """
+        sessions = self._sessions()
+        session = sessions.get(key)
+        if session is not None and session.bind is not engine:
+            # The engine was replaced (see engines.EngineRegistry.invalidate).
+            close(sessions.pop(key))
+            session = None
+        if session is None:
+            session = sessions[key] = open_session(engine)
+        return session
+
+    def remove(self):
+        """Closes the sessions of the current thread. Their connections go back to the pool."""
+        sessions = self._sessions()
+        while sessions:
+            _key, session = sessions.popitem()
+            close(session)
+
+    def __len__(self):
+        """Returns the number of sessions of the current thread."""
+        return len(self._sessions())
+
+
+registry = SessionRegistry()
+
+
+def open_session(bind):
+    """Returns a new session on ``bind`` (an engine or a connection). It must be given to ``close()``."""
+    session = _Session(bind=bind)
+    counters.add('open_sessions', 1)
+    return session
+
+
+def close(session):
+    try:
+        session.close()
+    finally:
+        counters.add('open_sessions', -1)
+
+
+def remove():
+    """Closes the sessions of the current thread. See ``SessionRegistry.remove()``."""
+    registry.remove()
+
+
+@event.listens_for(Pool, 'checkout')
+def _checkout(dbapi_connection, connection_record, connection_proxy):
+    counters.add('checked_out_connections', 1)
+
+
+@event.listens_for(Pool, 'checkin')
+def _checkin(dbapi_connection, connection_record):
+    counters.add('checked_out_connections', -1)
+
+
+def stats():
+    """Returns the number of sessions open and of connections checked out in the process."""
+    with counters.lock:
+        return {'open_sessions': counters.open_sessions,
+                'checked_out_connections': counters.checked_out_connections}
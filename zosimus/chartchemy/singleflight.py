@@ -0,0 +1,151 @@
+"""Coalescing of identical chart queries that run at the same time ("single flight").
+
+When a popular chart is opened by many people at once (or a dashboard on a wall refreshes on a timer), every
+request misses the chart data cache at the same moment and runs the same aggregate query on the customer's
+database. Instead, the first request (the leader) runs the query and the others wait for its result.
+
+The queries are identified by ``make_key``: the connection parameters of the datasource and the compiled
+SQL. Charts that compile to the same SQL share one execution, whatever chart they are.
+
+``SINGLE_FLIGHT`` says how far the coalescing goes:
+
+* ``PROCESS``: the threads of a process wait for the one running the query (``SingleFlight``).
+* ``CACHE``: the leaders of the processes (e.g. the uWSGI workers) also coordinate through a lock in the
+  default cache. The one that takes the lock runs the query and publishes the result in the cache, the others
+  poll for it every ``SINGLE_FLIGHT_POLL_INTERVAL`` seconds. This needs a cache shared by the processes
+  (memcached). With a per-process cache (locmem, the default) it only adds round trips to the cache.
+
+Waiters give up after ``SINGLE_FLIGHT_TIMEOUT`` seconds and run the query themselves. So do the processes
+waiting on a leader that failed or whose result didn't fit in the cache. An error of the leader is raised in
+the threads of its process that waited for it, not in other processes.
+"""
+import hashlib
+import threading
+import time
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+
+import instrumentation
+
+PROCESS, CACHE = 'process', 'cache'
+
+LOCK_KEY_PREFIX = 'chartchemy:flight:lock:'
+RESULT_KEY_PREFIX = 'chartchemy:flight:result:'
+
+
+def normalized_sql(statement, dialect):
+    """Returns the SQL of ``statement`` compiled for ``dialect``, with its whitespace collapsed, and its
+    parameters.
+    """
+    compiled = statement.compile(dialect=dialect)
+    return u' '.join(unicode(compiled).split()), sorted(compiled.params.items())
+
+
+def make_key(connection_key, statement, dialect, *parts):
+    """Returns the key of the query ``statement`` on the database identified by ``connection_key`` (see
+    ``Datasource.connection_key``). ``parts`` are whatever else changes the result (e.g. the category limit).
+    """
+    sql, params = normalized_sql(statement, dialect)
+    digest = hashlib.md5()
+    for part in (connection_key, sql, params) + parts:
+        digest.update(repr(part))
+        digest.update('\0')
+    return digest.hexdigest()
+
+
+class _Flight(object):
+    """A query being run by the leader, and its outcome."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = self.error = None
+
+
+class SingleFlight(object):
+    """The queries being run in the process, by key."""
+
+    def __init__(self):
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def call(self, key_func, func, *args):
+        """Returns ``func(*args)``. If a call with the same key (``key_func()``) is running already, waits for
+        it and returns (or raises) its outcome instead. The key is only computed if coalescing is on.
+        """
+        mode = settings.SINGLE_FLIGHT
+        if not mode:
+            return func(*args)
+        key = key_func()
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+        if not leader:
+            with instrumentation.stage('coalesced'):
+                done = flight.done.wait(settings.SINGLE_FLIGHT_TIMEOUT)
+            if not done:
+                return func(*args)
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+        try:
+            if mode == CACHE:
+                flight.result = _call_shared(key, func, args)
+            else:
+                flight.result = func(*args)
+            return flight.result
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+    def in_flight(self):
+        """Returns the number of calls running now."""
+        with self._lock:
+            return len(self._flights)
+
+
+flights = SingleFlight()
+
+
+def _call_shared(key, func, args):
+    """Returns ``func(*args)``, or the result of the process that holds the cache lock of ``key``."""
+    lock_key = LOCK_KEY_PREFIX + key
+    timeout = settings.SINGLE_FLIGHT_TIMEOUT
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        token = uuid.uuid4().hex
+        if cache.add(lock_key, token, timeout):
+            return _lead(lock_key, token, timeout, func, args)
+        owner = cache.get(lock_key)
+        with instrumentation.stage('coalesced'):
+            while owner is not None and time.time() < deadline:
+                time.sleep(settings.SINGLE_FLIGHT_POLL_INTERVAL)
+                # The result is published before the lock is released, so the lock is read first.
+                current = cache.get(lock_key)
+                entry = cache.get(RESULT_KEY_PREFIX + owner)
+                if entry is not None:
+                    return entry[0]
+                if current != owner:
+                    # The owner failed. Someone takes over.
+                    break
+    return func(*args)
+
+
+def _lead(lock_key, token, timeout, func, args):
+    try:
+        result = func(*args)
+        # Wrapped in a tuple so that a None result can be told from a missing one. The result is only read by
+        # the processes that saw ``token``, so it can't be served to a request that comes later.
+        cache.set(RESULT_KEY_PREFIX + token, (result,), timeout)
+        return result
+    finally:
+        # The lock may have expired (and been taken by another process) if func() took longer than timeout.
+        if cache.get(lock_key) == token:
+            cache.delete(lock_key)
@@ -1,5 +1,106 @@
-// jQuery function to create a chart for each of the HighCharts Chart Options
-// JSON object (_chartchemy_hco) passed to web page from the view.
+// jQuery function to create the charts of the page.
+// A chart whose HighCharts Chart Options were computed with the page (a preview) is passed in a JSON object
+// (_chartchemy_hco). The options of the other charts are fetched once the page is shown, and only when the
+// chart scrolls into view:
+// - an element with a data-chart-src attribute gets the options at that URL.
+// - the elements with a data-chart-pk attribute inside a data-chart-batch-src element (the dashboard) get
+//   theirs from that URL, ?charts=<pk>,<pk>,... for all the charts that came into view at the same time, so
+//   that their queries can be merged.
+// A chart that is being computed in the background (202), or whose datasource is busy (503), is asked for
+// again after the number of seconds its answer says (retry_after, or the Retry-After header).
 $(document).ready(function() {
-		chart = new Highcharts.Chart(_chartchemy_hco);
-});
\ No newline at end of file
+		if (typeof _chartchemy_hco !== 'undefined') {
+			chart = new Highcharts.Chart(_chartchemy_hco);
+		}
+
+		// Charts this many pixels below the fold are loaded too.
+		var margin = 200;
+
+		function plot(element, hco) {
+			if (hco.retry_after) {
+				$(element).html($('<div class="alert alert-info"></div>').text(hco.detail || 'Loading...'));
+				setTimeout(function() {
+					// Loaded again by the next pass, if it is still in view.
+					$(element).removeClass('chartchemy-loading');
+					loadVisible();
+				}, hco.retry_after * 1000);
+				return;
+			}
+			if (hco.error) {
+				$(element).html($('<div class="alert alert-error"></div>')
+						.text('Uh Oh! Error creating chart! ' + (hco.detail || '')));
+				return;
+			}
+			hco.chart.renderTo = element;
+			new Highcharts.Chart(hco);
+		}
+
+		function failed(element) {
+			return function(xhr) {
+				var hco = {error: true};
+				try {
+					hco = $.parseJSON(xhr.responseText) || hco;
+				} catch (e) {}
+				if (xhr.status === 503 && !hco.retry_after) {
+					hco.retry_after = parseInt(xhr.getResponseHeader('Retry-After'), 10) || 0;
+				}
+				plot(element, hco);
+			};
+		}
+
+		function inView(element) {
+			var top = $(element).offset().top;
+			var $window = $(window);
+			return top < $window.scrollTop() + $window.height() + margin &&
+					top + $(element).outerHeight() > $window.scrollTop() - margin;
+		}
+
+		function loadVisible() {
+			$('[data-chart-src]').not('.chartchemy-loading').filter(function() {
+				return inView(this);
+			}).each(function() {
+				var element = this;
+				$(element).addClass('chartchemy-loading');
+				$.ajax({url: $(element).data('chart-src'), dataType: 'json'})
+						.done(function(hco) { plot(element, hco); })
+						.fail(failed(element));
+			});
+			$('[data-chart-batch-src]').each(function() {
+				var elements = {};
+				var pks = [];
+				$(this).find('[data-chart-pk]').not('.chartchemy-loading').filter(function() {
+					return inView(this);
+				}).each(function() {
+					var pk = $(this).data('chart-pk');
+					$(this).addClass('chartchemy-loading');
+					elements[pk] = this;
+					pks.push(pk);
+				});
+				if (!pks.length) {
+					return;
+				}
+				$.ajax({url: $(this).data('chart-batch-src'), data: {charts: pks.join(',')}, dataType: 'json'})
+						.done(function(hcos) {
+							$.each(elements, function(pk, element) {
+								plot(element, hcos[pk] || {error: true});
+							});
+						})
+						.fail(function(xhr) {
+							$.each(elements, function(pk, element) {
+								failed(element)(xhr);
+							});
+						});
+			});
+		}
+
+		var scheduled = null;
+		$(window).on('scroll resize', function() {
+			if (scheduled === null) {
+				scheduled = setTimeout(function() {
+					scheduled = null;
+					loadVisible();
+				}, 100);
+			}
+		});
+		loadVisible();
+});
@@ -9,5 +9,8 @@ register = template.Library()
 
 @register.filter
 def load_chart(hco):
+    if not hco:
+        # The options are fetched by chartloader.js instead.
+        return ''
     embed_script = '<script type="text/javascript">\nvar _chartchemy_hco = %s;\n</script>\n' % hco
     return mark_safe(embed_script)
@@ -5,7 +5,37 @@ when you run "manage.py test".
 Replace this with more appropriate tests for your application.
 """
 
+import base64
+import datetime
+import logging
+import pickle
+import threading
+import time
+from decimal import Decimal
+from StringIO import StringIO
+
+import simplejson
+import sqlalchemy
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.http import HttpResponse
 from django.test import TestCase
+from django.test.utils import override_settings
+from django.utils import timezone
+from sqlalchemy.pool import QueuePool, StaticPool
+
+from zosimus.chartchemy import (buckets, caching, concurrency, costs, instrumentation, introspection, kernels,
+                                profiling, queries, rollups, sampling, schema, sessions, singleflight, utils,
+                                views)
+from zosimus.chartchemy.dashboard import load_charts
+from zosimus.chartchemy.engines import EngineRegistry
+from zosimus.chartchemy.exceptions import (ChartQueuedError, DatasourceBusyError, QueryOverBudgetError,
+                                           QueryTimeoutError)
+from zosimus.chartchemy.forms import ChartTableForm, ColumnChartAxesForm
+from zosimus.chartchemy.mappers import MapperCache
+from zosimus.chartchemy.middleware import SessionCleanupMiddleware
+from zosimus.chartchemy.models import Datasource, DatasourceTable, Chart
 
 
 class SimpleTest(TestCase):
@@ -14,3 +44,1414 @@ class SimpleTest(TestCase):
         Tests that 1 + 1 always equals 2.
         """
         self.assertEqual(1 + 1, 2)
+
+
+class EngineRegistryTest(TestCase):
+    def setUp(self):
+        self.registry = EngineRegistry(max_engines=2)
+
+    def tearDown(self):
+        self.registry.clear()
+
+    def test_same_key_shares_engine(self):
+        a = self.registry.get('a', 'sqlite://')
+        self.assertIs(self.registry.get('a', 'sqlite://'), a)
+        self.assertIsNot(self.registry.get('b', 'sqlite://'), a)
+
+    def test_evicts_least_recently_used(self):
+        a = self.registry.get('a', 'sqlite://')
+        self.registry.get('b', 'sqlite://')
+        self.registry.get('a', 'sqlite://')
+        self.registry.get('c', 'sqlite://')
+        self.assertIn('a', self.registry)
+        self.assertNotIn('b', self.registry)
+        self.assertIs(self.registry.get('a', 'sqlite://'), a)
+
+    def test_busy_engines_are_not_evicted(self):
+        a = self.registry.get('a', 'sqlite:///:memory:', poolclass=QueuePool)
+        conn = a.connect()
+        try:
+            self.registry.get('b', 'sqlite://')
+            self.registry.get('c', 'sqlite://')
+            self.assertIn('a', self.registry)
+            self.assertNotIn('b', self.registry)
+        finally:
+            conn.close()
+
+    def test_grows_when_all_engines_are_busy(self):
+        connections = [self.registry.get(key, 'sqlite:///:memory:', poolclass=QueuePool).connect()
+                       for key in ('a', 'b')]
+        try:
+            c = self.registry.get('c', 'sqlite://')
+            self.assertEqual(len(self.registry), 3)
+            self.assertIn('c', self.registry)
+            self.assertIs(self.registry.get('c', 'sqlite://'), c)
+        finally:
+            for conn in connections:
+                conn.close()
+
+    def test_invalidate(self):
+        a = self.registry.get('a', 'sqlite://')
+        self.registry.invalidate('a')
+        self.assertNotIn('a', self.registry)
+        self.assertIsNot(self.registry.get('a', 'sqlite://'), a)
+
+
+class MapperCacheTest(TestCase):
+    def setUp(self):
+        self.cache = MapperCache(max_size=2)
+        self.metadata = sqlalchemy.MetaData()
+        self.tables = dict((name, sqlalchemy.Table(name, self.metadata,
+                                                   sqlalchemy.Column('id', sqlalchemy.Integer, primary_key=True)))
+                           for name in ('customers', 'orders', 'items'))
+
+    def get(self, fingerprint, table_name):
+        return self.cache.get(fingerprint, table_name, lambda: self.tables[table_name])
+
+    def test_classes_are_shared(self):
+        klass = self.get('abc', 'customers')
+        self.assertEqual(klass.__name__, 'BaseCustomers')
+        self.assertIs(self.get('abc', 'customers'), klass)
+        self.assertIs(sqlalchemy.orm.class_mapper(klass).local_table, self.tables['customers'])
+
+    def test_bounded(self):
+        self.get('abc', 'customers')
+        self.get('abc', 'orders')
+        self.get('abc', 'customers')
+        self.get('abc', 'items')
+        self.assertEqual(len(self.cache), 2)
+        self.assertIn(('abc', 'customers'), self.cache)
+        self.assertNotIn(('abc', 'orders'), self.cache)
+
+    def test_invalidate(self):
+        self.get('abc', 'customers')
+        self.get('xyz', 'customers')
+        self.cache.invalidate('abc')
+        self.assertNotIn(('abc', 'customers'), self.cache)
+        self.assertIn(('xyz', 'customers'), self.cache)
+
+
+def _pickled(obj):
+    return base64.b64encode(pickle.dumps(obj))
+
+
+class SQLiteDatasourceMixin(object):
+    """Points ``Datasource.engine`` at an in-memory SQLite db with an ``orders`` and a ``customers`` table."""
+
+    def setUp(self):
+        super(SQLiteDatasourceMixin, self).setUp()
+        # One connection shared by all the threads, so that the queries run on the query pool see the db.
+        self.engine = sqlalchemy.create_engine('sqlite://', poolclass=StaticPool,
+                                               connect_args={'check_same_thread': False})
+        self.metadata = sqlalchemy.MetaData()
+        self.orders = sqlalchemy.Table('orders', self.metadata,
+                                       sqlalchemy.Column('id', sqlalchemy.Integer, primary_key=True),
+                                       sqlalchemy.Column('region', sqlalchemy.String(20)),
+                                       sqlalchemy.Column('revenue', sqlalchemy.Integer))
+        sqlalchemy.Table('customers', self.metadata,
+                         sqlalchemy.Column('id', sqlalchemy.Integer, primary_key=True),
+                         sqlalchemy.Column('name', sqlalchemy.String(20)))
+        self.metadata.create_all(self.engine)
+        self.engine.execute(self.orders.insert(), [{'region': u'east', 'revenue': 4},
+                                                   {'region': u'east', 'revenue': 6},
+                                                   {'region': u'west', 'revenue': 20}])
+        self._engine_property = Datasource.engine
+        Datasource.engine = property(lambda ds: self.engine)
+
+    def tearDown(self):
+        Datasource.engine = self._engine_property
+        super(SQLiteDatasourceMixin, self).tearDown()
+
+
+class ChartTestMixin(SQLiteDatasourceMixin):
+    """Creates an introspected datasource and a chart on the ``orders`` table."""
+
+    def setUp(self):
+        super(ChartTestMixin, self).setUp()
+        cache.clear()
+        self.user = User.objects.create_user('chartchemy', 'chartchemy@example.com', 'secret')
+        # bulk_create() doesn't send the signals that introspect the db.
+        Datasource.objects.bulk_create([Datasource(user=self.user, name='shop', dbtype='MYSQL',
+                                                   dbname='shop', dbusername='u', dbpassword='p',
+                                                   dbhost='localhost', time_introspected=timezone.now(),
+                                                   introspection_status=introspection.DONE)])
+        self.datasource = Datasource.objects.get(name='shop')
+        self.datasource._pickle_all()
+        self.chart = Chart.objects.create(user=self.user, name='Revenue', datasource=self.datasource,
+                                          table_name='orders', x_axis='region', y_axis='revenue',
+                                          aggr_func_name='sum')
+        self.queries = []
+        self.stub_query(self.chart)
+
+    def stub_query(self, chart, rows=((u'east', 10), (u'west', 20))):
+        def query():
+            self.queries.append(chart.data_cache_key)
+            return list(rows)
+        chart._query_column_chart_data = query
+        return chart
+
+    def reload_chart(self):
+        """Returns a new instance of the chart, as a new request would see it."""
+        return self.stub_query(Chart.objects.get(pk=self.chart.pk))
+
+
+class ChartDataCacheTest(ChartTestMixin, TestCase):
+    def test_data_is_cached(self):
+        caching.reset_stats()
+        self.assertEqual(self.chart._get_column_chart_data(), [(u'east', 10), (u'west', 20)])
+        self.assertEqual(self.reload_chart()._get_column_chart_data(), [(u'east', 10), (u'west', 20)])
+        self.assertEqual(len(self.queries), 1)
+        self.assertEqual(caching.stats(), {'hits': 1, 'misses': 1})
+
+    def test_zero_timeout_disables_cache(self):
+        Chart.objects.filter(pk=self.chart.pk).update(cache_timeout=0)
+        self.reload_chart()._get_column_chart_data()
+        chart = self.reload_chart()
+        chart._get_column_chart_data()
+        chart._plot_column_chart()
+        self.assertEqual(len(self.queries), 2)
+
+    def test_key_depends_on_axes(self):
+        key = self.chart.data_cache_key
+        self.chart.aggr_func_name = 'avg'
+        self.assertNotEqual(self.chart.data_cache_key, key)
+
+    def test_saving_table_form_invalidates(self):
+        self.chart._get_column_chart_data()
+        key = self.chart.data_cache_key
+        form = ChartTableForm({'table_name': 'customers'}, instance=self.chart)
+        self.assertTrue(form.is_valid())
+        form.save()
+        self.assertIsNone(cache.get(key))
+
+
+class ChartDataConditionalGetTest(ChartTestMixin, TestCase):
+    def setUp(self):
+        super(ChartDataConditionalGetTest, self).setUp()
+        # The view loads its own chart instance. Stub the query on the class.
+        self._query = Chart._query_column_chart_data
+        Chart._query_column_chart_data = lambda chart: [(u'east', 10), (u'west', 20)]
+        self.client.login(username='chartchemy', password='secret')
+        self.url = '/charts/%d/data/' % self.chart.pk
+
+    def tearDown(self):
+        Chart._query_column_chart_data = self._query
+        super(ChartDataConditionalGetTest, self).tearDown()
+
+    def test_page_does_not_wait_for_the_data(self):
+        Chart._query_column_chart_data = None
+        response = self.client.get('/charts/%d/' % self.chart.pk)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('class="chartchemy-chart" data-chart-src="%s"' % self.url, response.content)
+
+    def test_gzipped(self):
+        response = self.client.get(self.url, HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        response = self.client.get(self.url, HTTP_ACCEPT_ENCODING='gzip', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+    def test_not_modified(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('east', response.content)
+        etag = response['ETag']
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+    def test_settings_change_the_etag(self):
+        etag = self.client.get(self.url)['ETag']
+        for field, value in (('category_limit', 1), ('cache_timeout', 60)):
+            Chart.objects.filter(pk=self.chart.pk).update(**{field: value})
+            response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 200)
+            self.assertNotEqual(response['ETag'], etag)
+            etag = response['ETag']
+
+    def test_queued_chart_is_retried(self):
+        def queued(chart):
+            raise ChartQueuedError('The chart is being computed in the background.')
+        Chart._query_column_chart_data = queued
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response['Retry-After'], str(views.RETRY_AFTER))
+        self.assertEqual(simplejson.loads(response.content)['retry_after'], views.RETRY_AFTER)
+
+    def test_busy_datasource_is_retried(self):
+        def busy(chart):
+            raise DatasourceBusyError('Too many queries.')
+        Chart._query_column_chart_data = busy
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], str(views.RETRY_AFTER))
+
+    def test_streamed_is_private(self):
+        Chart.objects.filter(pk=self.chart.pk).update(category_limit=0)
+        response = self.client.get(self.url)
+        self.assertTrue(response.streaming)
+        self.assertIn('private', response['Cache-Control'])
+        self.assertIn('east', ''.join(response.streaming_content))
+
+    def test_etag_changes_with_data(self):
+        etag = self.client.get(self.url)['ETag']
+        Chart._query_column_chart_data = lambda chart: [(u'east', 10), (u'west', 30)]
+        cache.clear()
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+
+class InstrumentationTest(ChartTestMixin, TestCase):
+    def setUp(self):
+        super(InstrumentationTest, self).setUp()
+        instrumentation.metrics.clear()
+        self.client.login(username='chartchemy', password='secret')
+        # The chart page doesn't query the datasource, its data endpoint does.
+        self.url = '/charts/%d/data/' % self.chart.pk
+
+    def test_server_timing(self):
+        timing = self.client.get(self.url)['Server-Timing']
+        self.assertIn('render;dur=', timing)
+        self.assertIn('query;dur=', timing)
+        self.assertIn('total;dur=', timing)
+
+    def test_table_index_is_timed(self):
+        timings = instrumentation.start()
+        try:
+            Datasource.objects.get(pk=self.datasource.pk).table_names
+        finally:
+            instrumentation.finish()
+        self.assertEqual(timings.stages.keys(), ['schema'])
+
+    def test_metrics(self):
+        self.client.get(self.url)
+        self.client.get(self.url)
+        self.assertEqual(self.client.get('/metrics/').status_code, 404)
+        User.objects.filter(pk=self.user.pk).update(is_staff=True)
+        summary = simplejson.loads(self.client.get('/metrics/').content)
+        self.assertEqual(summary['charts'][str(self.chart.pk)]['count'], 2)
+        self.assertEqual(summary['datasources'][str(self.datasource.pk)]['count'], 2)
+
+    def test_slow_chart_log(self):
+        records = []
+        handler = logging.Handler()
+        handler.emit = records.append
+        handlers, instrumentation.slow_logger.handlers = instrumentation.slow_logger.handlers, [handler]
+        try:
+            with self.settings(SLOW_CHART_THRESHOLD=0.000001):
+                self.client.get(self.url)
+        finally:
+            instrumentation.slow_logger.handlers = handlers
+        entry = simplejson.loads(records[0].getMessage())
+        self.assertEqual(entry['tags'], {'chart': self.chart.pk, 'datasource': self.datasource.pk})
+        self.assertIn('query', entry['stages'])
+
+    def test_percentile(self):
+        values = range(1, 101)
+        self.assertEqual(instrumentation.percentile(values, 0.5), 50)
+        self.assertEqual(instrumentation.percentile(values, 0.95), 95)
+
+
+@override_settings(CHART_STREAM_BATCH_SIZE=2)
+class StreamingChartDataTest(ChartTestMixin, TestCase):
+    def setUp(self):
+        super(StreamingChartDataTest, self).setUp()
+        self.engine.execute(self.orders.insert(), [{'region': u'north', 'revenue': 1},
+                                                   {'region': u'<south>', 'revenue': 15}])
+        # Without a category limit the rows are streamed from the db.
+        Chart.objects.filter(pk=self.chart.pk).update(category_limit=0)
+        self._iter_rows = Chart._iter_column_chart_data
+
+    def tearDown(self):
+        Chart._iter_column_chart_data = self._iter_rows
+        super(StreamingChartDataTest, self).tearDown()
+
+    def test_streamed_options(self):
+        chart = Chart.objects.get(pk=self.chart.pk)
+        options = simplejson.loads(''.join(chart._stream_column_chart()))
+        self.assertEqual(options['series'][0]['data'],
+                         [[u'&lt;south&gt;', 15], [u'east', 10], [u'north', 1], [u'west', 20]])
+        self.assertEqual(options['chart']['renderTo'], 'chartchemy_chart')
+
+    def test_data_endpoint(self):
+        self.client.login(username='chartchemy', password='secret')
+        response = self.client.get('/charts/%d/data/' % self.chart.pk)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        options = simplejson.loads(''.join(response.streaming_content))
+        self.assertEqual(len(options['series'][0]['data']), 4)
+
+    def failing_rows(self, good_rows):
+        def iter_rows(chart):
+            for row in [(u'east', 10), (u'west', 20)][:good_rows]:
+                yield row
+            raise QueryTimeoutError('The query took longer than 1 seconds and was cancelled.')
+        Chart._iter_column_chart_data = iter_rows
+        self.client.login(username='chartchemy', password='secret')
+        return self.client.get('/charts/%d/data/' % self.chart.pk)
+
+    def test_error_in_the_first_rows(self):
+        response = self.failing_rows(1)
+        self.assertEqual(response.status_code, 500)
+        self.assertFalse(response.streaming)
+        self.assertIn('longer than 1 seconds', simplejson.loads(response.content)['detail'])
+
+    def test_error_mid_stream(self):
+        for compat in (False, True):
+            with self.settings(CHART_JSON_COMPAT=compat):
+                response = self.failing_rows(2)
+                self.assertEqual(response.status_code, 200)
+                options = simplejson.loads(''.join(response.streaming_content))
+            self.assertEqual(options['series'][0]['data'], [[u'east', 10], [u'west', 20]])
+            self.assertEqual(options['error'], 'Error creating chart')
+            self.assertIn('longer than 1 seconds', options['detail'])
+
+    def test_cached_rows_are_not_queried_again(self):
+        self.reload_chart()._get_column_chart_data()
+        self.assertEqual(list(self.reload_chart()._iter_column_chart_data()), [(u'east', 10), (u'west', 20)])
+        self.assertEqual(len(self.queries), 1)
+
+
+@override_settings(CHART_STREAM_BATCH_SIZE=2, CHART_QUERY_MODE='orm')
+class ORMStreamingChartDataTest(StreamingChartDataTest):
+    pass
+
+
+class HighchartsOptionsTest(TestCase):
+    categories = ['<b>', 'Tom & Jerry', '"quoted"', "it's", 'back\\', 'plain']
+    series = [Decimal('1.5'), 2, Decimal('0.1'), None, 3.25, Decimal('10')]
+
+    def render(self):
+        return simplejson.loads(utils.render_highcharts_options('chart', self.categories, self.series,
+                                                                'A <title>', 'x', 'y', 'sum(y)'))
+
+    def test_same_options_as_compat(self):
+        with self.settings(CHART_JSON_COMPAT=True):
+            compat = self.render()
+        self.assertEqual(self.render(), compat)
+        self.assertEqual(compat['xAxis']['categories'][:3],
+                         [u'&lt;b&gt;', u'Tom &amp; Jerry', u'&quot;quoted&quot;'])
+
+    def test_streamed_same_as_compat(self):
+        rows = zip(self.categories, self.series)
+        iter_options = lambda: simplejson.loads(''.join(utils.iter_highcharts_options(
+            'chart', rows, 'A <title>', 'x', 'y', 'sum(y)', 2)))
+        with self.settings(CHART_JSON_COMPAT=True):
+            compat = iter_options()
+        self.assertEqual(iter_options(), compat)
+
+    def test_non_ascii_is_kept(self):
+        self.categories = [u'Z\xfcrich', 'S\xc3\xa3o Paulo']
+        self.series = [1, 2]
+        self.assertEqual(self.render()['xAxis']['categories'], [u'Z\xfcrich', u'S\xe3o Paulo'])
+
+    def test_extra_series(self):
+        options = simplejson.loads(utils.render_highcharts_options('chart', ['a', 'b'], [1, 2], 'title', 'x',
+                                                                   'y', 'sum(y)',
+                                                                   [('avg(z)', [Decimal('0.5'), 3])]))
+        self.assertEqual(options['series'], [{'name': 'sum(y)', 'data': [1, 2]},
+                                             {'name': 'avg(z)', 'data': [0.5, 3]}])
+
+    def test_null_category(self):
+        self.categories = [None, 'a']
+        self.series = [1, 2]
+        with self.settings(CHART_JSON_COMPAT=True):
+            compat = self.render()
+        self.assertEqual(self.render(), compat)
+        self.assertEqual(compat['xAxis']['categories'], [u'(none)', u'a'])
+        rows = zip(self.categories, self.series)
+        for json_compat in (False, True):
+            with self.settings(CHART_JSON_COMPAT=json_compat):
+                streamed = simplejson.loads(''.join(utils.iter_highcharts_options('chart', rows, 'title', 'x',
+                                                                                  'y', 'sum(y)')))
+            self.assertEqual(streamed['series'][0]['data'], [[u'(none)', 1], [u'a', 2]])
+
+    def test_compat_categories_that_arent_ascii_strings(self):
+        self.categories = [7, datetime.date(2013, 5, 14), u'caf\xe9 <b>']
+        self.series = [1, 2, 3]
+        expected = [u'7', u'2013-05-14', u'caf\xe9 &lt;b&gt;']
+        with self.settings(CHART_JSON_COMPAT=True):
+            self.assertEqual(self.render()['xAxis']['categories'], expected)
+            streamed = simplejson.loads(''.join(utils.iter_highcharts_options(
+                'chart', zip(self.categories, self.series), 'title', 'x', 'y', 'sum(y)')))
+        self.assertEqual([category for category, _value in streamed['series'][0]['data']], expected)
+
+    def test_html_escape_json(self):
+        self.assertEqual(utils.html_escape_json(r'["a\\", "<\"b\">"]'), r'["a\\", "&lt;&quot;b&quot;&gt;"]')
+
+
+class ExtraSeriesTest(ChartTestMixin, TestCase):
+    def setUp(self):
+        super(ExtraSeriesTest, self).setUp()
+        self.chart = Chart.objects.get(pk=self.chart.pk)
+        self.chart.extra_series = '[["revenue", "avg"], ["id", "count"]]'
+        self.chart.save()
+        self.statements = []
+        sqlalchemy.event.listen(self.engine, 'before_cursor_execute', self.record_statement)
+
+    def tearDown(self):
+        sqlalchemy.event.remove(self.engine, 'before_cursor_execute', self.record_statement)
+        super(ExtraSeriesTest, self).tearDown()
+
+    def record_statement(self, conn, cursor, statement, *args):
+        self.statements.append(statement)
+
+    def test_one_query(self):
+        options = simplejson.loads(Chart.objects.get(pk=self.chart.pk)._plot_column_chart())
+        self.assertEqual(len(self.statements), 1)
+        self.assertEqual(options['series'], [{'name': 'sum(revenue)', 'data': [10, 20]},
+                                             {'name': 'avg(revenue)', 'data': [5, 20]},
+                                             {'name': 'count(id)', 'data': [2, 1]}])
+        self.assertEqual(options['yAxis']['title']['text'], 'revenue, id')
+
+    def test_streamed_in_one_chunk(self):
+        options = simplejson.loads(''.join(Chart.objects.get(pk=self.chart.pk)._stream_column_chart()))
+        self.assertEqual(len(options['series']), 3)
+
+    def test_data_cache_key(self):
+        key = self.chart.data_cache_key
+        self.chart.extra_series = None
+        self.assertNotEqual(self.chart.data_cache_key, key)
+
+    def test_form(self):
+        form = ColumnChartAxesForm(instance=self.chart)
+        self.assertEqual(form.initial['extra_series'], ['avg:revenue', 'count:id'])
+        data = {'x_axis': 'region', 'y_axis': 'revenue', 'aggr_func_name': 'sum',
+                'execution_mode': queries.LIVE, 'extra_series': ['max:revenue']}
+        form = ColumnChartAxesForm(data, instance=self.chart)
+        self.assertTrue(form.is_valid(), form.errors)
+        self.assertEqual(form.save().extra_measures, [('revenue', 'max')])
+        data['execution_mode'] = queries.ROLLUP
+        self.assertFalse(ColumnChartAxesForm(data, instance=self.chart).is_valid())
+
+
+class TimeBucketTest(ChartTestMixin, TestCase):
+    def setUp(self):
+        super(TimeBucketTest, self).setUp()
+        events = sqlalchemy.Table('events', self.metadata,
+                                  sqlalchemy.Column('id', sqlalchemy.Integer, primary_key=True),
+                                  sqlalchemy.Column('created', sqlalchemy.DateTime),
+                                  sqlalchemy.Column('amount', sqlalchemy.Integer))
+        events.create(self.engine)
+        self.engine.execute(events.insert(), [{'created': datetime.datetime(2013, 5, 14, 9, 41), 'amount': 1},
+                                              {'created': datetime.datetime(2013, 5, 14, 23, 5), 'amount': 2},
+                                              {'created': datetime.datetime(2013, 5, 16), 'amount': 4},
+                                              {'created': None, 'amount': 8}])
+        self.datasource._pickle_all()
+        self.chart = Chart.objects.create(user=self.user, name='Sales', datasource=self.datasource,
+                                          table_name='events', x_axis='created', x_bucket=buckets.DAY,
+                                          y_axis='amount', aggr_func_name='sum')
+
+    def data(self, **kwargs):
+        Chart.objects.filter(pk=self.chart.pk).update(**kwargs)
+        return Chart.objects.get(pk=self.chart.pk)._get_column_chart_data()
+
+    def test_dates_are_dimensions(self):
+        self.assertIn('created', Datasource.objects.get(pk=self.datasource.pk).dimensions['events'])
+
+    def test_buckets_and_gaps(self):
+        self.assertEqual(self.data(), [(None, 8), (u'2013-05-14', 3), ('2013-05-15', 0), (u'2013-05-16', 4)])
+        self.assertEqual(self.data(aggr_func_name='avg')[2], ('2013-05-15', None))
+        self.assertEqual(self.data(aggr_func_name='sum', x_bucket=buckets.MONTH),
+                         [(None, 8), (u'2013-05', 7)])
+
+    def test_rollup(self):
+        live = self.data(x_bucket=buckets.WEEK)
+        rollups.refresh(Chart.objects.get(pk=self.chart.pk))
+        self.assertEqual(self.data(execution_mode=queries.ROLLUP), live)
+
+    def test_preview_labels(self):
+        sample = Chart.objects.get(pk=self.chart.pk)._sample_column_chart_data()
+        self.assertEqual([row[:2] for row in sample.rows], [(None, 8), ('2013-05-14', 3), ('2013-05-16', 4)])
+
+    def test_fill_gaps(self):
+        rows = [('2012-11', 1), ('2013-02', 2)]
+        self.assertEqual(buckets.fill_gaps(rows, buckets.MONTH, [0], 10),
+                         [('2012-11', 1), ('2012-12', 0), ('2013-01', 0), ('2013-02', 2)])
+        self.assertEqual(buckets.fill_gaps(rows, buckets.MONTH, [0], 3), rows)
+        self.assertEqual(buckets.label(datetime.date(2013, 5, 19), buckets.WEEK), '2013-05-13')
+
+    def test_form_needs_a_bucket(self):
+        data = {'x_axis': 'created', 'y_axis': 'amount', 'aggr_func_name': 'sum',
+                'execution_mode': queries.LIVE}
+        chart = Chart.objects.get(pk=self.chart.pk)
+        self.assertFalse(ColumnChartAxesForm(data, instance=chart).is_valid())
+        data['x_bucket'] = buckets.HOUR
+        self.assertTrue(ColumnChartAxesForm(data, instance=chart).is_valid())
+
+    def test_form_refuses_too_many_buckets(self):
+        data = {'x_axis': 'created', 'y_axis': 'amount', 'aggr_func_name': 'sum', 'x_bucket': buckets.MINUTE,
+                'execution_mode': queries.LIVE}
+        chart = Chart.objects.get(pk=self.chart.pk)
+        # From 2013-05-14 09:41 to 2013-05-16 00:00: 38 hours and 20 minutes.
+        with self.settings(TIME_BUCKET_MAX_BUCKETS=2300):
+            self.assertTrue(ColumnChartAxesForm(data, instance=chart).is_valid())
+        with self.settings(TIME_BUCKET_MAX_BUCKETS=2299):
+            form = ColumnChartAxesForm(data, instance=chart)
+            self.assertFalse(form.is_valid())
+            self.assertIn('coarser granularity', form.non_field_errors()[0])
+            data['x_bucket'] = buckets.HOUR
+            self.assertTrue(ColumnChartAxesForm(data, instance=chart).is_valid())
+        self.assertEqual(buckets.count(datetime.date(2012, 11, 30), datetime.date(2013, 2, 1), buckets.MONTH),
+                         4)
+
+
+class DashboardTest(ChartTestMixin, TestCase):
+    def setUp(self):
+        super(DashboardTest, self).setUp()
+        self.engine.execute(self.orders.insert(), [{'region': u'north', 'revenue': 1},
+                                                   {'region': None, 'revenue': 2}])
+        for name, aggr_func_name, category_limit in (('Orders', 'count', None), ('Average', 'avg', None),
+                                                     ('Top', 'sum', 1)):
+            Chart.objects.create(user=self.user, name=name, datasource=self.datasource, table_name='orders',
+                                 x_axis='region', y_axis='revenue', aggr_func_name=aggr_func_name,
+                                 category_limit=category_limit)
+        self.statements = []
+        sqlalchemy.event.listen(self.engine, 'before_cursor_execute', self.record_statement)
+
+    def tearDown(self):
+        sqlalchemy.event.remove(self.engine, 'before_cursor_execute', self.record_statement)
+        super(DashboardTest, self).tearDown()
+
+    def record_statement(self, conn, cursor, statement, *args):
+        self.statements.append(statement)
+
+    def test_merged_query(self):
+        charts = list(Chart.objects.order_by('pk'))
+        self.assertEqual(load_charts(charts), {})
+        # One merged GROUP BY for the four charts, plus the aggregate of the other categories of 'Top'.
+        self.assertEqual(len(self.statements), 2)
+        expected = [Chart.objects.get(pk=chart.pk)._query_column_chart_data() for chart in charts]
+        self.assertEqual([chart._get_column_chart_data() for chart in charts], expected)
+        self.assertEqual(charts[-1]._get_column_chart_data(), [(u'west', 20), ('Other', 13)])
+
+    def test_extra_series_are_merged(self):
+        Chart.objects.filter(name='Orders').update(extra_series='[["revenue", "max"], ["id", "min"]]')
+        charts = list(Chart.objects.order_by('pk'))
+        self.assertEqual(load_charts(charts), {})
+        self.assertEqual(len(self.statements), 2)
+        expected = [Chart.objects.get(pk=chart.pk)._query_column_chart_data() for chart in charts]
+        self.assertEqual([chart._get_column_chart_data() for chart in charts], expected)
+        self.assertEqual(charts[1]._get_column_chart_data()[-1], (u'west', 1, 20, 3))
+
+    def test_cached_charts_are_not_queried(self):
+        load_charts(list(Chart.objects.all()))
+        del self.statements[:]
+        self.assertEqual(load_charts(list(Chart.objects.all())), {})
+        self.assertEqual(self.statements, [])
+
+    def test_failed_chart(self):
+        Chart.objects.filter(name='Average').update(y_axis='nope')
+        errors = load_charts(list(Chart.objects.all()))
+        self.assertEqual(errors.keys(), [Chart.objects.get(name='Average').pk])
+
+    def test_view(self):
+        self.client.login(username='chartchemy', password='secret')
+        response = self.client.get('/dashboard/')
+        self.assertEqual(response.status_code, 200)
+        for chart in Chart.objects.all():
+            self.assertIn('chartchemy_chart_%d' % chart.pk, response.content)
+        self.assertEqual(self.statements, [])
+
+    def test_data_view(self):
+        Chart.objects.filter(name='Average').update(y_axis='nope')
+        self.client.login(username='chartchemy', password='secret')
+        charts = dict((chart.name, chart.pk) for chart in Chart.objects.all())
+        response = self.client.get('/dashboard/data/', {'charts': ','.join(map(str, charts.values()))})
+        self.assertEqual(response.status_code, 200)
+        options = simplejson.loads(response.content)
+        self.assertEqual(options[str(charts['Top'])]['series'][0]['data'], [20, 13])
+        self.assertEqual(options[str(charts['Orders'])]['xAxis']['categories'],
+                         [u'(none)', u'east', u'north', u'west'])
+        self.assertEqual(options[str(charts['Average'])]['error'], 'Error creating chart')
+
+
+class DatasourceSemaphoresTest(TestCase):
+    def test_concurrency_is_bounded(self):
+        semaphores = concurrency.DatasourceSemaphores()
+        lock, running, peak = threading.Lock(), [0], [0]
+
+        def query():
+            semaphore = semaphores.acquire('db', 2, blocking=True)
+            with lock:
+                running[0] += 1
+                peak[0] = max(peak[0], running[0])
+            time.sleep(0.02)
+            with lock:
+                running[0] -= 1
+            semaphore.release()
+
+        pending = [concurrency.submit(query) for _i in range(6)]
+        for result in pending:
+            result.get()
+        self.assertEqual(peak[0], 2)
+        self.assertIs(semaphores.get('db'), semaphores.get('db'))
+        self.assertIsNot(semaphores.get('db'), semaphores.get('other db'))
+
+    def test_fail_fast(self):
+        semaphores = concurrency.DatasourceSemaphores()
+        semaphores.acquire('db', 1)
+        self.assertRaises(DatasourceBusyError, semaphores.acquire, 'db', 1)
+
+    def test_different_limits_share_the_slots(self):
+        semaphores = concurrency.DatasourceSemaphores()
+        first = semaphores.acquire('db', 1)
+        semaphores.acquire('db', 2)
+        # Two queries are running on the database, whatever the limit they came in with.
+        self.assertRaises(DatasourceBusyError, semaphores.acquire, 'db', 1)
+        self.assertRaises(DatasourceBusyError, semaphores.acquire, 'db', 2)
+        first.release()
+        self.assertRaises(DatasourceBusyError, semaphores.acquire, 'db', 1)
+        semaphores.acquire('db', 3)
+        self.assertEqual(semaphores.get('db').running, 2)
+        self.assertEqual(len(semaphores._semaphores), 1)
+
+    def test_blocking_waits_for_a_slot(self):
+        semaphores = concurrency.DatasourceSemaphores()
+        semaphore = semaphores.acquire('db', 1)
+        threading.Timer(0.05, semaphore.release).start()
+        semaphores.acquire('db', 1, blocking=True)
+        self.assertEqual(semaphores.get('db').running, 1)
+
+
+class QueryGuardTest(ChartTestMixin, TestCase):
+    # Never ends, unless interrupted.
+    ENDLESS = sqlalchemy.text('WITH RECURSIVE c(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM c) '
+                              'SELECT count(*) FROM c')
+
+    def test_timeout_cancels_query(self):
+        engine = sqlalchemy.create_engine('sqlite://')
+        started = time.time()
+        with self.assertRaises(QueryTimeoutError):
+            with concurrency.QueryGuard(engine, 'endless', 0.1, 1) as connection:
+                connection.execute(self.ENDLESS)
+        self.assertLess(time.time() - started, 5)
+        # The slot of the datasource was given back.
+        concurrency.semaphores.acquire('endless', 1).release()
+
+    def test_stopped_watchdog_doesnt_fire(self):
+        engine = sqlalchemy.create_engine('sqlite://')
+        with engine.connect() as connection:
+            watchdog = concurrency._Watchdog(connection, 0.05)
+            watchdog.start()
+            self.assertFalse(watchdog.stop())
+            time.sleep(0.1)
+            watchdog._fire()
+            self.assertFalse(watchdog.fired)
+            self.assertEqual(connection.scalar(sqlalchemy.text('SELECT 1')), 1)
+
+    def test_mysql_kill_uses_its_own_connection(self):
+        dialect, raw = _FakeMySQLDialect(), _FakeMySQLConnection()
+        connection = _Attributes(dialect=dialect, connection=_Attributes(connection=raw),
+                                 engine=_Attributes(dialect=dialect, url='mysql://db'))
+        kill = concurrency._canceller(connection)
+        # Nothing is sent to the server until the time is up.
+        self.assertEqual(raw.executed, [])
+        kill()
+        self.assertEqual(dialect.connected, [((u'mysql://db', ), {})])
+        self.assertEqual(dialect.killer.executed, ['KILL QUERY 7', 'close'])
+
+    def test_busy_datasource_fails_fast(self):
+        Datasource.objects.filter(pk=self.datasource.pk).update(max_concurrent_queries=1)
+        chart = Chart.objects.get(pk=self.chart.pk)
+        with chart.datasource.guarded_connection():
+            self.assertRaises(DatasourceBusyError, chart._query_column_chart_data)
+        self.assertEqual(len(chart._query_column_chart_data()), 2)
+
+
+class SingleFlightTest(ChartTestMixin, TestCase):
+    def setUp(self):
+        super(SingleFlightTest, self).setUp()
+        self.calls = []
+
+    def slow_query(self, result=42):
+        self.calls.append(result)
+        time.sleep(0.1)
+        return result
+
+    def call_concurrently(self, flights, n=5):
+        call = lambda: results.append(flights.call(lambda: 'key', self.slow_query))
+        threads = [threading.Thread(target=call) for _i in range(n)]
+        results = []
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    @override_settings(SINGLE_FLIGHT=singleflight.PROCESS)
+    def test_concurrent_calls_share_one_execution(self):
+        flights = singleflight.SingleFlight()
+        self.assertEqual(self.call_concurrently(flights), [42] * 5)
+        self.assertEqual(len(self.calls), 1)
+        self.assertEqual(flights.in_flight(), 0)
+        # Calls that come later run again.
+        self.assertEqual(flights.call(lambda: 'key', self.slow_query, 7), 7)
+
+    @override_settings(SINGLE_FLIGHT=None)
+    def test_disabled(self):
+        self.call_concurrently(singleflight.SingleFlight(), 3)
+        self.assertEqual(len(self.calls), 3)
+        # The key isn't computed.
+        self.assertEqual(singleflight.SingleFlight().call(None, self.slow_query), 42)
+
+    @override_settings(SINGLE_FLIGHT=singleflight.PROCESS)
+    def test_error_is_shared(self):
+        flights = singleflight.SingleFlight()
+        errors = []
+
+        def failing():
+            self.calls.append(None)
+            time.sleep(0.1)
+            raise QueryTimeoutError('Too slow')
+
+        def call():
+            try:
+                flights.call(lambda: 'key', failing)
+            except QueryTimeoutError as e:
+                errors.append(e)
+        threads = [threading.Thread(target=call) for _i in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual((len(self.calls), len(errors)), (1, 3))
+
+    @override_settings(SINGLE_FLIGHT=singleflight.CACHE, SINGLE_FLIGHT_POLL_INTERVAL=0.01)
+    def test_waits_for_other_process(self):
+        # Another process holds the lock, and publishes its result a bit later.
+        cache.set(singleflight.LOCK_KEY_PREFIX + 'key', 'other', 60)
+
+        def publish():
+            time.sleep(0.1)
+            cache.set(singleflight.RESULT_KEY_PREFIX + 'other', ([(u'east', 10)],), 60)
+            cache.delete(singleflight.LOCK_KEY_PREFIX + 'key')
+        threading.Thread(target=publish).start()
+        self.assertEqual(singleflight.SingleFlight().call(lambda: 'key', self.slow_query), [(u'east', 10)])
+        self.assertEqual(self.calls, [])
+
+    @override_settings(SINGLE_FLIGHT=singleflight.CACHE, SINGLE_FLIGHT_POLL_INTERVAL=0.01)
+    def test_takes_over_from_failed_process(self):
+        cache.set(singleflight.LOCK_KEY_PREFIX + 'key', 'other', 60)
+        threading.Timer(0.05, cache.delete, [singleflight.LOCK_KEY_PREFIX + 'key']).start()
+        self.assertEqual(singleflight.SingleFlight().call(lambda: 'key', self.slow_query), 42)
+        self.assertEqual(len(self.calls), 1)
+        self.assertIsNone(cache.get(singleflight.LOCK_KEY_PREFIX + 'key'))
+
+    def test_key_is_the_query(self):
+        other = Chart.objects.create(user=self.user, name='Revenue again', datasource=self.datasource,
+                                     table_name='orders', x_axis='region', y_axis='revenue',
+                                     aggr_func_name='sum')
+        self.assertEqual(other.query_flight_key(), self.chart.query_flight_key())
+        other.aggr_func_name = 'avg'
+        self.assertNotEqual(other.query_flight_key(), self.chart.query_flight_key())
+        other.aggr_func_name, other.category_limit = 'sum', 1
+        self.assertNotEqual(other.query_flight_key(), self.chart.query_flight_key())
+
+    def test_chart_queries_are_coalesced(self):
+        chart = Chart.objects.get(pk=self.chart.pk)
+        self.assertEqual(chart._query_column_chart_data(), [(u'east', 10), (u'west', 20)])
+        with self.settings(SINGLE_FLIGHT=singleflight.CACHE, SINGLE_FLIGHT_POLL_INTERVAL=0.01):
+            cache.set(singleflight.LOCK_KEY_PREFIX + chart.query_flight_key(), 'other', 60)
+            cache.set(singleflight.RESULT_KEY_PREFIX + 'other', ([(u'east', 1)],), 60)
+            self.assertEqual(chart._query_column_chart_data(), [(u'east', 1)])
+
+
+class SessionsTest(ChartTestMixin, TestCase):
+    def tearDown(self):
+        sessions.remove()
+        super(SessionsTest, self).tearDown()
+
+    def test_session_is_shared_in_the_thread(self):
+        session = self.datasource.session
+        self.assertIs(Datasource.objects.get(pk=self.datasource.pk).session, session)
+        other = []
+        thread = threading.Thread(target=lambda: other.append(self.datasource.session))
+        thread.start()
+        thread.join()
+        self.assertIsNot(other[0], session)
+
+    def test_middleware_closes_sessions(self):
+        before = sessions.stats()
+        session = self.datasource.session
+        self.assertEqual(session.execute('SELECT count(*) FROM orders').scalar(), 3)
+        self.assertEqual(sessions.stats(), {'open_sessions': before['open_sessions'] + 1,
+                                            'checked_out_connections': before['checked_out_connections'] + 1})
+        response = HttpResponse()
+        self.assertIs(SessionCleanupMiddleware().process_response(None, response), response)
+        self.assertEqual(sessions.stats(), before)
+        self.assertIsNot(self.datasource.session, session)
+        SessionCleanupMiddleware().process_exception(None, ValueError())
+        self.assertEqual(len(sessions.registry), 0)
+
+    def test_new_engine_gets_new_session(self):
+        session = self.datasource.session
+        self.engine = sqlalchemy.create_engine('sqlite://')
+        self.assertIsNot(self.datasource.session, session)
+        self.assertEqual(len(sessions.registry), 1)
+
+    @override_settings(CHART_QUERY_MODE='orm', SINGLE_FLIGHT=None)
+    def test_query_sessions_are_closed(self):
+        before = sessions.stats()
+        self.assertEqual(self.chart._query_column_chart_data(), [(u'east', 10), (u'west', 20)])
+        self.assertEqual(sessions.stats(), before)
+        # Without a category limit the rows are streamed.
+        self.chart.category_limit = 0
+        with self.settings(CHART_STREAM_BATCH_SIZE=1):
+            rows = self.chart._iter_column_chart_data()
+            self.assertEqual(next(rows), (u'east', 10))
+            self.assertEqual(sessions.stats()['open_sessions'], before['open_sessions'] + 1)
+            self.assertEqual(list(rows), [(u'west', 20)])
+        self.assertEqual(sessions.stats(), before)
+
+    def test_clean_returns_connection(self):
+        before = sessions.stats()['checked_out_connections']
+        self.datasource.clean()
+        self.assertEqual(sessions.stats()['checked_out_connections'], before)
+
+    def test_metrics(self):
+        User.objects.filter(pk=self.user.pk).update(is_staff=True)
+        self.client.login(username='chartchemy', password='secret')
+        summary = simplejson.loads(self.client.get('/metrics/').content)
+        self.assertEqual(summary['sessions'], sessions.stats())
+
+
+class RollupTest(ChartTestMixin, TestCase):
+    def setUp(self):
+        super(RollupTest, self).setUp()
+        self.engine.execute(self.orders.insert(), [{'region': u'north', 'revenue': 1},
+                                                   {'region': None, 'revenue': 2},
+                                                   {'region': u'north', 'revenue': None}])
+        Chart.objects.filter(pk=self.chart.pk).update(execution_mode=queries.ROLLUP, rollup_key_column='id')
+        self.statements = []
+        sqlalchemy.event.listen(self.engine, 'before_cursor_execute', self.record_statement)
+
+    def tearDown(self):
+        sqlalchemy.event.remove(self.engine, 'before_cursor_execute', self.record_statement)
+        super(RollupTest, self).tearDown()
+
+    def record_statement(self, conn, cursor, statement, *args):
+        self.statements.append(statement)
+
+    def updated_chart(self, **kwargs):
+        Chart.objects.filter(pk=self.chart.pk).update(**kwargs)
+        return Chart.objects.get(pk=self.chart.pk)
+
+    def assertRollupMatchesLive(self):
+        for aggr_func_name in ('sum', 'count', 'min', 'max', 'avg'):
+            for category_limit in (0, 2):
+                chart = self.updated_chart(aggr_func_name=aggr_func_name, category_limit=category_limit)
+                live = self.updated_chart(execution_mode=queries.LIVE)._query_column_chart_data()
+                self.updated_chart(execution_mode=queries.ROLLUP)
+                self.assertEqual(rollups.read(chart), [tuple(row) for row in live])
+
+    def test_full_refresh(self):
+        self.assertEqual(rollups.refresh(self.updated_chart()), 4)
+        self.assertRollupMatchesLive()
+
+    def test_incremental_refresh(self):
+        rollups.refresh(self.updated_chart())
+        self.engine.execute(self.orders.insert(), [{'region': u'east', 'revenue': 5},
+                                                   {'region': u'south', 'revenue': 7}])
+        del self.statements[:]
+        self.assertEqual(rollups.refresh(self.updated_chart()), 2)
+        self.assertIn('orders.id >', self.statements[-1])
+        self.assertRollupMatchesLive()
+
+    def test_chart_reads_rollup(self):
+        rollups.refresh(self.updated_chart())
+        del self.statements[:]
+        self.assertEqual(self.updated_chart()._query_column_chart_data(),
+                         [(None, 2), (u'east', 10), (u'north', 1), (u'west', 20)])
+        self.assertEqual(self.statements, [])
+        # The rollup no longer matches the chart. Query the datasource.
+        self.assertEqual(len(self.updated_chart(y_axis='id')._query_column_chart_data()), 4)
+        self.assertNotEqual(self.statements, [])
+
+    def test_command(self):
+        call_command('refresh_rollups', stdout=StringIO())
+        self.assertIsNotNone(rollups.read(self.updated_chart()))
+
+    def test_command_refreshes_rollups_of_live_charts(self):
+        # A LIVE chart over budget, sent to its rollup by the cost check.
+        chart = self.updated_chart(execution_mode=queries.LIVE)
+        rollups.refresh(chart)
+        self.engine.execute(self.orders.insert(), [{'region': u'south', 'revenue': 7}])
+        call_command('refresh_rollups', stdout=StringIO())
+        self.assertIn((u'south', 7), rollups.read(self.updated_chart()))
+
+
+class KernelsTest(TestCase):
+    ROWS = [(u'east', 4), (u'west', 20), (u'east', 6), (None, 2), (u'north', None), (u'east', None)]
+
+    def test_partials(self):
+        expected = {u'east': [10, 2, 4, 6], u'west': [20, 1, 20, 20], None: [2, 1, 2, 2],
+                    u'north': [None, 0, None, None]}
+        self.assertEqual(kernels._python_partials(self.ROWS), expected)
+        if kernels.numpy is not None:
+            self.assertEqual(kernels._numpy_partials(self.ROWS), expected)
+            floats = [(x, float(y) if y is not None else None) for x, y in self.ROWS]
+            self.assertEqual(kernels._numpy_partials(floats), kernels._python_partials(floats))
+            # Sums that could overflow an int64 are computed in Python, exactly.
+            big = [(u'east', 2 ** 62), (u'east', 2 ** 62), (u'east', 2 ** 62)]
+            self.assertIsNone(kernels._numpy_partials(big))
+            self.assertEqual(kernels.batch_partials(big), {u'east': [3 * 2 ** 62, 3, 2 ** 62, 2 ** 62]})
+        # Decimals are not reduced with NumPy.
+        self.assertEqual(kernels.batch_partials([(u'east', Decimal('1.5')), (u'east', Decimal('2.25'))]),
+                         {u'east': [Decimal('3.75'), 2, Decimal('1.5'), Decimal('2.25')]})
+
+    def test_finalize(self):
+        partials = kernels._python_partials(self.ROWS)
+        self.assertEqual(kernels.finalize(partials, 'avg'), [(None, 2.0), (u'east', 5.0), (u'north', None),
+                                                             (u'west', 20.0)])
+        self.assertEqual(kernels.finalize(partials, 'count', 2), [(u'east', 2), (None, 1), ('Other', 1)])
+
+
+@override_settings(IN_PROCESS_BATCH_SIZE=2)
+class InProcessTest(ChartTestMixin, TestCase):
+    def setUp(self):
+        super(InProcessTest, self).setUp()
+        self.engine.execute(self.orders.insert(), [{'region': u'north', 'revenue': 1},
+                                                   {'region': None, 'revenue': 2},
+                                                   {'region': u'north', 'revenue': None}])
+
+    def test_same_as_sql(self):
+        for aggr_func_name in ('sum', 'count', 'min', 'max', 'avg'):
+            for category_limit in (0, 2):
+                Chart.objects.filter(pk=self.chart.pk).update(aggr_func_name=aggr_func_name,
+                                                              category_limit=category_limit,
+                                                              execution_mode=queries.LIVE)
+                live = Chart.objects.get(pk=self.chart.pk)._query_column_chart_data()
+                Chart.objects.filter(pk=self.chart.pk).update(execution_mode=queries.IN_PROCESS)
+                self.assertEqual(Chart.objects.get(pk=self.chart.pk)._query_column_chart_data(), live)
+
+    def test_dashboard(self):
+        Chart.objects.filter(pk=self.chart.pk).update(execution_mode=queries.IN_PROCESS)
+        chart = Chart.objects.get(pk=self.chart.pk)
+        self.assertEqual(load_charts([chart]), {})
+        self.assertEqual(chart._get_column_chart_data(), [(None, 2), (u'east', 10), (u'north', 1),
+                                                          (u'west', 20)])
+
+    def test_dashboard_waits_for_slots(self):
+        Datasource.objects.filter(pk=self.datasource.pk).update(max_concurrent_queries=1)
+        charts = []
+        for aggr_func_name in ('sum', 'count', 'min', 'max'):
+            chart = Chart.objects.create(user=self.user, name=aggr_func_name, datasource=self.datasource,
+                                         table_name='orders', x_axis='region', y_axis='revenue',
+                                         aggr_func_name=aggr_func_name, execution_mode=queries.IN_PROCESS)
+            charts.append(Chart.objects.get(pk=chart.pk))
+        # Someone else holds the only slot for a bit.
+        semaphore = concurrency.semaphores.acquire(self.datasource.connection_key, 1)
+        threading.Timer(0.1, semaphore.release).start()
+        self.assertEqual(load_charts(charts), {})
+        self.assertEqual(charts[1]._get_column_chart_data(), [(None, 1), (u'east', 2), (u'north', 1),
+                                                              (u'west', 1)])
+
+
+class SamplingTest(ChartTestMixin, TestCase):
+    def test_small_table_is_read_whole(self):
+        with self.engine.connect() as connection:
+            sample = sampling.preview(connection, self.orders, 'region', 'revenue', 'sum', 100)
+        self.assertEqual(sample.method, sampling.FULL)
+        self.assertEqual(sample.fraction, 1.0)
+        self.assertEqual(sample.rows, [(u'east', 10.0, 0.0), (u'west', 20.0, 0.0)])
+
+    def test_key_range(self):
+        self.engine.execute(self.orders.delete())
+        self.engine.execute(self.orders.insert(), [{'region': u'r%d' % (i % 2), 'revenue': 1}
+                                                   for i in range(1000)])
+        with self.engine.connect() as connection:
+            sample = sampling.preview(connection, self.orders, 'region', 'revenue', 'count', 100)
+        self.assertEqual(sample.method, sampling.KEY_RANGE)
+        self.assertAlmostEqual(sample.fraction, 0.1, delta=0.01)
+        for category, value, bound in sample.rows:
+            self.assertAlmostEqual(value, 500, delta=20)
+            self.assertTrue(0 < bound < 500)
+
+    def test_stale_statistics(self):
+        self.engine.execute(self.orders.insert(), [{'region': u'north', 'revenue': 1} for _i in range(200)])
+        estimated_row_count, sampling.estimated_row_count = sampling.estimated_row_count, lambda *args: 3
+        try:
+            with self.engine.connect() as connection:
+                rows, fraction, method = sampling.sample_rows(connection, self.orders, [self.orders.c.region],
+                                                              100)
+        finally:
+            sampling.estimated_row_count = estimated_row_count
+        self.assertEqual(method, sampling.KEY_RANGE)
+        self.assertLessEqual(len(rows), 100)
+        self.assertAlmostEqual(fraction, len(rows) / 203.0)
+
+    def test_description(self):
+        rows = [(u'east', 100.0, 5.0)]
+        self.assertIn('within 5% of the full result',
+                      views._describe_sample(sampling.Sample(rows, 0.1, sampling.TABLESAMPLE)))
+        for method in (sampling.KEY_RANGE, sampling.LIMIT):
+            description = views._describe_sample(sampling.Sample(rows, 0.1, method))
+            self.assertNotIn('confidence', description)
+            self.assertIn('may not be representative', description)
+
+    def test_preview_doesnt_save(self):
+        self.client.login(username='chartchemy', password='secret')
+        Chart._query_column_chart_data, query = None, Chart._query_column_chart_data
+        try:
+            response = self.client.post('/charts/%d/' % self.chart.pk, {
+                'preview_axes': 'Preview', 'x_axis': 'region', 'y_axis': 'revenue', 'aggr_func_name': 'max',
+                'execution_mode': queries.LIVE})
+        finally:
+            Chart._query_column_chart_data = query
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('max(revenue) (preview)', response.content)
+        self.assertIn('Preview computed from all the rows.', response.content)
+        self.assertEqual(Chart.objects.get(pk=self.chart.pk).aggr_func_name, 'sum')
+
+
+@override_settings(INTROSPECTION_PROFILE=True)
+class ProfilingTest(ChartTestMixin, TestCase):
+    def test_hyperloglog(self):
+        sketch = profiling.HyperLogLog()
+        for i in range(20000):
+            sketch.add(u'value %d' % (i % 10000))
+        self.assertAlmostEqual(sketch.count(), 10000, delta=500)
+
+    def test_profile(self):
+        profile = Datasource.objects.get(pk=self.datasource.pk).profiles['orders']
+        self.assertEqual(profile['rows'], 3)
+        self.assertEqual(profile['columns']['id'], {'indexed': True})
+        self.assertEqual(profile['columns']['region'], {'indexed': False, 'distinct': 2})
+
+    @override_settings(PROFILE_LARGE_TABLE_ROWS=3, PROFILE_MANY_CATEGORIES=2)
+    def test_axes_form_warnings(self):
+        chart = Chart.objects.get(pk=self.chart.pk)
+        form = ColumnChartAxesForm({'x_axis': 'region', 'y_axis': 'revenue', 'aggr_func_name': 'sum',
+                                    'execution_mode': queries.LIVE}, instance=chart)
+        self.assertIn(('region', 'region (not indexed, ~2 values)'), form.fields['x_axis'].choices)
+        self.assertTrue(form.is_valid())
+        self.assertEqual(len(form.warnings), 2)
+
+    def test_queries_are_guarded(self):
+        guards = []
+        guarded_connection = Datasource.guarded_connection
+
+        def record(datasource, *args, **kwargs):
+            guards.append(kwargs)
+            return guarded_connection(datasource, *args, **kwargs)
+        Datasource.guarded_connection = record
+        try:
+            self.datasource._profile_tables()
+        finally:
+            Datasource.guarded_connection = guarded_connection
+        self.assertEqual(guards, [{'blocking': True}] * len(self.datasource.table_names))
+
+    def test_profiling_is_optional(self):
+        DatasourceTable.objects.update(profile=None)
+        with self.settings(INTROSPECTION_PROFILE=False):
+            self.datasource._pickle_all()
+        self.assertEqual(Datasource.objects.get(pk=self.datasource.pk).profiles, {})
+
+
+class CostsTest(ChartTestMixin, TestCase):
+    def chart_with_budget(self, budget, action=costs.REFUSE):
+        Datasource.objects.filter(pk=self.datasource.pk).update(query_row_budget=budget,
+                                                                over_budget_action=action)
+        return Chart.objects.get(pk=self.chart.pk)
+
+    def test_explain(self):
+        x_column, y_aggr = self.chart._core_columns()
+        with self.engine.connect() as connection:
+            estimate = costs.explain(connection, queries.grouped(x_column, y_aggr), self.orders)
+        self.assertEqual(estimate.rows, 3)
+        self.assertFalse(estimate.uses_index)
+
+    def test_under_budget(self):
+        self.assertEqual(self.chart_with_budget(3)._query_column_chart_data(), [(u'east', 10), (u'west', 20)])
+        estimate = self.chart.chartqueryestimate
+        self.assertEqual((estimate.estimated_rows, estimate.over_budget, estimate.action), (3, False, None))
+
+    def test_refuse(self):
+        self.assertRaises(QueryOverBudgetError, self.chart_with_budget(2)._query_column_chart_data)
+        estimate = self.chart.chartqueryestimate
+        self.assertEqual((estimate.over_budget, estimate.action), (True, costs.REFUSE))
+
+    def test_sample(self):
+        chart = self.chart_with_budget(2, costs.SAMPLE)
+        self.assertEqual(chart._query_column_chart_data(), [(u'east', 10.0), (u'west', 20.0)])
+
+    def test_sample_is_not_cached(self):
+        chart = self.chart_with_budget(2, costs.SAMPLE)
+        self.assertEqual(chart._get_column_chart_data(), [(u'east', 10.0), (u'west', 20.0)])
+        self.assertTrue(chart.data_is_sampled)
+        self.assertIsNone(cache.get(chart.data_cache_key))
+        self.assertIn('sum(revenue) (sample)', chart._plot_column_chart())
+
+    def test_dashboard(self):
+        refused = self.chart_with_budget(2)
+        errors = load_charts([refused])
+        self.assertIsInstance(errors[refused.pk], QueryOverBudgetError)
+        Datasource.objects.filter(pk=self.datasource.pk).update(max_concurrent_queries=1)
+        sampled = self.chart_with_budget(2, costs.SAMPLE)
+        # Someone else holds the only slot for a bit. The EXPLAIN and the sample wait for it.
+        semaphore = concurrency.semaphores.acquire(self.datasource.connection_key, 1)
+        threading.Timer(0.1, semaphore.release).start()
+        self.assertEqual(load_charts([sampled]), {})
+        self.assertEqual(sampled._get_column_chart_data(), [(u'east', 10.0), (u'west', 20.0)])
+        self.assertIsNone(cache.get(sampled.data_cache_key))
+
+    def test_background(self):
+        submitted = []
+        submit_background, concurrency.submit_background = (concurrency.submit_background,
+                                                            lambda *args: submitted.append(args))
+        try:
+            chart = self.chart_with_budget(2, costs.BACKGROUND)
+            self.assertRaises(ChartQueuedError, chart._query_column_chart_data)
+        finally:
+            concurrency.submit_background = submit_background
+        self.assertEqual(submitted[0][0], ('chart', chart.data_cache_key))
+
+    def test_chart_costs_command(self):
+        self.assertRaises(QueryOverBudgetError, self.chart_with_budget(2)._query_column_chart_data)
+        out = StringIO()
+        call_command('chart_costs', stdout=out)
+        self.assertIn('3 rows', out.getvalue())
+        self.assertIn('(Revenue)', out.getvalue())
+
+
+@override_settings(INTROSPECTION_ASYNC=False)
+class IntrospectionTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('chartchemy', 'chartchemy@example.com', 'secret')
+        self._pickle_all = Datasource._pickle_all
+
+    def tearDown(self):
+        Datasource._pickle_all = self._pickle_all
+
+    def create_datasource(self):
+        return Datasource.objects.create(user=self.user, name='shop', dbtype='MYSQL', dbname='shop',
+                                         dbusername='u', dbpassword='p', dbhost='localhost')
+
+    def test_done(self):
+        Datasource._pickle_all = lambda ds: None
+        ds = Datasource.objects.get(pk=self.create_datasource().pk)
+        self.assertEqual(ds.introspection_status, introspection.DONE)
+        self.assertTrue(ds.is_introspected)
+
+    def test_failed(self):
+        def pickle_all(ds):
+            raise sqlalchemy.exc.OperationalError('reflect', {}, Exception("Can't connect"))
+        Datasource._pickle_all = pickle_all
+        ds = Datasource.objects.get(pk=self.create_datasource().pk)
+        self.assertEqual(ds.introspection_status, introspection.FAILED)
+        self.assertIn("Can't connect", ds.introspection_error)
+        self.assertFalse(ds.is_introspected)
+
+    def test_chart_details_waits_for_introspection(self):
+        Datasource._pickle_all = lambda ds: None
+        with self.settings(INTROSPECTION_ASYNC=True):
+            # Keep the job from running.
+            introspection._pool, pool = _NoPool(), introspection._pool
+            try:
+                ds = self.create_datasource()
+            finally:
+                introspection._pool = pool
+        chart = Chart.objects.create(user=self.user, name='Revenue', datasource=ds)
+        self.client.login(username='chartchemy', password='secret')
+        response = self.client.get('/charts/%d/' % chart.pk)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('being introspected', response.content)
+
+    def test_stale_datasources(self):
+        Datasource._pickle_all = lambda ds: None
+        fresh, old, failed, never, running, lost = [self.create_datasource() for _i in range(6)]
+        two_hours_ago = timezone.now() - datetime.timedelta(hours=2)
+        Datasource.objects.filter(pk=old.pk).update(time_introspected=two_hours_ago)
+        Datasource.objects.filter(pk=failed.pk).update(introspection_status=introspection.FAILED)
+        Datasource.objects.filter(pk=never.pk).update(time_introspected=None)
+        Datasource.objects.filter(pk=running.pk).update(introspection_status=introspection.RUNNING,
+                                                        time_introspected=None)
+        Datasource.objects.filter(pk=lost.pk).update(introspection_status=introspection.RUNNING,
+                                                     introspection_started=two_hours_ago)
+        stale = introspection.stale_datasources(datetime.timedelta(hours=1))
+        self.assertEqual(sorted(ds.pk for ds in stale), [old.pk, failed.pk, never.pk, lost.pk])
+
+    def test_lost_job_can_be_restarted(self):
+        Datasource._pickle_all = lambda ds: None
+        ds = self.create_datasource()
+        Datasource.objects.filter(pk=ds.pk).update(introspection_status=introspection.PENDING)
+        self.client.login(username='chartchemy', password='secret')
+        url = '/datasources/%d/introspect/' % ds.pk
+        self.client.post(url)
+        self.assertEqual(Datasource.objects.get(pk=ds.pk).introspection_status, introspection.PENDING)
+        with self.settings(INTROSPECTION_JOB_TIMEOUT=0):
+            self.client.post(url)
+        self.assertEqual(Datasource.objects.get(pk=ds.pk).introspection_status, introspection.DONE)
+
+
+class _NoPool(object):
+    def apply_async(self, func, args):
+        pass
+
+
+class _Attributes(object):
+    def __init__(self, **attrs):
+        self.__dict__.update(attrs)
+
+
+class _FakeMySQLConnection(object):
+    """A DBAPI connection of a MySQL driver, that records the statements it is sent."""
+
+    def __init__(self):
+        self.executed = []
+
+    def thread_id(self):
+        return 7
+
+    def cursor(self):
+        return self
+
+    def execute(self, statement):
+        self.executed.append(statement)
+
+    def close(self):
+        self.executed.append('close')
+
+
+class _FakeMySQLDialect(object):
+    name = 'mysql'
+
+    def __init__(self):
+        self.connected, self.killer = [], None
+
+    def create_connect_args(self, url):
+        return (url, ), {}
+
+    def connect(self, *cargs, **cparams):
+        self.connected.append((cargs, cparams))
+        self.killer = _FakeMySQLConnection()
+        return self.killer
+
+
+class DatasourceTablesTest(SQLiteDatasourceMixin, TestCase):
+    def setUp(self):
+        super(DatasourceTablesTest, self).setUp()
+        self.user = User.objects.create_user('chartchemy', 'chartchemy@example.com', 'secret')
+        Datasource.objects.bulk_create([Datasource(user=self.user, name='shop', dbtype='MYSQL',
+                                                   dbname='shop', dbusername='u', dbpassword='p',
+                                                   dbhost='localhost')])
+        self.datasource = Datasource.objects.get(name='shop')
+
+    def reload(self):
+        return Datasource.objects.get(pk=self.datasource.pk)
+
+    def test_introspection(self):
+        self.datasource._pickle_all()
+        ds = self.reload()
+        self.assertEqual(ds.table_names, ['customers', 'orders'])
+        self.assertEqual(ds.measures, {'customers': ['id'], 'orders': ['id', 'revenue']})
+        self.assertEqual(ds.dimensions, {'customers': ['name'], 'orders': ['region']})
+        self.assertEqual([c.name for c in ds.tables['orders'].columns], ['id', 'region', 'revenue'])
+        self.assertRaises(KeyError, lambda: ds.tables['nope'])
+
+    def test_reintrospection_only_updates_changed_tables(self):
+        self.datasource._pickle_all()
+        checksums = dict(self.reload().table_checksums)
+        self.engine.execute('ALTER TABLE orders ADD COLUMN discount INTEGER')
+        self.engine.execute('DROP TABLE customers')
+        self.engine.execute('CREATE TABLE items (id INTEGER PRIMARY KEY)')
+        self.datasource._pickle_all()
+        ds = self.reload()
+        self.assertEqual(ds.table_names, ['items', 'orders'])
+        self.assertNotEqual(ds.table_checksums['orders'], checksums['orders'])
+        self.assertIn('discount', ds.measures['orders'])
+
+    def test_legacy_pickled_tables_are_migrated(self):
+        Datasource.objects.filter(pk=self.datasource.pk).update(
+            pickled_tables=_pickled({'orders': self.orders}),
+            pickled_measures=_pickled({'orders': ['id', 'revenue']}),
+            pickled_dimensions=_pickled({'orders': ['region']}))
+        ds = self.reload()
+        self.assertEqual(ds.table_names, ['orders'])
+        self.assertEqual(ds.measures, {'orders': ['id', 'revenue']})
+        self.assertIsNone(self.reload().pickled_tables)
+
+    def test_legacy_pickled_rows_are_readable_and_migrated(self):
+        self.datasource.datasourcetable_set.create(name='orders', checksum='x',
+                                                   pickled_table=_pickled(self.orders),
+                                                   pickled_measures=_pickled(['id', 'revenue']),
+                                                   pickled_dimensions=_pickled(['region']))
+        ds = self.reload()
+        self.assertEqual(ds.measures, {'orders': ['id', 'revenue']})
+        self.assertEqual(ds.tables['orders'].columns.keys(), ['id', 'region', 'revenue'])
+        row = DatasourceTable.objects.get(name='orders')
+        row.migrate_pickled()
+        row = DatasourceTable.objects.get(name='orders')
+        self.assertIsNone(row.pickled_table)
+        self.assertEqual(self.reload().dimensions, {'orders': ['region']})
+        self.assertEqual(row.table.columns.keys(), ['id', 'region', 'revenue'])
+
+
+class SchemaFormatTest(TestCase):
+    def setUp(self):
+        self.table = sqlalchemy.Table('orders', sqlalchemy.MetaData(),
+                                      sqlalchemy.Column('id', sqlalchemy.Integer, primary_key=True),
+                                      sqlalchemy.Column('region', sqlalchemy.String(20), nullable=False),
+                                      sqlalchemy.Column('price', sqlalchemy.Numeric(10, 2)),
+                                      sqlalchemy.Column('created', sqlalchemy.DateTime))
+
+    def test_round_trip(self):
+        table = schema.loads(schema.dumps(self.table))
+        self.assertEqual(table.name, 'orders')
+        self.assertEqual(table.columns.keys(), ['id', 'region', 'price', 'created'])
+        self.assertEqual([c.name for c in table.primary_key], ['id'])
+        self.assertFalse(table.c.region.nullable)
+        self.assertEqual(table.c.region.type.length, 20)
+        self.assertEqual((table.c.price.type.precision, table.c.price.type.scale), (10, 2))
+        self.assertIsInstance(table.c.created.type, sqlalchemy.DateTime)
+
+    def test_load_columns(self):
+        self.assertEqual(schema.load_columns(schema.dumps(self.table))[1],
+                         ('region', 'String', {'length': 20}, False, False))
+
+    def test_unknown_version(self):
+        self.assertRaises(ValueError, schema.loads, '{"v": 99, "name": "orders", "columns": []}')
+
+
+class CategoryLimitTest(ChartTestMixin, TestCase):
+    def setUp(self):
+        super(CategoryLimitTest, self).setUp()
+        self.engine.execute(self.orders.insert(), [{'region': u'north', 'revenue': 1},
+                                                   {'region': None, 'revenue': 2},
+                                                   {'region': u'south', 'revenue': 15}])
+
+    def data(self, **kwargs):
+        Chart.objects.filter(pk=self.chart.pk).update(**kwargs)
+        return Chart.objects.get(pk=self.chart.pk)._query_column_chart_data()
+
+    def test_top_n_and_other(self):
+        self.assertEqual(self.data(category_limit=2), [(u'west', 20), (u'south', 15), ('Other', 13)])
+
+    def test_other_uses_the_aggregate(self):
+        self.assertEqual(self.data(category_limit=2, aggr_func_name='count'),
+                         [(u'east', 2), (None, 1), ('Other', 3)])
+
+    def test_within_limit(self):
+        self.assertEqual(self.data(category_limit=5),
+                         [(None, 2), (u'east', 10), (u'north', 1), (u'south', 15), (u'west', 20)])
+
+    def test_no_limit(self):
+        self.assertEqual(len(self.data(category_limit=0)), 5)
+
+    def test_plain_tuples(self):
+        self.assertTrue(all(type(row) is tuple for row in self.data(category_limit=2)))
+
+    def test_extra_series(self):
+        # The top categories are picked by the main series, the other categories aggregate every series.
+        rows = self.data(category_limit=2, extra_series='[["revenue", "count"], ["id", "max"]]')
+        self.assertEqual([tuple(row) for row in rows],
+                         [(u'west', 20, 1, 3), (u'south', 15, 1, 6), ('Other', 13, 4, 5)])
+
+
+@override_settings(CHART_QUERY_MODE='orm')
+class ORMCategoryLimitTest(CategoryLimitTest):
+    def test_plain_tuples(self):
+        # The ORM returns KeyedTuples. The chart turns them into plain tuples, which pickle reliably.
+        super(ORMCategoryLimitTest, self).test_plain_tuples()
+        chart = Chart.objects.get(pk=self.chart.pk)
+        self.assertTrue(all(type(row) is not tuple for row in chart._query_column_chart_data_orm()[:2]))
@@ -1,17 +1,112 @@
+import uuid
+from decimal import Decimal
+from itertools import islice
+
 import simplejson
+from django.conf import settings
 from django.utils.html import escape
 
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+
+def dumps(obj):
+    """Serializes ``obj`` (made of dicts, lists, unicode strings and numbers) to JSON with ujson if it is
+    installed, simplejson otherwise.
+    """
+    if ujson is not None:
+        return ujson.dumps(obj, double_precision=15)
+    return simplejson.dumps(obj)
+
+
+def html_escape_json(text):
+    """Returns the JSON ``text`` with all its strings HTML escaped, like ``django.utils.html.escape`` does, in
+    a few passes over the whole text rather than a few passes per string.
+    """
+    # In a JSON text ``&``, ``<``, ``>`` and ``'`` can only be part of a string, and a ``"`` that is part of a
+    # string is escaped as ``\"``. Escaped backslashes are set aside first, so that the ``"`` closing a
+    # string that ends with a backslash is left alone (NUL is always escaped in JSON, it can't be in the text).
+    text = text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;').replace("'", '&#39;')
+    if '\\\\' in text:
+        return text.replace('\\\\', '\x00').replace('\\"', '&quot;').replace('\x00', '\\\\')
+    return text.replace('\\"', '&quot;')
+
+
+def _text(value):
+    if isinstance(value, str):
+        return value.decode('utf-8', 'replace')
+    return unicode(value)
+
+
+def _category(value):
+    if value is None:
+        return _text(settings.CHART_NULL_CATEGORY)
+    return _text(value)
+
+
+def _texts(values):
+    """Returns the categories ``values`` as unicode strings. NULL is ``CHART_NULL_CATEGORY``."""
+    return [value if value.__class__ is unicode else _category(value) for value in values]
+
+
+def _numbers(values):
+    """Returns ``values`` with the ``Decimal`` values converted to floats."""
+    return [float(value) if value.__class__ is Decimal else value for value in values]
+
+
+def render_highcharts_options(render_to, categories, series, title, x_axis_title, y_axis_title, series_name,
+                              extra_series=()):
+    """Accepts the parameters to render a chart and returns a JSON serialized Highcharts options object.
+    ``extra_series`` are the ``(name, data)`` pairs of more series to plot against the same categories.
+
+    All the strings are HTML escaped, once the options are serialized (see ``html_escape_json``), and the
+    ``Decimal`` values of the series are serialized as floats. NULL categories are labelled
+    ``CHART_NULL_CATEGORY``, in either case. If ``CHART_JSON_COMPAT`` is True, the options
+    are rendered the way they used to be instead (every string escaped on its own, non ASCII characters
+    dropped, Decimals serialized as is).
+    """
+    if settings.CHART_JSON_COMPAT:
+        return _render_highcharts_options_compat(render_to, categories, series, title, x_axis_title,
+                                                 y_axis_title, series_name, extra_series)
+    hco = {
+        "chart": {
+            "renderTo": _text(render_to) if render_to else u'render_to',
+            "type": 'column'
+        },
+        "title": {
+            "text": _text(title) if title else u'title'
+        },
+        "xAxis": {
+            "title": {
+                "text": _text(x_axis_title) if x_axis_title else u'x axis'
+            },
+            "categories": _texts(categories)
+        },
+        "yAxis": {
+            "title": {
+                "text": _text(y_axis_title) if y_axis_title else u'y axis',
+            }
+        },
+        "series": [{
+            "name": _text(series_name),
+            "data": _numbers(series),
+        }] + [{"name": _text(name), "data": _numbers(data)} for name, data in extra_series]
+    }
+    return html_escape_json(dumps(hco))
+
 
-def render_highcharts_options(render_to, categories, series, title, x_axis_title, y_axis_title, series_name):
-    """Accepts the parameters to render a chart and returns a JSON serialized Highcharts options object."""
+def _render_highcharts_options_compat(render_to, categories, series, title, x_axis_title, y_axis_title,
+                                      series_name, extra_series=()):
 
     # Escape all the character strings to make them HTML safe.
     render_to = escape(render_to.decode('ascii', 'ignore')) if render_to else 'render_to'
     title = escape(title.decode('ascii', 'ignore')) if title else 'title'
     x_axis_title = escape(x_axis_title.decode('ascii', 'ignore')) if x_axis_title else 'x axis'
     y_axis_title = escape(y_axis_title.decode('ascii', 'ignore')) if y_axis_title else 'y axis'
-    # Categories (dimensions) come from the use. Escape them too.
-    categories = [escape(c.decode('ascii', 'ignore')) for c in categories]
+    # Categories (dimensions) come from the use. Escape them too, like the streamed options do.
+    categories = [_escape_category(c) for c in categories]
 
     hco = {
         "chart": {
@@ -35,7 +130,137 @@ def render_highcharts_options(render_to, categories, series, title, x_axis_title
         "series": [{
             "name": series_name,
             "data": series,
-        }]
+        }] + [{"name": name, "data": data} for name, data in extra_series]
     }
 
     return simplejson.dumps(hco, use_decimal=True)
+
+
+def _escape_category(category):
+    if category is None:
+        category = settings.CHART_NULL_CATEGORY
+    if isinstance(category, str):
+        category = category.decode('ascii', 'ignore')
+    return escape(unicode(category))
+
+
+def iter_highcharts_options(render_to, rows, title, x_axis_title, y_axis_title, series_name, batch_size=1000,
+                            on_error=None):
+    """Same as ``render_highcharts_options`` but yields the JSON serialized Highcharts options in chunks as
+    it consumes ``rows``, an iterable of ``(category, value)`` pairs. Only ``batch_size`` rows are held in
+    memory at a time.
+
+    The categories are not listed in ``xAxis.categories``. Instead the data of the series is a list of
+    ``[category, value]`` pairs and the x axis is of type ``category``. That way the options can be
+    written in one pass over the rows.
+
+    If reading the rows raises an exception, ``on_error(exception)`` may return a dict of fields. The data
+    stops there and the fields are added to the options, which are still valid JSON. Otherwise the exception
+    is raised.
+    """
+    if settings.CHART_JSON_COMPAT:
+        for chunk in _iter_highcharts_options_compat(render_to, rows, title, x_axis_title, y_axis_title,
+                                                     series_name, batch_size, on_error):
+            yield chunk
+        return
+    placeholder = uuid.uuid4().hex
+    hco = {
+        "chart": {
+            "renderTo": _text(render_to) if render_to else u'render_to',
+            "type": 'column'
+        },
+        "title": {
+            "text": _text(title) if title else u'title'
+        },
+        "xAxis": {
+            "type": "category",
+            "title": {
+                "text": _text(x_axis_title) if x_axis_title else u'x axis'
+            },
+        },
+        "yAxis": {
+            "title": {
+                "text": _text(y_axis_title) if y_axis_title else u'y axis',
+            }
+        },
+        "series": [{
+            "name": _text(series_name),
+            "data": placeholder,
+        }]
+    }
+    # Serialize everything but the data and split it where the data goes.
+    head, tail = html_escape_json(dumps(hco)).split('"%s"' % placeholder)
+    yield head + '['
+    rows = iter(rows)
+    separator = ''
+    try:
+        while True:
+            batch = [[category if category.__class__ is unicode else _category(category),
+                      float(value) if value.__class__ is Decimal else value]
+                     for category, value in islice(rows, batch_size)]
+            if not batch:
+                break
+            # Strip the brackets of the list of the batch, the pairs are part of the one big list.
+            yield separator + html_escape_json(dumps(batch))[1:-1]
+            separator = ','
+    except Exception as e:
+        fields = on_error(e) if on_error is not None else None
+        if fields is None:
+            raise
+        yield ']' + _with_fields(tail, fields)
+        return
+    yield ']' + tail
+
+
+def _with_fields(tail, fields):
+    """Returns the ``tail`` of serialized options with the ``fields`` added to the top level object."""
+    return tail[:-1] + ',' + html_escape_json(dumps(fields))[1:]
+
+
+def _iter_highcharts_options_compat(render_to, rows, title, x_axis_title, y_axis_title, series_name,
+                                    batch_size, on_error):
+    placeholder = uuid.uuid4().hex
+    hco = {
+        "chart": {
+            "renderTo": escape(render_to.decode('ascii', 'ignore')) if render_to else 'render_to',
+            "type": 'column'
+        },
+        "title": {
+            "text": escape(title.decode('ascii', 'ignore')) if title else 'title'
+        },
+        "xAxis": {
+            "type": "category",
+            "title": {
+                "text": escape(x_axis_title.decode('ascii', 'ignore')) if x_axis_title else 'x axis'
+            },
+        },
+        "yAxis": {
+            "title": {
+                "text": escape(y_axis_title.decode('ascii', 'ignore')) if y_axis_title else 'y axis',
+            }
+        },
+        "series": [{
+            "name": series_name,
+            "data": placeholder,
+        }]
+    }
+    # Serialize everything but the data and split it where the data goes.
+    head, tail = simplejson.dumps(hco).split('"%s"' % placeholder)
+    yield head + '['
+    rows = iter(rows)
+    separator = ''
+    try:
+        while True:
+            batch = [(_escape_category(category), value) for category, value in islice(rows, batch_size)]
+            if not batch:
+                break
+            # Strip the brackets of the list of the batch, the pairs are part of the one big list.
+            yield separator + simplejson.dumps(batch, use_decimal=True)[1:-1]
+            separator = ','
+    except Exception as e:
+        fields = on_error(e) if on_error is not None else None
+        if fields is None:
+            raise
+        yield ']' + _with_fields(tail, fields)
+        return
+    yield ']' + tail
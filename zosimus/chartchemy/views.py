@@ -1,15 +1,30 @@
 from collections import OrderedDict
 
+import simplejson
 import sqlalchemy
 
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required
 from django.core.exceptions import ObjectDoesNotExist
+from django.http import (Http404, HttpResponse, HttpResponseNotModified, HttpResponseServerError,
+                         StreamingHttpResponse)
 from django.shortcuts import render, HttpResponseRedirect
+from django.utils.cache import patch_cache_control
+from django.utils.http import parse_etags, quote_etag
+from django.views.decorators.gzip import gzip_page
 
+import instrumentation
+import introspection
+import sampling
+import sessions
+from dashboard import load_charts
 from forms import DatasourceForm, ChartTableForm, ColumnChartAxesForm, CreateChartForm
 from models import Datasource, Chart
-from zosimus.chartchemy.exceptions import ChartCreationError
+from zosimus.chartchemy.exceptions import ChartCreationError, ChartQueuedError, DatasourceBusyError
+
+# Number of seconds after which the browser asks again for a chart that is being computed in the background,
+# or whose datasource is busy.
+RETRY_AFTER = 5
 
 
 @login_required
@@ -69,9 +84,12 @@ def datasource_details(request, pk):
         messages.add_message(request, messages.ERROR, 'Cannot find the datasource: %s!' % pk)
         return HttpResponseRedirect('/datasources/')
 
-    db_layout = OrderedDict((k, {'measures': ds.measures.get(k, []),
-                                 'dimensions': ds.dimensions.get(k, [])})
-                             for k in sorted(ds.measures.viewkeys() | ds.dimensions.viewkeys()))
+    if ds.is_introspected:
+        db_layout = OrderedDict((k, {'measures': ds.measures.get(k, []),
+                                     'dimensions': ds.dimensions.get(k, [])})
+                                 for k in sorted(ds.measures.viewkeys() | ds.dimensions.viewkeys()))
+    else:
+        db_layout = OrderedDict()
 
     return render(request, 'chartchemy/datasource_detail.html', {
         'db_layout': db_layout,
@@ -79,6 +97,25 @@ def datasource_details(request, pk):
     })
 
 
+@login_required
+def introspect_datasource(request, pk):
+    """Queues the re-introspection of the datasource identified by the pk."""
+    try:
+        pk = int(pk)
+        ds = request.user.datasource_set.get(pk=pk)
+    except (ObjectDoesNotExist, ValueError):
+        messages.add_message(request, messages.ERROR, 'Cannot find the datasource: %s!' % pk)
+        return HttpResponseRedirect('/datasources/')
+
+    if request.method == 'POST':
+        if introspection.in_progress(ds):
+            messages.add_message(request, messages.INFO, 'Datasource %d is already being introspected.' % pk)
+        else:
+            introspection.schedule(ds)
+            messages.add_message(request, messages.INFO, 'Introspecting datasource: %d' % pk)
+    return HttpResponseRedirect('/datasources/%d/' % pk)
+
+
 @login_required
 def charts(request):
     """Lists the charts and also displays a form to add a new one."""
@@ -111,21 +148,54 @@ def delete_chart(request, pk):
     return HttpResponseRedirect('/charts/')
 
 
+def _describe_sample(sample):
+    if sample.method == sampling.FULL:
+        return 'Preview computed from all the rows.'
+    description = 'Preview computed from %.2g%% of the rows (%s sample).' % (100 * sample.fraction,
+                                                                             sample.method)
+    if sample.method != sampling.TABLESAMPLE:
+        # The confidence intervals only hold for rows sampled at random.
+        description += ' The rows are not sampled at random, the preview may not be representative.'
+    else:
+        bound = sampling.largest_relative_bound(sample)
+        if bound is not None:
+            description += ' Values are within %.2g%% of the full result (95%% confidence).' % (100 * bound)
+    return description + ' Save the chart to plot the full result.'
+
+
 @login_required
 def chart_details(request, pk):
     """Displays all the details about the chart identified by the pk.
 
     Displays two forms - one to choose the table for which to create the chart and a second form
     to select, the x and y axis columns and the aggregation function.
+
+    The page doesn't wait for the chart data. It only carries the URL of the Highcharts options (see
+    ``chart_data``), which ``chartloader.js`` fetches once the page is shown. A preview is computed with the
+    page, it is never fetched again.
     """
 
-    column_chart = None
+    column_chart, chart_data_url = None, None
     try:
         pk = int(pk)
         ch = request.user.chart_set.get(pk=pk)
     except (ObjectDoesNotExist, ValueError):
         messages.add_message(request, messages.ERROR, 'Cannot find the chart: %s!' % pk)
         return HttpResponseRedirect('/charts/')
+    instrumentation.tag(chart=ch.pk, datasource=ch.datasource_id)
+
+    # Nothing can be done with the chart until its datasource has been introspected.
+    if not ch.datasource.is_introspected:
+        messages.add_message(request, messages.INFO,
+                             'The datasource %s is being introspected (%s). Try again in a bit.' %
+                             (ch.datasource, ch.datasource.get_introspection_status_display()))
+        return render(request, 'chartchemy/chart_detail.html', {
+            'form_table': None,
+            'display_axes_form': False,
+            'form_axes': None,
+            'column_chart': None,
+            'chart_data_url': None
+        })
 
     if request.method == 'POST':
         # If the 'Save' button on ChartTableForm has been clicked.
@@ -138,24 +208,35 @@ def chart_details(request, pk):
                     ch.x_axis, ch.y_axis, ch.aggr_func_name = None, None, None
                 form_table.save()
                 return HttpResponseRedirect('/charts/%s/' % ch.id)
+        # If the 'Preview' button on ColumnChartAxesForm has been clicked. The chart is plotted from a sample
+        # of the rows and nothing is saved. The full query runs once the axes are saved.
+        elif 'preview_axes' in request.POST:
+            form_table = ChartTableForm(instance=ch)
+            form_axes = ColumnChartAxesForm(request.POST, instance=ch)
+            if form_axes.is_valid():
+                for warning in form_axes.warnings:
+                    messages.add_message(request, messages.WARNING, warning)
+                try:
+                    column_chart, sample = ch._preview_column_chart()
+                    messages.add_message(request, messages.INFO, _describe_sample(sample))
+                except (AttributeError, sqlalchemy.exc.OperationalError, ChartCreationError) as e:
+                    detail = unicode(e) if isinstance(e, ChartCreationError) else ''
+                    messages.add_message(request, messages.ERROR,
+                                         ('Uh Oh! Error creating the preview! %s' % detail).strip())
         # If the 'Save' button on ColumnChartAxesForm has been clicked.
         elif 'save_axes' in request.POST:
             form_axes = ColumnChartAxesForm(request.POST, instance=ch)
             if form_axes.is_valid():
+                for warning in form_axes.warnings:
+                    messages.add_message(request, messages.WARNING, warning)
                 form_axes.save()
                 return HttpResponseRedirect('/charts/%s/' % ch.id)
     else:
         form_table = ChartTableForm(instance=ch)
         if ch.table_name:
             form_axes = ColumnChartAxesForm(instance=ch)
-            if ch.x_axis and ch.y_axis and ch.aggr_func_name:
-                column_chart = ch._plot_column_chart()
-                try:
-                    column_chart = ch._plot_column_chart()
-                except (AttributeError, sqlalchemy.exc.OperationalError, ChartCreationError):
-                    column_chart = None
-                    messages.add_message(request, messages.ERROR,
-                                         'Uh Oh! Error creating chart!')
+            if ch.is_complete:
+                chart_data_url = '/charts/%d/data/' % ch.pk
         else:
             form_axes = None
 
@@ -165,5 +246,162 @@ def chart_details(request, pk):
         'form_table': form_table,
         'display_axes_form': display_axes_form,
         'form_axes': form_axes,
-        'column_chart': column_chart
+        'column_chart': column_chart,
+        'chart_data_url': chart_data_url
     })
+
+
+def _chart_error_fields(e):
+    """Returns the dict describing the error ``e`` of a chart. Charts that are being computed in the
+    background, or whose datasource is busy, say when to ask again (``retry_after``, in seconds).
+    """
+    # Timeouts and busy datasources say what went wrong.
+    detail = unicode(e) if isinstance(e, ChartCreationError) else ''
+    error = {'error': 'Error creating chart', 'detail': detail}
+    if isinstance(e, (ChartQueuedError, DatasourceBusyError)):
+        error['retry_after'] = RETRY_AFTER
+    return error
+
+
+def _chart_error(e):
+    """Returns the JSON object describing the error ``e`` of a chart. See ``_chart_error_fields()``."""
+    return simplejson.dumps(_chart_error_fields(e))
+
+
+def _stream_error(e):
+    """Returns the fields that end the options of a chart whose query failed after the response started (see
+    ``Chart._stream_column_chart``), or None for errors that aren't the chart's.
+    """
+    if isinstance(e, (AttributeError, sqlalchemy.exc.OperationalError, ChartCreationError)):
+        return _chart_error_fields(e)
+    return None
+
+
+def _chart_error_response(e):
+    """Returns the response for the error ``e`` of a chart: a 202 (Accepted) if the chart is being computed
+    in the background, a 503 if its datasource is busy, both with a ``Retry-After`` header, or a 500.
+    """
+    if isinstance(e, ChartQueuedError):
+        status = 202
+    elif isinstance(e, DatasourceBusyError):
+        status = 503
+    else:
+        return HttpResponseServerError(_chart_error(e), content_type='application/json')
+    response = HttpResponse(_chart_error(e), content_type='application/json', status=status)
+    response['Retry-After'] = str(RETRY_AFTER)
+    return response
+
+
+def _etag_matches(request, etag):
+    # GZip adds ';gzip' to the ETag of the responses it compresses.
+    etags = parse_etags(request.META.get('HTTP_IF_NONE_MATCH', ''))
+    return etag in etags or etag + ';gzip' in etags
+
+
+@gzip_page
+@login_required
+def chart_data(request, pk):
+    """Returns the Highcharts options of the chart identified by the pk as JSON (gzipped if the browser
+    accepts it).
+
+    The options of a chart whose data is loaded all at once (see ``Chart.streams_data``) carry an ETag
+    derived from the chart configuration and the chart data. Conditional GETs (``If-None-Match``) for an
+    unchanged chart are answered with a 304. The options of the other charts are streamed: the rows are read
+    from the database and written to the response in batches, so memory use doesn't grow with the number of
+    categories.
+
+    A chart that is being computed in the background is answered with a 202, and one whose datasource is
+    busy with a 503, both with a ``Retry-After`` header. ``chartloader.js`` asks again after that. A streamed
+    chart whose query fails after the first rows can only end its options with the ``error``.
+    """
+    try:
+        ch = request.user.chart_set.get(pk=int(pk))
+    except (ObjectDoesNotExist, ValueError):
+        raise Http404
+    instrumentation.tag(chart=ch.pk, datasource=ch.datasource_id)
+    if not (ch.datasource.is_introspected and ch.is_complete):
+        raise Http404
+    try:
+        if ch.streams_data:
+            # Reads the first rows. The errors of the query until then still get their own status.
+            chunks = ch._stream_column_chart(on_error=_stream_error)
+            response = StreamingHttpResponse(chunks, content_type='application/json')
+        else:
+            etag = ch.column_chart_etag
+            if _etag_matches(request, etag):
+                response = HttpResponseNotModified()
+            else:
+                response = HttpResponse(ch._plot_column_chart(), content_type='application/json')
+            response['ETag'] = quote_etag(etag)
+    except (AttributeError, sqlalchemy.exc.OperationalError, ChartCreationError) as e:
+        return _chart_error_response(e)
+    # The options are specific to the user. Make the browser revalidate them every time.
+    patch_cache_control(response, private=True, max_age=0, must_revalidate=True)
+    return response
+
+
+@login_required
+def dashboard(request):
+    """Displays all the charts of the user on one page (or only the ones in the ``charts`` parameter, a
+    comma separated list of pks).
+
+    The page doesn't wait for the chart data. ``chartloader.js`` fetches the options of the charts that are
+    in view from ``dashboard_data``, a batch at a time.
+    """
+    return render(request, 'chartchemy/dashboard.html', {
+        'charts': _dashboard_charts(request),
+    })
+
+
+def _dashboard_charts(request):
+    """Returns the complete charts of the user (only the ones in the ``charts`` parameter, if any)."""
+    charts = Chart.objects.filter(user=request.user).select_related('datasource').order_by('name')
+    if request.GET.get('charts'):
+        try:
+            charts = charts.filter(pk__in=[int(pk) for pk in request.GET['charts'].split(',')])
+        except ValueError:
+            raise Http404
+    return [ch for ch in charts if ch.datasource.is_introspected and ch.is_complete]
+
+
+@gzip_page
+@login_required
+def dashboard_data(request):
+    """Returns the Highcharts options of the charts in the ``charts`` parameter (a comma separated list of
+    pks) as a JSON object keyed by pk. Charts that couldn't be plotted get an ``{"error": ...}`` object.
+
+    The data of all the charts is loaded at once, see ``chartchemy.dashboard``.
+    """
+    if not request.GET.get('charts'):
+        raise Http404
+    charts = _dashboard_charts(request)
+    errors = load_charts(charts)
+    members = []
+    for ch in charts:
+        if ch.pk in errors:
+            options = _chart_error(errors[ch.pk])
+        else:
+            try:
+                options = ch._plot_column_chart()
+            except (AttributeError, sqlalchemy.exc.OperationalError, ChartCreationError) as e:
+                options = _chart_error(e)
+        # The options are JSON already.
+        members.append('"%d": %s' % (ch.pk, options))
+    response = HttpResponse('{%s}' % ', '.join(members), content_type='application/json')
+    patch_cache_control(response, private=True, max_age=0, must_revalidate=True)
+    return response
+
+
+@login_required
+def metrics(request):
+    """Returns the p50 and p95 durations (seconds) of the recent requests of every chart and every datasource
+    handled by this process, and the number of SQLAlchemy sessions and connections open in the process, as
+    JSON. Staff only. See ``instrumentation`` and ``sessions``.
+    """
+    if not request.user.is_staff:
+        raise Http404
+    summary = {'charts': {}, 'datasources': {}, 'sessions': sessions.stats()}
+    for key, stats in instrumentation.metrics.summary().items():
+        kind, pk = key.split(':', 1)
+        summary[kind + 's'][pk] = stats
+    return HttpResponse(simplejson.dumps(summary, sort_keys=True), content_type='application/json')
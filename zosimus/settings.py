@@ -69,6 +69,10 @@ TEMPLATE_LOADERS = (
 )
 
 MIDDLEWARE_CLASSES = (
+    # First, so that it times everything else.
+    'zosimus.chartchemy.middleware.ServerTimingMiddleware',
+    # Right after it, so that the sessions are closed even if a later middleware fails.
+    'zosimus.chartchemy.middleware.SessionCleanupMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -120,6 +124,10 @@ LOGGING = {
             'level': 'ERROR',
             'filters': ['require_debug_false'],
             'class': 'django.utils.log.AdminEmailHandler'
+        },
+        'console': {
+            'level': 'WARNING',
+            'class': 'logging.StreamHandler'
         }
     },
     'loggers': {
@@ -128,6 +136,12 @@ LOGGING = {
             'level': 'ERROR',
             'propagate': True,
         },
+        # One JSON object per slow chart request. See chartchemy.instrumentation.
+        'zosimus.chartchemy.slow': {
+            'handlers': ['console'],
+            'level': 'WARNING',
+            'propagate': False,
+        },
     }
 }
 
@@ -136,6 +150,107 @@ LOGGING = {
 # If ECHO is True, SQLAlchemy will print the SQL commands to stdout
 ECHO = DEBUG
 
+# Datasources that share the same connection parameters share one pooled engine. See
+# chartchemy.engines.EngineRegistry.
+# Maximum number of engines (i.e. connection pools) kept alive in a process.
+ENGINE_REGISTRY_SIZE = 20
+# Number of connections kept open in each pool and the number of extra connections allowed on top of it.
+ENGINE_POOL_SIZE = 5
+ENGINE_MAX_OVERFLOW = 10
+# Recycle connections older than this many seconds. Should be lower than MySQL's ``wait_timeout``.
+ENGINE_POOL_RECYCLE = 3600
+# If True, test connections for liveness when they are checked out of the pool.
+ENGINE_POOL_PRE_PING = True
+# Maximum number of ORM classes mapped to introspected tables (and of Table objects) kept in a process. See
+# chartchemy.mappers.MapperCache.
+MAPPER_CACHE_SIZE = 500
+
+# Chartchemy settings
+# ~~~~~~~~~~~~~~~~~~~
+# Number of seconds the result of a chart's aggregate query is cached for (in the default Django cache),
+# unless the chart sets its own ``cache_timeout``. 0 disables caching.
+CHART_DATA_CACHE_TIMEOUT = 300
+# Charts plot at most this many categories (x axis values), unless the chart sets its own ``category_limit``.
+# The rest are lumped together in an "Other" category. 0 means no limit.
+CHART_CATEGORY_LIMIT = 50
+# How the aggregate queries of the charts are built: 'core' (SQLAlchemy Core select(), plain tuples) or 'orm'
+# (session.query() on mapped classes).
+CHART_QUERY_MODE = 'core'
+# Number of rows fetched from the database (and serialized) at a time when streaming chart data.
+CHART_STREAM_BATCH_SIZE = 1000
+# Number of threads (per process) that run the queries of the dashboards.
+QUERY_THREADS = 8
+# Maximum number of chart queries (per process) that run against the same datasource at the same time, unless
+# the datasource sets its own ``max_concurrent_queries``. Charts fail right away when the limit is reached.
+# The queries of the datasources on the same database are counted together.
+DATASOURCE_MAX_CONCURRENT_QUERIES = 2
+# Number of seconds a chart query may run for, unless the datasource sets its own ``query_timeout``. Longer
+# queries are cancelled (killed on the server for MySQL). 0 means no limit.
+DATASOURCE_QUERY_TIMEOUT = 30
+# Identical chart queries that run at the same time share one execution (see chartchemy.singleflight):
+# 'process' within a process, 'cache' across the processes too, through a lock in the default cache. Only set
+# 'cache' along with a cache shared by the processes (e.g. memcached), the default cache is per process. None
+# disables the coalescing. Waiters run the query themselves after SINGLE_FLIGHT_TIMEOUT seconds. Other
+# processes check for the result every SINGLE_FLIGHT_POLL_INTERVAL seconds.
+SINGLE_FLIGHT = 'process'
+SINGLE_FLIGHT_TIMEOUT = 60
+SINGLE_FLIGHT_POLL_INTERVAL = 0.05
+# Chart queries the database expects to read more rows than this from are refused, sampled, read from the
+# rollup or run in the background (see chartchemy.costs), unless the datasource sets its own
+# ``query_row_budget``. 0 means no budget: the queries aren't EXPLAINed first. Plans that read an index get
+# INDEXED_BUDGET_FACTOR times the budget.
+DATASOURCE_QUERY_ROW_BUDGET = 0
+INDEXED_BUDGET_FACTOR = 4
+# Number of threads (per process) that run the chart queries too expensive to run in a request.
+BACKGROUND_QUERY_THREADS = 2
+# Number of rows fetched from the database at a time by charts that aggregate in process.
+IN_PROCESS_BATCH_SIZE = 50000
+# Previews of the charts (while the axes are picked) aggregate a sample of at most this many rows, and give up
+# after this many seconds.
+PREVIEW_SAMPLE_SIZE = 10000
+PREVIEW_QUERY_TIMEOUT = 5
+# The gaps between the time buckets of a chart with a date or datetime x axis are filled (with 0 for counts
+# and sums, null otherwise), unless the chart would have more than this many buckets. Charts can't be given a
+# granularity that splits the dates of their x axis in more buckets than this.
+TIME_BUCKET_MAX_BUCKETS = 10000
+# Number of seconds the queries that refresh the rollups of the charts may run for. 0 means no limit.
+ROLLUP_QUERY_TIMEOUT = 3600
+# The dashboard answers the charts of the same table and x axis with one query, unless the x axis has more
+# than this many categories.
+DASHBOARD_MERGE_MAX_CATEGORIES = 10000
+# Chart requests that take at least this many seconds are logged (zosimus.chartchemy.slow). 0 disables the
+# log.
+SLOW_CHART_THRESHOLD = 2.0
+# The metrics view reports the percentiles of the durations of the last METRICS_SAMPLES requests of every
+# chart and every datasource.
+METRICS_SAMPLES = 1000
+# If True, the chart options are serialized the old way: every string HTML escaped on its own, non ASCII
+# characters dropped and the decimals serialized as is, with simplejson. Otherwise they are serialized in one
+# pass (with ujson if it is installed) and escaped afterwards. See chartchemy.utils.
+CHART_JSON_COMPAT = False
+# Label of the NULL category (rows whose x axis value is NULL) in the charts.
+CHART_NULL_CATEGORY = '(none)'
+# If True, datasources are introspected on a pool of background threads (uWSGI needs --enable-threads).
+# Otherwise introspection runs inline when a datasource is added.
+INTROSPECTION_ASYNC = True
+# Number of threads that introspect datasources.
+INTROSPECTION_THREADS = 2
+# If True, the introspection also profiles the tables (row counts, distinct counts of the dimensions, indexed
+# columns). See chartchemy.profiling. Distinct counts the database doesn't keep are counted over the first
+# PROFILE_MAX_ROWS rows of every table, in Python, within the query timeout of the datasource. Off by default:
+# it reads a lot of rows on every introspection.
+INTROSPECTION_PROFILE = False
+PROFILE_MAX_ROWS = 1000000
+# Charts on tables with at least this many rows, grouped by an unindexed x axis, and charts with an x axis
+# with at least this many distinct values are flagged as expensive.
+PROFILE_LARGE_TABLE_ROWS = 1000000
+PROFILE_MANY_CATEGORIES = 10000
+# The ``reintrospect`` management command refreshes datasources introspected more than this many hours ago.
+INTROSPECTION_MAX_AGE = 24
+# Introspection jobs queued or started more than this many seconds ago are taken for lost (the jobs only live
+# in the memory of the process): the datasource can be introspected again, and ``reintrospect`` does it.
+INTROSPECTION_JOB_TIMEOUT = 3600
+
 try:
     from production_settings import *  # @UnusedWildImport
 except ImportError:
@@ -9,8 +9,13 @@ urlpatterns = patterns('zosimus.chartchemy.views',
     url(r'^datasources/$', 'datasources'),
     url(r'^datasources/(?P<pk>\d+)/$', 'datasource_details'),
     url(r'^datasources/(?P<pk>\d+)/delete/$', 'delete_datasource'),
+    url(r'^datasources/(?P<pk>\d+)/introspect/$', 'introspect_datasource'),
+    url(r'^dashboard/$', 'dashboard'),
+    url(r'^dashboard/data/$', 'dashboard_data'),
+    url(r'^metrics/$', 'metrics'),
     url(r'^charts/$', 'charts'),
     url(r'^charts/(?P<pk>\d+)/$', 'chart_details'),
+    url(r'^charts/(?P<pk>\d+)/data/$', 'chart_data'),
     url(r'^charts/(?P<pk>\d+)/delete/$', 'delete_chart'),
 
     (r'^accounts/', include('django.contrib.auth.urls')),